@@ -10,17 +10,17 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
 import collections
-from debian.deb822 import Packages as debPackages
+import concurrent.futures
 import flask
-import gzip
-import io
 import logging
 import os
 from pdb import set_trace
-import requests as HTTP_REQUESTS
 import sys
 
 from tmms.utils import core_utils
+from tmms.utils import index_cache
+from tmms.utils import package_catalog
+from tmms.utils import package_search
 
 
 _ERS_element = 'package'
@@ -43,8 +43,8 @@ def _webpage(name=None):
         return flask.render_template(
             _ERS_element + '_all.tpl',
             label=__doc__,
-            keys=sorted(_data.keys()),
-            alphabetic_sets=alphabetic_sets(_data.keys()),
+            keys=_search.names,
+            alphabetic_sets=_alphabetic,
             base_url=flask.request.url)
 
     return flask.render_template(
@@ -78,11 +78,11 @@ def _api(name=None):
     status_code = 200
     if name is None:
         packages = [ ]
-        for pkg in _data.values():
+        for name in _data:
             tmpdict = {
-                'package': pkg['Package'],
-                'version': pkg['Version'],
-                'description': pkg['Description']
+                'package': name,
+                'version': _data.version(name),
+                'description': _data.field(name, 'Description')
             }
             packages.append(tmpdict)
 
@@ -100,38 +100,108 @@ def _api(name=None):
         if tag in pkg and False:
             pkg[tag] = pkg[tag].split(', ')
 
-    #at this point, pkg is of type debian.deb822.Packages, instead of dict.
-    #that would make jsonify flip out as a TypeError. Therefore - make it dict.
-    pkg = dict(pkg)
     return flask.make_response(flask.jsonify(pkg), status_code)
 
+
+@BP.route('/api/%ss/search' % _ERS_element)
+def _api_search():
+    """
+        Packages matching the query parameters, a page at a time:
+    q (terms in the name or short description, all of them), prefix (of
+    the name), section, architecture, priority (exact values), page
+    (from 1) and per_page (default 50, at most 1000).  The response has
+    the matching page of packages, as in the full list plus their section,
+    architecture and priority, and the total number of matches.
+    """
+    if _data is None:
+        _load_data()
+
+    args = flask.request.args
+    filters = dict((field, args[field.lower()])
+                   for field in package_search.FILTERS if args.get(field.lower()))
+    try:
+        page = int(args.get('page', 1))
+        per_page = min(int(args.get('per_page', 50)), 1000)
+        if page < 1 or per_page < 1:
+            raise ValueError('page and per_page start at 1')
+    except ValueError as err:
+        return flask.make_response(flask.jsonify({ 'error': str(err) }), 400)
+
+    total, names = _search.search(args.get('q', ''), prefix=args.get('prefix'),
+                                  filters=filters,
+                                  offset=(page - 1) * per_page, limit=per_page)
+    packages = [ ]
+    for name in names:
+        pkg = _data.fields(name, ('Description', ) + package_search.FILTERS)
+        packages.append({
+            'package': name,
+            'version': _data.version(name),
+            'description': pkg.get('Description'),
+            'section': pkg.get('Section'),
+            'architecture': pkg.get('Architecture'),
+            'priority': pkg.get('Priority'),
+        })
+    return flask.make_response(flask.jsonify({
+        'package': packages,
+        'total': total,
+        'page': page,
+        'per_page': per_page }), 200)
+
 ###########################################################################
 
-_data = None
+_data = None        # utils/package_catalog.py Catalog
+_provides = None    # virtual package name -> [ real package names ]
+_search = None      # utils/package_search.py SearchIndex of _data
+_alphabetic = None  # alphabetic_sets() of the names, for the HTML list
 
 
 def _load_data():
-    global _data
+    global _data, _provides, _search, _alphabetic
 
     logging.info('Proxy settings\n%s' % '\n'.join(
         sorted(('%s=%s' % (p, os.environ[p])
             for p in os.environ if 'proxy' in p))))
 
-    all_mirrors = get_all_mirrors()
-
-    _data = {}
-    for full_source in all_mirrors:
-        _read_packages(full_source)
-
-
-def _read_packages(full_source):
-    """ Get Packages.gz of the sources.list entry and extract all of its pks.
-    Packages are saved into _data variable and will be accessed by _filter()
-    function.
+    # Every index of every mirror, in the order they override each other
+    indices = []
+    for full_source in get_all_mirrors():
+        components = _components(full_source)
+        for area in components.areas:
+            for arch in ('binary-all', 'binary-' + BP.config.arch):
+                indices.append((components.url, components.release, area, arch))
+
+    # Fetch and scan them all at once, merge them in order.  Downloads and
+    # gunzip overlap; the scanning itself still takes turns on the GIL.
+    workers = BP.config.get('INDEX_WORKERS', 8) or 1
+    cache = index_cache.IndexCache(
+        BP.config['MANIFESTING_ROOT'] + '/indexcache',
+        session=index_cache.session(workers), logger=BP.logger)
+    data = package_catalog.Catalog()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        scanned = [ pool.submit(_read_packages, cache, *index)
+                    for index in indices ]
+        for future in scanned:
+            if future.result() is not None:
+                data.add(future.result())
+    BP.logger.info('Package indices: %(cached)d cached, %(not_modified)d '
+                   'not modified, %(downloaded)d downloaded, %(stale)d stale'
+                   % cache.stats)
+    cache.prune()       # whatever no mirror lists anymore
+
+    provides = collections.defaultdict(list)
+    for name in data:
+        for virtual in _relations(data.field(name, 'Provides', '')):
+            provides[virtual[0]].append(name)
+    search = package_search.SearchIndex(data)
+    _data, _provides, _search, _alphabetic = \
+        data, provides, search, alphabetic_sets(search.names)
+
+
+def _components(full_source):
+    """
+        Mirror URL, release and areas of a sources.list entry.
 
     @param full_source: sources.list entry (deb http//url release area1 ...)
-
-    return: None. Content is saved into _data directly.
     """
     components = core_utils.deb_components(full_source)  # it leaves blanks...
     components.areas = [ a for a in components.areas if a.strip() ]
@@ -140,26 +210,28 @@ def _read_packages(full_source):
         msg += '  - Expected "deb http://mirror.url release ares"\n'
         msg += '  - Mirror provided: %s' % (full_source)
         raise RuntimeError(msg)
-    # Reference:
-    # https://github.com/raumkraut/python-debian/blob/master/README.deb822
-    repo = '%s/dists/%s/%%s/%%s/Packages.gz' % (components.url, components.release)
-    for area in components.areas:
-        for arch in ('binary-all', 'binary-' + BP.config.arch):
-            retrieveURL = repo % (area, arch)
-            BP.logger.info('Loading/processing "%s"' % retrieveURL)
-            pkgresp = HTTP_REQUESTS.get(retrieveURL)
-            if pkgresp.status_code != 200:
-                BP.logger.error('%s not found' % arch)
-                continue
-            BP.logger.debug('Uncompressing %s bytes' % pkgresp.headers['content-length'])
-
-            unzipped = gzip.decompress(pkgresp.content) # bytes all around
-            BP.logger.debug('Parsing %d bytes of package data' % len(unzipped))
-            unzipped = io.BytesIO(unzipped)    # the next step needs read()
-            deb_packages_iter = debPackages.iter_paragraphs(unzipped)
-            tmp = [ src for src in deb_packages_iter ]
-
-            _data.update(dict((pkg['Package'], pkg) for pkg in tmp))
+    return components
+
+
+def _read_packages(cache, url, release, area, arch):
+    """ Get Packages.gz of one area and arch of a mirror and map it.
+    Runs in a worker thread of _load_data().
+
+    @param cache: utils/index_cache.py IndexCache to get it through.
+    @param arch: "binary-all" or "binary-<arch>"
+
+    return: utils/package_catalog.py Index, None if there is no index.
+    """
+    retrieveURL = '%s/dists/%s/%s/%s/Packages.gz' % (url, release, area, arch)
+    BP.logger.info('Loading/processing "%s"' % retrieveURL)
+    path = cache.packages_path(url, release, area, arch)
+    if path is None:
+        BP.logger.error('%s not found' % retrieveURL)
+        return None
+
+    BP.logger.debug('Scanning %d bytes of package data' % os.path.getsize(path))
+    return package_catalog.Index(path, url)
+
 
 def get_all_mirrors():
     """
@@ -185,6 +257,72 @@ def get_all_mirrors():
     return all_mirrors
 
 
+def _relations(field):
+    '''"a (>= 1) | b:any, c" -> [ ['a', 'b'], ['c'] ], versions are ignored.'''
+    result = []
+    for group in field.split(','):
+        alternatives = []
+        for alt in group.split('|'):
+            name = alt.split('(')[0].split('[')[0].strip().split(':')[0]
+            if name:
+                alternatives.append(name)
+        if alternatives:
+            result.append(alternatives)
+    return result
+
+
+def _resolve(alternatives):
+    '''First alternative that is a real package or provided by one.'''
+    for name in alternatives:
+        if name in _data:
+            return name
+        if _provides.get(name):
+            return sorted(_provides[name])[0]
+    return None
+
+
+def _closure(packages):
+    """
+        Everything apt would pull in for these packages, as far as the
+    loaded indices can tell: Pre-Depends, Depends and Recommends (apt's
+    default), first satisfiable alternative, virtual packages through their
+    first provider.  Version constraints are not checked, the indices only
+    hold one version per package anyway.
+
+    :param 'packages': [list] of package names (URLs and files are ignored).
+    :return: [list] of dicts with the fields needed to fetch and verify each
+             .deb: package, version, architecture, url, size, sha256.
+    """
+    if _data is None:
+        _load_data()
+    todo = [ name for name in packages if name in _data ]
+    seen = set(todo)
+    while todo:
+        pkg = _data.fields(todo.pop(), ('Pre-Depends', 'Depends', 'Recommends'))
+        for field in ('Pre-Depends', 'Depends', 'Recommends'):
+            for alternatives in _relations(pkg.get(field, '')):
+                name = _resolve(alternatives)
+                if name is not None and name not in seen:
+                    seen.add(name)
+                    todo.append(name)
+
+    result = []
+    for name in sorted(seen):
+        pkg = _data.fields(name, ('Filename', 'SHA256', 'Version',
+                                  'Architecture', 'Size'))
+        if 'Filename' not in pkg or 'SHA256' not in pkg:
+            continue
+        result.append({
+            'package':      name,
+            'version':      pkg['Version'],
+            'architecture': pkg['Architecture'],
+            'url':          '%s/%s' % (_data.origin(name).rstrip('/'), pkg['Filename']),
+            'size':         int(pkg.get('Size', -1)),
+            'sha256':       pkg['SHA256'],
+        })
+    return result
+
+
 def _filter(packages):    # Maybe it's time for a class
     return [ pkg for pkg in packages if (
         not pkg.startswith('http://') and
@@ -195,5 +333,6 @@ def _filter(packages):    # Maybe it's time for a class
 
 def register(url_prefix):
     BP.filter = _filter     # So manifest can see it
+    BP.closure = _closure   # So nodes can prefetch
     BP.mainapp.register_blueprint(BP, url_prefix=url_prefix)
     _load_data()
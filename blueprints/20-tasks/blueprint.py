@@ -10,12 +10,13 @@ __maintainer__ = "Rocky Craig, Zakhar Volchak"
 __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
-from debian.deb822 import Packages as debPackages
 import flask
 import os
 from pdb import set_trace
 import sys
 
+from tmms.utils import control
+
 
 _ERS_element = 'task'
 
@@ -81,14 +82,10 @@ def _load_data():
     '''Parse the actual tasksel description file.'''
     global _data
 
-    _data = {}
-    task_content = None
-    with open(BP.tasks_file, 'r') as file_obj:
-        task_content = file_obj.read()
-
-    deb_packages_iter = debPackages.iter_paragraphs(task_content)
-    tmp = [ task for task in deb_packages_iter ]
-    _data.update(dict((task['Task'], task) for task in tmp))
+    with open(BP.tasks_file, 'rb') as file_obj:
+        tmp = list(control.iter_paragraphs(file_obj))
+    # One assignment: other request threads never see a partial catalog
+    _data = dict((task['Task'], task) for task in tmp)
 
 
 def _lookup(task_name, key=None):
@@ -13,17 +13,27 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 import argparse
 import errno
 import flask
+import functools
 import glob
+import inspect
 import json
 import os
 from pdb import set_trace
 import sys
+import threading
 import time
 import werkzeug
 
 from tmms.utils import core_utils
 from tmms.utils import customize_node
+from tmms.utils import events
 from tmms.utils import file_utils
+from tmms.utils import history
+from tmms.utils import logging
+from tmms.utils import metrics
+from tmms.utils import rootfs
+from tmms.utils import scheduler
+from tmms.utils import status_cache
 
 
 _ERS_element = 'node'
@@ -31,6 +41,18 @@ _ERS_element = 'node'
 # See the README in the main templates directory.
 BP = flask.Blueprint(_ERS_element, __name__)
 
+# The server is threaded (long polls and event streams stay open), so the
+# check-then-build of a binding has to be done one at a time.
+_binding_lock = threading.RLock()
+
+
+def _serialized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _binding_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
 ###########################################################################
 # HTML
 # See blueprint registration in manifest_api.py, these are relative paths
@@ -38,9 +60,9 @@ BP = flask.Blueprint(_ERS_element, __name__)
 
 @BP.route('/%s/' % _ERS_element)
 def web_node_all():
-    nodes_info = BP.nodes
-    for node in nodes_info:
-        status = get_node_status(node.coordinate)
+    bindings = _history().bindings()
+    for node in BP.nodes:
+        status = bindings.get(node.coordinate)
         if status:
             node.manifest = status['manifest']
             node.status = status['status']
@@ -54,6 +76,7 @@ def web_node_all():
 
 @BP.route('/%s/<path:name>' % _ERS_element, methods=('POST', ))
 @BP.route('/%s//<path:name>' % _ERS_element, methods=('POST', ))
+@_serialized
 def web_node_button_action(name=None):
     # Either way, name has no leading slash.
     if 'unbind' in flask.request.form:
@@ -79,13 +102,14 @@ def web_node_status(name=None):
         status = get_node_status(name)
         if status is not None:
             if status['status'] == 'ready':
-                ESPpath = '%s/%s/%s.ESP' % (
+                # Built on first download, see web_node_send_ESP()
+                ESPpath = '%s/%s/%s.ESP.json' % (
                     BP.config['TFTP_IMAGES'], node.hostname, node.hostname)
                 if os.path.isfile(ESPpath):
                     prefix = flask.request.url.split(_ERS_element)[0]
                     ESPURL = '%s%s/ESP/%s' % (
                         prefix, _ERS_element, node.hostname)
-                    ESPsizeMB = os.stat(ESPpath).st_size >> 20
+                    ESPsizeMB = customize_node.SNBU_SIZE_MB
 
             if status['status'] in ('building', 'ready'):
                 installpath = '%s/%s/untar/root' % (
@@ -117,17 +141,33 @@ def web_node_status(name=None):
         return flask.make_response('Kaboom: %s' % str(e), 404)
 
 
+# Flask 2.0 renamed send_file(cache_timeout) to max_age, 2.2 dropped the old name
+_NO_CACHE = { 'max_age': 0 } if 'max_age' in \
+    inspect.signature(flask.send_file).parameters else { 'cache_timeout': 0 }
+
+
 @BP.route('/%s/ESP/<path:hostname>' % _ERS_element)
 def web_node_send_ESP(hostname):
-    filename = hostname + '.ESP'
+    '''The first download builds the image, Range requests can resume it.'''
+    if '/' in hostname or hostname.startswith('.'):
+        return flask.make_response('No such node "%s"' % hostname, 404)
     ESPdir = '%s/%s' % (BP.config['TFTP_IMAGES'], hostname)
+    try:
+        ESPpath = customize_node.SNBU_image(ESPdir, hostname,
+                                            journal=BP.metrics.journal)
+    except Exception as err:
+        BP.logger.error('SNBU image for %s failed: %s' % (hostname, str(err)))
+        return flask.make_response('SNBU image failed: %s' % str(err), 500)
+    if ESPpath is None:
+        return flask.make_response('No image was built for "%s"' % hostname, 404)
 
     return flask.send_from_directory(
         ESPdir,                                     # required #1
-        filename,                                   # required #2
+        os.path.basename(ESPpath),                  # required #2
         as_attachment=True,                         # os.path.basename
         mimetype='application/x-raw-disk-image',    # dialogs say "ESP file"
-        cache_timeout=0)                            # Not in mainapp.config
+        conditional=True,                           # Range, If-Modified-Since
+        **_NO_CACHE)                                # Not in mainapp.config
 
 ###########################################################################
 # API
@@ -152,7 +192,8 @@ def get_all_bindings():
         List all nodes, their manifest bindings, and status
         (ready, building or error).
     """
-    nodes_info = _load_data()
+    nodes_info = { node_coord: status for node_coord, status in
+                   _history().bindings().items() if node_coord in BP.node_hostnames }
     if not nodes_info:  # FIXME: This is not a correct id of the node binding
         response = flask.jsonify({
             'No Content': 'There are no manifests associated with any nodes.'})
@@ -164,6 +205,185 @@ def get_all_bindings():
     return response
 
 
+@BP.route('/api/metrics', methods=('GET', ))
+def get_build_metrics():
+    """
+        Per-stage build timing and resource histograms over every build,
+    in Prometheus text format (see utils/metrics.py).
+    """
+    response = flask.make_response(BP.metrics.prometheus(), 200)
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+@BP.route('/api/%ss/history' % _ERS_element, methods=('GET', ))
+def get_build_history():
+    """
+        Past and current builds, newest first: node, manifest, when it was
+    bound, started and finished, duration, result ("ready", "error",
+    "superseded", "cancelled" or null while building) and artifact bytes.
+    Query parameters node, manifest, days and limit (default 100) narrow it;
+    with a node, each build also lists its status transitions.
+    """
+    try:
+        node_coord, manifest, since = _history_filter()
+        limit = min(int(flask.request.args.get('limit', 100)), 10000)
+    except ValueError as err:
+        return flask.make_response(flask.jsonify({'status': str(err)}), 400)
+    db = _history()
+    builds = db.builds(node=node_coord, manifest=manifest, since=since,
+                       limit=limit)
+    if node_coord is not None:
+        for build in builds:
+            build['transitions'] = db.transitions(build['id'])
+    return flask.make_response(flask.jsonify({'builds': builds}), 200)
+
+
+@BP.route('/api/%ss/history/stats' % _ERS_element, methods=('GET', ))
+def get_build_history_stats():
+    """
+        Durations of successful builds, eg the p95 for a manifest over the
+    last week: ?manifest=<namespace>&days=7.  Also takes node and result.
+    Returns count, mean, max, p50 and p95 in seconds (null without builds).
+    """
+    try:
+        node_coord, manifest, since = _history_filter()
+    except ValueError as err:
+        return flask.make_response(flask.jsonify({'status': str(err)}), 400)
+    stats = _history().stats(manifest=manifest, node=node_coord, since=since,
+                             result=flask.request.args.get('result', 'ready'))
+    return flask.make_response(flask.jsonify(stats), 200)
+
+
+def _history_filter():
+    '''(node_coord, manifest, since) from the query, ValueError if bad.'''
+    node_coord = None
+    nodespec = flask.request.args.get('node')
+    if nodespec:
+        node_coord = _resolve_node_coord(nodespec)
+        if node_coord is None:
+            raise ValueError('No such node "%s"' % nodespec)
+    manifest = flask.request.args.get('manifest') or None
+    if manifest is not None:
+        manifest = manifest.strip('/')
+    since = None
+    days = flask.request.args.get('days')
+    if days:
+        since = time.time() - float(days) * 86400
+    return node_coord, manifest, since
+
+
+def _history():
+    '''This thread's connection to the bindings and build history.'''
+    return history.open_history(BP.history_path)
+
+
+def _status_event(hostname, status):
+    '''StatusCache callback: one event per status change of a known node.'''
+    node_coord = BP.hostname_coords.get(hostname)
+    if node_coord is not None:
+        BP.events.append(_event(node_coord, status))
+
+
+def _event(node_coord, status):
+    event = { 'node': node_coord, 'status': 'unbound' }
+    if status is not None:
+        event.update((key, status[key]) for key in
+            ('status', 'message', 'manifest', 'job_id', 'queue_position')
+            if key in status)
+    return event
+
+
+@BP.route('/api/%ss/status' % _ERS_element, methods=('GET', ))
+def get_all_node_status():
+    """
+        Status of every node in one response: status, manifest, message,
+    stage and the started/updated timestamps, "unbound" for nodes without a
+    binding.  The strong ETag is the event sequence number, which moves on
+    every status change, so If-None-Match gets a 304 until something does.
+    """
+    etag = str(BP.events.seq)   # before reading: a newer body is harmless
+    if flask.request.if_none_match.contains(etag):
+        response = flask.make_response('', 304)
+        response.set_etag(etag)
+        return response
+    nodes = {}
+    for node_coord in BP.node_coords:
+        nodes[node_coord] = get_node_status(node_coord) or {'status': 'unbound'}
+    response = flask.make_response(
+        flask.jsonify({'version': int(etag), 'nodes': nodes}), 200)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'     # always revalidate
+    return response
+
+
+@BP.route('/api/%ss/events' % _ERS_element, methods=('GET', ))
+def get_node_events():
+    """
+        Node status transitions, as a long poll (JSON) or a server-sent
+    event stream (Accept: text/event-stream).  Query parameters:
+        since=N     last seq seen (SSE also takes a Last-Event-ID header)
+        nodes=a,b   node specs of interest, default all
+        timeout=T   long poll seconds, default 30, at most 60
+    JSON is {"seq": S, "events": [...]}, each event with its own seq.  If N
+    is missing or too old to resume, "reset" is true and the events are the
+    current state of the nodes (status "unbound" if not bound).
+    """
+    args = flask.request.args
+    try:
+        since = args.get('since', flask.request.headers.get('Last-Event-ID'))
+        since = None if since in (None, '') else int(since)
+        timeout = min(max(float(args.get('timeout', 30)), 0.0), 60.0)
+    except ValueError as err:
+        return flask.make_response(flask.jsonify({'status': str(err)}), 400)
+    wanted = None
+    if args.get('nodes'):
+        wanted = set()
+        for nodespec in args['nodes'].split(','):
+            node_coord = _resolve_node_coord(nodespec.strip())
+            if node_coord is None:
+                response_msg = flask.jsonify(
+                    {'status': 'No such node "%s"' % nodespec})
+                return flask.make_response(response_msg, 404)
+            wanted.add(node_coord)
+    match = None if wanted is None else (lambda e: e['node'] in wanted)
+
+    def snapshot(seq):
+        return [ dict(_event(node_coord, get_node_status(node_coord)), seq=seq)
+                 for node_coord in BP.node_coords
+                 if wanted is None or node_coord in wanted ]
+
+    def poll(since, timeout):
+        seq, found = BP.events.since(since, timeout, match)
+        if found is None:
+            return seq, snapshot(seq), True
+        return seq, found, False
+
+    if 'text/event-stream' not in flask.request.headers.get('Accept', ''):
+        seq, found, reset = poll(since, timeout)
+        body = {'seq': seq, 'events': found}
+        if reset:
+            body['reset'] = True
+        return flask.make_response(flask.jsonify(body), 200)
+
+    def stream(since):
+        while not BP.events.closed:     # the server is going away
+            seq, found, reset = poll(since, 15)
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            for event in found:
+                yield 'id: %d\nevent: status\ndata: %s\n\n' % (
+                    event['seq'], json.dumps(event))
+            if not found:
+                yield ': keepalive\n\n'      # also notices a gone client
+            since = seq
+
+    response = flask.Response(stream(since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 def _resolve_node_coord(nodespec):
     '''Discern whether the input is a number or a string, then
        lookup the node.
@@ -224,6 +444,7 @@ def node_coord2image_dir(node_coord):
 
 @BP.route('/api/%s/<path:nodespec>' % _ERS_element, methods=('DELETE', ))
 @BP.route('/api/%s//<path:nodespec>' % _ERS_element, methods=('DELETE', ))
+@_serialized
 def delete_node_binding(nodespec):
     """
         Remove Node to Manifest binding. Find node's folder in the TFTP
@@ -241,8 +462,9 @@ def delete_node_binding(nodespec):
         BP.logger(response)    # chooses log level based on status code
         return response
 
-    node_status = get_node_status(node_coord)
-    if node_status and node_status['status'] == 'building':
+    node_status = get_node_status(node_coord, fresh=True)
+    if node_status and node_status['status'] == 'building' and \
+       not BP.scheduler.cancel(node_coord):     # queued jobs can go
         msg = 'Cant delete binding - node is busy.'
         response_msg = flask.jsonify({'status' : msg})
         return flask.make_response(response_msg, 409)
@@ -255,19 +477,25 @@ def delete_node_binding(nodespec):
         node_name = os.path.basename(node_image_dir)
         node_build_dir = BP.config['FILESYSTEM_IMAGES'] + '/' + node_name
 
+        if not BP.DEBUG:    # overlay mount or btrfs snapshot
+            rootfs.release(node_build_dir)
+
         files_to_clean = glob.glob(node_image_dir + '/*')
         files_to_clean.extend(glob.glob(node_build_dir + '/*')) # sys-images/$NODE$/*
 
         if not BP.DEBUG: # keep previous build while debugging.
             for to_remove in files_to_clean:
                 file_utils.remove_target(to_remove)
+        BP.status_cache.refresh(node_name)
 
     except AssertionError as e:     # no such dir, no such binding
         pass
-    except OSError as err:
+    except (OSError, RuntimeError) as err:
         msg = 'Failed to delete binding: %s' % err
         response_msg = flask.jsonify({'status' : msg})
         response = flask.make_response(response_msg, 500)
+    if response.status_code != 500:
+        _history().unbind(node_coord)
     BP.logger(response)    # chooses log level based on status code
 
     return response
@@ -277,6 +505,7 @@ def delete_node_binding(nodespec):
 
 @BP.route('/api/%s/<path:nodespec>' % _ERS_element, methods=('PUT', ))
 @BP.route('/api/%s//<path:nodespec>' % _ERS_element, methods=('PUT', ))
+@_serialized
 def bind_node_to_manifest(nodespec=None):
     """
         Generate a custom filesystem image for a provided node coordinate
@@ -291,7 +520,8 @@ def bind_node_to_manifest(nodespec=None):
         BP.logger.info('Binding manifest to a node [%s].' % (node_coord))
 
         resp_status = 409   # Conflict
-        assert get_node_status(node_coord) is None, 'Node is already bound.'
+        assert get_node_status(node_coord, fresh=True) is None, \
+            'Node is already bound.'
 
         resp_status = 413
         assert int(flask.request.headers['Content-Length']) < 200, \
@@ -310,7 +540,10 @@ def bind_node_to_manifest(nodespec=None):
 
         manifest.validate_packages_tasks()
 
-        response = build_node(manifest, node_coord)
+        resp_status = 400
+        priority = int(req_body.get('priority', 0))
+
+        response = build_node(manifest, node_coord, priority)
     except werkzeug.exceptions.BadRequest as e:
         response_msg = flask.jsonify({'status' : e.get_response()})
         response = flask.make_response(response_msg, resp_status)
@@ -320,21 +553,97 @@ def bind_node_to_manifest(nodespec=None):
     BP.logger(response)
     return response
 
+
+
+@BP.route('/api/%ss/' % _ERS_element, methods=('PUT', ))
+@_serialized
+def bind_nodes_to_manifest():
+    """
+        Bind one manifest to many nodes, body {"manifest": name, "nodes":
+    [nodespec, ...]} and optionally "priority".  The manifest is validated
+    and its packages resolved once.  With the image cache on (IMAGE_CACHE_MB
+    > 0) the first node builds the shared image (see image_cache.py) and the
+    others are queued after it to reuse it, so only the per-node steps are
+    repeated.  Without it there is nothing to share and they all queue
+    independently.
+
+    :return: per-node status code, message and job_id under "nodes".
+    """
+    try:
+        BP.logger.info('Binding manifest to many nodes.')
+
+        resp_status = 413
+        assert int(flask.request.headers['Content-Length']) < 65536, \
+            'Content is too long! Max size is 65536 characters.'
+
+        resp_status = 400
+        req_body = flask.request.get_json(force=True)
+        manname = req_body['manifest']
+        nodespecs = req_body['nodes']
+        assert isinstance(nodespecs, list) and nodespecs, \
+            '"nodes" must be a list of node coordinates'
+        priority = int(req_body.get('priority', 0))
+
+        manifest = BP.manifest_lookup(manname)
+        resp_status = 404
+        assert manifest is not None, "The specified manifest does not exist."
+
+        manifest.validate_packages_tasks()
+        debs = prefetch_debs(manifest)
+
+        results = {}
+        leader = None
+        chain = BP.config.get('IMAGE_CACHE_MB', 20480) > 0
+        for nodespec in nodespecs:
+            node_coord = _resolve_node_coord(str(nodespec))
+            if node_coord is None:
+                results[nodespec] = {
+                    'status': 404, 'message': 'No such node "%s"' % nodespec }
+                continue
+            if get_node_status(node_coord, fresh=True) is not None:
+                results[node_coord] = {
+                    'status': 409, 'message': 'Node is already bound.' }
+                continue
+            response = build_node(manifest, node_coord, priority,
+                                  after=leader, debs=debs)
+            try:
+                body = json.loads(response.get_data().decode())
+            except ValueError:      # DRY RUN tacks text on
+                body = { 'status': response.get_data().decode() }
+            results[node_coord] = {
+                'status': response.status_code,
+                'message': body.get('status'),
+                'job_id': body.get('job_id') }
+            if chain and leader is None and response.status_code < 300:
+                leader = body.get('job_id')
+
+        built = sum(1 for r in results.values() if r['status'] < 300)
+        msg = '%s manifest set on %d of %d nodes.' % (
+            manifest.namespace, built, len(nodespecs))
+        response = flask.make_response(
+            flask.jsonify({'status': msg, 'nodes': results}),
+            200 if built else 409)
+    except werkzeug.exceptions.BadRequest as e:
+        response_msg = flask.jsonify({'status' : 'Bad JSON body: %s' % e})
+        response = flask.make_response(response_msg, resp_status)
+    except (AssertionError, KeyError, TypeError, ValueError) as err:
+        response_msg = flask.jsonify({'status' : str(err)})
+        response = flask.make_response(response_msg, resp_status)
+    BP.logger(response)
+    return response
+
 ###########################################################################
 
 
-def build_node(manifest, node_coord):
+def _build_args(manifest, node_coord):
     """
-        Generate a custom filesystem image based on the provided manifset.
+        Everything customize_node.execute() needs to build one node.
 
     :param 'manifest': [cls] manifest class of the 99-manifest/blueprint.py
-    :param 'node_coord': [int\str] node number or name.
-    :return: flask's response data.
+    :param 'node_coord': [str] node coordinate.
+    :return: [dict] build arguments.
     """
     golden_tar = BP.config['GOLDEN_TAR']
-    if not os.path.exists(golden_tar):
-        response_msg = flask.jsonify({'status' : 'Missing "Golden Image"!' })
-        return flask.make_response(response_msg, 505)
 
     # Each node gets its own set of dirs.  'nodes[]' matches snippets.
     hostname = BP.nodes[node_coord][0].hostname
@@ -383,6 +692,22 @@ def build_node(manifest, node_coord):
         'postinst':      postinst,
         'rclocal':       rclocal,
         'golden_tar':    golden_tar,
+        'rootfs_backend': BP.config.get('ROOTFS_BACKEND', 'auto'),
+        'image_cache':   sys_imgs + '/_cache',
+        'image_cache_mb': BP.config.get('IMAGE_CACHE_MB', 20480),
+        'install_batch': BP.config.get('INSTALL_BATCH', True),
+        'deb_cache':     BP.config['MANIFESTING_ROOT'] + '/debcache',
+        'deb_cache_mb':  BP.config.get('DEB_CACHE_MB', 8192),
+        'prefetch':      build_dir + '/prefetch.json',
+        'prefetch_workers': BP.config.get('PREFETCH_WORKERS', 8),
+        'compress_threads': BP.config.get('COMPRESS_THREADS', None),
+        'initramfs_codec': BP.config.get('INITRAMFS_CODEC', 'gzip'),
+        'layered_initramfs': BP.config.get('LAYERED_INITRAMFS', True),
+        'slots_dir':     BP.config['MANIFESTING_ROOT'] + '/jobs/slots',
+        'metrics_journal': BP.metrics.journal,
+        'history':       BP.history_path,
+        'io_slots':      BP.config.get('BUILD_IO_SLOTS', 2),
+        'cpu_slots':     BP.config.get('BUILD_CPU_SLOTS', 2),
         'build_dir':     build_dir,
         'tftp_dir':      tftp_dir,
         'status_file':   tftp_dir + '/status.json',
@@ -390,6 +715,29 @@ def build_node(manifest, node_coord):
         'debug':         BP.DEBUG,
         'logger':        BP.logger   # will get replaced in execute()
     }
+    return build_args
+
+
+def build_node(manifest, node_coord, priority=0, after=None, debs=None):
+    """
+        Queue a custom filesystem image build based on the provided manifset.
+
+    :param 'manifest': [cls] manifest class of the 99-manifest/blueprint.py
+    :param 'node_coord': [int\str] node number or name.
+    :param 'priority': [int] higher builds sooner if BUILD_ORDER is "priority".
+    :param 'after': [str] job_id of a build this one waits for.
+    :param 'debs': [list] prefetch_debs(manifest) if the caller has it.
+    :return: flask's response data.
+    """
+    if not os.path.exists(BP.config['GOLDEN_TAR']):
+        response_msg = flask.jsonify({'status' : 'Missing "Golden Image"!' })
+        return flask.make_response(response_msg, 505)
+
+    build_args = _build_args(manifest, node_coord)
+    hostname = build_args['hostname']
+    build_dir = build_args['build_dir']
+    tftp_dir = build_args['tftp_dir']
+
     # Legacy technique called this as a subprocess.  Construct the command
     # for verbose output and manual invocation for development.
     cmd_args = []
@@ -403,12 +751,13 @@ def build_node(manifest, node_coord):
     response_msg = flask.jsonify({'status' : msg})
     response = flask.make_response(response_msg, 201)
 
-    if glob.glob(tftp_dir + '/*.cpio'):
+    if glob.glob(tftp_dir + '/*.cpio.*'):
         msg = 'Existing manifest changed; image re-build initiated.'
         response_msg = flask.jsonify({'status' : msg})
         response = flask.make_response(response_msg, 200)
 
     build_args = argparse.Namespace(**build_args)    # mutable
+    _history().bind(node_coord, hostname, manifest.namespace)
 
     # ------------------------- DRY RUN
     if BP.config['DRYRUN']:
@@ -416,6 +765,7 @@ def build_node(manifest, node_coord):
         print(cmd)      # Now you can cut/paste and run it by hand.
         customize_node.update_status(
             build_args, 'Node was built with a Dry Run.', status='ready')
+        BP.status_cache.refresh(hostname)
         return response
     # ---------------------------------
 
@@ -427,10 +777,17 @@ def build_node(manifest, node_coord):
         response_msg = flask.jsonify({'status' : msg})
         return flask.make_response(response_msg, 505)
 
-    # Before the child, to eliminate race condition if returning from
+    write_prefetch(manifest, build_args.prefetch, debs)
+
+    # Any SNBU image is about to be stale
+    for stale in glob.glob('%s/%s.ESP*' % (tftp_dir, hostname)):
+        os.unlink(stale)
+
+    # Before the job, to eliminate race condition if returning from
     # here to web-based actions.
     customize_node.update_status(
         build_args, 'Preparing to build PXE images.', status='building')
+    BP.status_cache.refresh(hostname)
 
     if BP.DEBUG:
         set_trace()
@@ -438,89 +795,104 @@ def build_node(manifest, node_coord):
         return response
 
     try:
-        forked = os.fork()
-    except OSError as err:
+        job = BP.scheduler.submit(build_args, manifest.namespace, priority,
+                                  after)
+    except (OSError, RuntimeError) as err:
         msg = 'AYE! Took an arrow to the knee! [%s]' % err
         response_msg = flask.jsonify({'status' : msg})
         return flask.make_response(response_msg, 505)
 
-    if forked > 0:  # wait for the child1 to exit.
-        try:
-            pid, retval = os.waitpid(forked, 0)
-            if retval:
-                response.status_code = 500
-        except OSError as e:
-            response.status_code = 500
-        return response
+    body = json.loads(response.get_data().decode())
+    body['job_id'] = job.job_id
+    body['queue_position'] = BP.scheduler.position(job.job_id)
+    response.set_data(json.dumps(body))
+    return response
 
-    # The child makes a grandchild to build the node.  Close the flask socket.
-    # Yes there's a window on multiple requestors, but I'm not ready for
-    # eventlets yet.
-    for i in range(3, 20):
-        try:
-            os.close(i)
-        except OSError as err:
-            if err.errno != errno.EBADF:
-                BP.logger.warning('Could not close(%d): %s' % (i, str(err)))
 
-    customize_node.execute(build_args)      # should NOT return
-    BP.logger.critical('Unexpected return to child1')
-    raise SystemExit('Unexpected return to child1')
+def _run_job(job):
+    '''In the child the scheduler forked: close the flask sockets and build.'''
+    # Only this thread was forked.  Let go of what the server holds open
+    # before closing its fds, or log records and history writes would go
+    # to whatever file later reuses one of those numbers.
+    logging.tmmsLogger.after_fork()
+    history.after_fork()
+    BP.status_cache.after_fork()
+    # Threaded server: any number of client sockets and watches may be open
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+    os.chdir('/tmp')
+    os.setsid()     # outlive a server restart
+    job.args.scheduled = True
+    job.args.queue_position = None
+    customize_node.execute(job.args)
+
+
+def _report_job(job, message, status):
+    job.args.queue_position = job.position if status == 'building' else None
+    customize_node.update_status(job.args, message, status=status)
+
+
+def _recover_job(job):
+    '''Build arguments for a job from before a restart, None to drop it.'''
+    status = get_node_status(job.node_coord, fresh=True)
+    if not status or status['status'] != 'building':
+        return None     # unbound or finished since
+    manifest = BP.manifest_lookup(job.manifest)
+    if manifest is None:
+        return None
+    return argparse.Namespace(**_build_args(manifest, job.node_coord))
 
-###########################################################################
 
 
-_data = None    # node <-> manifest bindings
+def prefetch_debs(manifest):
+    '''Dependency closure of manifest packages and tasks for prefetch.py'''
+    roots = list(manifest.thedict['packages'] or [])
+    for task in manifest.thedict['tasks'] or []:
+        roots.extend(BP.blueprints['task'].get_packages(task) or [])
+    debs = []
+    if BP.config.get('PREFETCH_WORKERS', 8) and roots:
+        debs = BP.blueprints['package'].closure(roots)
+    return debs
 
 
-def get_node_status(node_coord):
+def write_prefetch(manifest, fname, debs=None):
+    if debs is None:
+        debs = prefetch_debs(manifest)
+    file_utils.write_to_file(fname, json.dumps(debs))
+
+###########################################################################
+
+
+def get_node_status(node_coord, fresh=False):
     """
-        Scan tftp/images/{hostname} folder for "status.json" that is generated
-    by node_builder/customize_node.py script. This file contatins information
-    about the Node binding status that complies with ERS specs (Section 8.6)
+        The "status.json" in tftp/images/{hostname} that is generated by
+    node_builder/customize_node.py script, from the status cache. This file
+    contatins information about the Node binding status that complies with
+    ERS specs (Section 8.6)
 
     :param 'node_coord': [str] node full coordinate string.
+    :param 'fresh': [bool] read the file now instead of trusting the cache,
+                    for decisions like "is it bound".
     :return: [dict] values that describes node's state
              (status, message, manifest)  (ERS document section 8.6)
              None no status file (ie, node is unbound)
     """
-    try:
-        assert node_coord in BP.node_coords, 'Unknown node coordinate'
-        node_image_dir = node_coord2image_dir(node_coord)   # can raise
-        with open(node_image_dir + '/status.json', 'r') as file_obj:
-            status = json.loads(file_obj.read())
-    except (FileNotFoundError) as err:    # Unbound
-        BP.logger.debug('<get_node_status> for %s: unbound' % (node_coord))
-        return None
-    except (AssertionError) as err:
-        BP.logger.error('%s: %s' % (node_coord, str(err)))
+    hostname = BP.node_hostnames.get(node_coord)
+    if hostname is None:
+        BP.logger.error('%s: Unknown node coordinate' % node_coord)
         return None
-    except Exception as err:       # TCNH =)
-        status = {
-            'message':  'Failed to parse status file: %s ' % str(err),
-            'manifest': 'unknown',
-            'status':   'error'
-        }
-    BP.logger.debug('<get_node_status> for %s: %s' % (
-        node_coord, json.dumps(status, indent=4)))
+    if fresh:
+        status = BP.status_cache.refresh(hostname)
+    else:
+        status = BP.status_cache.get(hostname)
+    BP.logger.debug('<get_node_status> for %s: %s', node_coord,
+                    status or 'unbound')
     return status
 
 
-def _load_data():
-    """
-        Scan tftp/images folder for known hostnames and read its status.json
-    file. Save this data into a dictionary and return it to the user.
-
-    :return: [dict] node_coordinate - node_status key value pair of the
-        current status of the nodes.
-    """
-    global _data
-    _data = {}
-    for node in BP.nodes:
-        node_status = get_node_status(node.coordinate)
-        if node_status:
-            _data[node.coordinate] = node_status
-    return _data
+def _drain():
+    '''The server stops serving: end event waits, stop launching builds.'''
+    BP.events.close()
+    BP.scheduler.stop()
 
 
 def _manifest_lookup(name):
@@ -535,6 +907,35 @@ def _manifest_lookup(name):
 def register(url_prefix):
     BP.nodes = BP.config['tmconfig'].allNodes
     BP.node_coords = list([node.coordinate for node in BP.nodes])  # ordered
+    BP.node_hostnames = { node.coordinate: node.hostname for node in BP.nodes }
+    BP.hostname_coords = { node.hostname: node.coordinate for node in BP.nodes }
     BP.manifest_lookup = _manifest_lookup
+    BP.drain = _drain       # see utils/serving.py
     BP.mainapp.register_blueprint(BP, url_prefix=url_prefix)
-    _load_data()
+    BP.events = events.EventLog()
+    BP.history_path = BP.config.get('HISTORY_DB',
+        BP.config['MANIFESTING_ROOT'] + '/history.sqlite')
+    # The store has the last status of every binding, no need to read them
+    # all.  A new store starts from status.json files instead.
+    db = _history()
+    BP.status_cache = status_cache.StatusCache(
+        BP.config['TFTP_IMAGES'],
+        poll=BP.config.get('STATUS_POLL_SECONDS', 30), logger=BP.logger,
+        on_change=_status_event,
+        initial=None if db.created else db.statuses())
+    if db.created:
+        for hostname, status in BP.status_cache.all().items():
+            if hostname in BP.hostname_coords:
+                db.import_status(BP.hostname_coords[hostname], status)
+    BP.status_cache.start()
+    BP.metrics = metrics.Aggregate(
+        BP.config['MANIFESTING_ROOT'] + '/metrics/builds.jsonl')
+    BP.scheduler = scheduler.Scheduler(
+        BP.config['MANIFESTING_ROOT'] + '/jobs', _run_job,
+        max_jobs=BP.config.get('BUILD_JOBS', 4),
+        order=BP.config.get('BUILD_ORDER', 'fifo'),
+        report=_report_job, logger=BP.logger)
+    # The reloader's watcher process never serves, leave the jobs alone.
+    if not BP.config.get('auto-update') or \
+       os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        BP.scheduler.recover(_recover_job)
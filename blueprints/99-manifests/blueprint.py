@@ -263,7 +263,7 @@ _data = None
 
 def _load_data():
     global _data
-    _data = {}
+    data = {}
     manfiles = [    # List comprehension
         (dirpath, f) for dirpath, dirnames, fnames in os.walk(BP.UPLOADS)
         for f in fnames
@@ -280,9 +280,10 @@ def _load_data():
 
             # search is expected by manifest name, (e.g. manifest.json, not
             # path/manifest.json)
-            _data[manname] = this
+            data[manname] = this
         except Exception as e:
             pass
+    _data = data    # other request threads never see a partial catalog
 
 
 def register(url_prefix):
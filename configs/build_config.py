@@ -164,8 +164,10 @@ class ManifestingConfiguration(object):
 
     @property
     def golden_tar(self):
-        path = self.golden_dir + '/golden.*.tar'
-        found_tar = glob.glob(path)
+        # Compressed golden images are extracted by utils/extract.py
+        found_tar = []
+        for suffix in ('', '.gz', '.xz', '.zst'):
+            found_tar += glob.glob(self.golden_dir + '/golden.*.tar' + suffix)
 
         if len(found_tar) == 0:
             return None
@@ -183,7 +185,7 @@ class ManifestingConfiguration(object):
     def arch(self):
         '''
             Get golden image architecture from its file name.
-        Golden image file name format: golden.ARCH_NAME.tar
+        Golden image file name format: golden.ARCH_NAME.tar[.gz|.xz|.zst]
         '''
         golden_file = self.get('GOLDEN_TAR')
         if golden_file is None:
@@ -52,6 +52,7 @@ from tm_librarian.tmconfig import TMConfig
 try:
     from tmms.utils import utils
     from tmms.utils import core_utils
+    from tmms.utils import serving
     from tmms.utils.daemonize3 import Daemon
     from tmms.utils.logging import tmmsLogger
     from tmms.setup import parse_cmdline_args
@@ -370,12 +371,25 @@ def daemonize(mainapp, cmdline_args):
             daemon.stop()
             raise SystemExit(0)
 
+        if cmdline_args.daemon_reload:
+            print('Reloading the daemon...')
+            daemon.reload()
+            raise SystemExit(0)
+
         if cmdline_args.daemon_status:
             print(daemon.status())
             raise SystemExit(0)
     except RuntimeError as err:
         raise SystemExit(str(err))
 
+
+def drain_blueprints():
+    '''serving.serve() stopped accepting requests, see BP.drain.'''
+    for blueprint in mainapp.blueprints.values():
+        drain = getattr(blueprint, 'drain', None)
+        if drain is not None:
+            drain()
+
 ###########################################################################
 # Must come after all route declarations, including blueprint registrations.
 # Used here for debug and in landing page (see route above).
@@ -419,22 +433,37 @@ def main():
     if mainapp.config['DEBUG']:
         mainapp.jinja_env.cache = jinja2.environment.create_cache(0)
 
-    core_utils.create_loopback_files() # they disappear after LXC restart FIXME utils?
-    set_iptables(mainapp.config)
-    kill_dnsmasq(mainapp.config)
-    start_dnsmasq(mainapp.config)
+    # A reload (SIGHUP) re-executes the daemon that already did all this.
+    if not serving.reloaded():
+        core_utils.create_loopback_files() # they disappear after LXC restart FIXME utils?
+        set_iptables(mainapp.config)
+        kill_dnsmasq(mainapp.config)
+        start_dnsmasq(mainapp.config)
 
-    daemonize(mainapp, cmdline_args)    # If it's a daemon, do it now...
-    register_blueprints(mainapp)        # ...to stick this in the background.
+        daemonize(mainapp, cmdline_args)    # If it's a daemon, do it now...
+    register_blueprints(mainapp)            # ...to stick this in the background.
 
     mainapp.logger.info('Starting web server')
-    mainapp.run(
-        debug=mainapp.config['DEBUG'],
-        use_reloader=mainapp.config['auto-update'],
-        host=mainapp.config['HOST'],
-        port=mainapp.config['PORT'],
-        threaded=False)
-    mainapp.logger.warning('Built-in server terminated')
+    if mainapp.config['DEBUG'] or mainapp.config['auto-update']:
+        mainapp.run(
+            debug=mainapp.config['DEBUG'],
+            use_reloader=mainapp.config['auto-update'],
+            host=mainapp.config['HOST'],
+            port=mainapp.config['PORT'],
+            threaded=True)     # node event streams and long polls wait a while
+        mainapp.logger.warning('Built-in server terminated')
+    else:
+        serving.serve(
+            mainapp,
+            mainapp.config['HOST'],
+            mainapp.config['PORT'],
+            workers=mainapp.config.get('SERVER_WORKERS', 32),
+            backlog=mainapp.config.get('SERVER_BACKLOG', 128),
+            keepalive=mainapp.config.get('SERVER_KEEPALIVE_SECONDS', 10),
+            graceful=mainapp.config.get('SERVER_GRACEFUL_SECONDS', 30),
+            on_drain=drain_blueprints,
+            logger=mainapp.logger)
+        mainapp.logger.warning('Server terminated')
     kill_dnsmasq(mainapp.config)
 
 
@@ -100,6 +100,10 @@ def parse_cmdline_args(extra_args_msg):
         '--daemon-status',
         help='Print status of the daemon',
         action='store_true')
+    parser.add_argument(
+        '--daemon-reload',
+        help='Reload the daemon without dropping requests',
+        action='store_true')
     parser.add_argument(
         '--daemon-restart',
         help='Restart the daemon',
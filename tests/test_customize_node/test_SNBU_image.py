@@ -0,0 +1,75 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the on-demand SNBU image functions of customize_node.py script.
+"""
+from pdb import set_trace
+from argparse import Namespace
+import os
+import unittest
+from shutil import rmtree
+
+import config
+from config import CN
+from tmms.utils import esp_image
+
+
+class SNBUImageTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        config.setup()
+        cls.tmp_folder = config.tmp_folder
+        cls.tftp_dir = cls.tmp_folder + '/tftp/images/node01'
+        os.makedirs(cls.tftp_dir)
+        os.makedirs(cls.tmp_folder + '/tftp/grub')
+        cls.files = {
+            '/grub/grubaa64.efi': b'grub',
+            '/images/node01/node01.vmlinuz.gz': b'kernel',
+            '/images/node01/node01.cpio.gz': b'cpio',
+        }
+        for name, content in cls.files.items():
+            with open(cls.tmp_folder + '/tftp' + name, 'wb') as f:
+                f.write(content)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_SNBU_image(self):
+        """ Built on first use, reused, rebuilt when an input changes. """
+        self.assertIsNone(CN.SNBU_image(self.tftp_dir, 'node01'))
+
+        args = Namespace(tftp_dir=self.tftp_dir, hostname='node01')
+        cpio = self.tftp_dir + '/node01.cpio.gz'
+        CN.record_SNBU_inputs(args, self.tftp_dir + '/node01.vmlinuz.gz', [ cpio ])
+        image = CN.SNBU_image(self.tftp_dir, 'node01')
+        self.assertEqual(image, self.tftp_dir + '/node01.ESP')
+        self.assertEqual(os.path.getsize(image), CN.SNBU_SIZE_MB << 20)
+        self.assertEqual(esp_image.read_file(image, 'EFI/debian/node01.cpio.gz'),
+                         b'cpio')
+        cfg = esp_image.read_file(image, 'EFI/debian/grub.cfg').decode()
+        self.assertIn('initrd /EFI/debian/node01.cpio.gz\n', cfg)
+
+        first = os.stat(image).st_ino
+        self.assertEqual(os.stat(CN.SNBU_image(self.tftp_dir, 'node01')).st_ino,
+                         first)
+
+        with open(cpio, 'wb') as f:
+            f.write(b'new cpio')
+        image = CN.SNBU_image(self.tftp_dir, 'node01')
+        self.assertNotEqual(os.stat(image).st_ino, first)
+        self.assertEqual(esp_image.read_file(image, 'EFI/debian/node01.cpio.gz'),
+                         b'new cpio')
+
+        # A rebind starts over
+        CN.record_SNBU_inputs(args, self.tftp_dir + '/node01.vmlinuz.gz', [ cpio ])
+        self.assertFalse(os.path.exists(image))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@
 """
 from pdb import set_trace
 from argparse import Namespace
+import gzip
 import os
 import sys
 import unittest
@@ -11,6 +12,7 @@ from shutil import rmtree, copytree
 
 import config
 from config import CN
+from tmms.utils import cpio
 
 
 class CreateCpioTest(unittest.TestCase):
@@ -38,23 +40,58 @@ class CreateCpioTest(unittest.TestCase):
     def test_create_cpio(self):
         """
             Test create_cpio func of customize_imga.py script.
-        Validate a .cpio file is created in expected location with a provided
-        hostname for the node.
+        Validate a compressed cpio is streamed into the TFTP directory with a
+        provided hostname for the node, and that /boot is not in it.
         """
         hostname = 'unittest_host'
-        cpio_file = '%s/%s.cpio' % (self.tmp_folder, hostname)
+        cpio_gzip = '%s/%s.cpio.gz' % (self.tmp_folder, hostname)
         args = {'new_fs_dir' : self.fs_img,
-                'dest_file' : cpio_file,
                 'hostname' : hostname,
                 'build_dir' : self.tmp_folder,
+                'tftp_dir' : self.tmp_folder,
                 'verbose' : False,
                 'dryrun' : True}
         args = Namespace(**args)
 
-        CN.create_cpio(args)
+        self.assertEqual(CN.create_cpio(args), [ cpio_gzip ])
 
-        self.assertTrue(os.path.exists(cpio_file), 'cpio file was not created!')
+        self.assertTrue(os.path.exists(cpio_gzip), 'cpio file was not created!')
+        with gzip.open(cpio_gzip, 'rb') as f:
+            names = [ entry[0] for entry in cpio.iter_entries(f) ]
+        self.assertIn('./etc/hostname', names)
+        self.assertIn('./sbin/init', names)
+        self.assertFalse([ n for n in names if n.startswith('./boot') ])
 
 
+    def test_layered_cpio(self):
+        """
+            With a shared image key the base cpio is written once under
+        _base and the node's own cpio only has what changed after that.
+        """
+        hostname = 'unittest_host'
+        tftp_dir = '%s/images/%s' % (self.tmp_folder, hostname)
+        os.makedirs(tftp_dir)
+        args = Namespace(new_fs_dir=self.fs_img, hostname=hostname,
+                         build_dir=self.tmp_folder, tftp_dir=tftp_dir,
+                         image_cache_key='0123abcd', layered_initramfs=True,
+                         is_golden=False, verbose=False, dryrun=True)
+
+        base = CN.create_base_cpio(args)
+        self.assertEqual(base, '%s/images/_base/0123abcd.cpio.gz' % self.tmp_folder)
+        with open(self.fs_img + '/etc/hostname', 'w') as f:
+            f.write(hostname)
+
+        cpio_files = CN.create_cpio(args)
+        self.assertEqual(cpio_files, [ base, tftp_dir + '/unittest_host.cpio.gz' ])
+        with gzip.open(cpio_files[1], 'rb') as f:
+            names = [ entry[0] for entry in cpio.iter_entries(f) ]
+        self.assertEqual(names, [ './etc', './etc/hostname' ])
+        self.assertEqual(os.path.realpath(tftp_dir + '/unittest_host.base'), base)
+
+        # Unbound, the base goes away
+        os.unlink(tftp_dir + '/unittest_host.base')
+        CN.initramfs.collect_bases(os.path.dirname(tftp_dir))
+        self.assertFalse(os.path.exists(base))
+
 if __name__ == '__main__':
     unittest.main()
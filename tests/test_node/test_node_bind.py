@@ -134,6 +134,36 @@ class BindNodeTest(unittest.TestCase):
         self.assertTrue('204' in status,
                         '204 for non binded node was not returned: %s' % status.keys())
 
+
+    def testSetNodeBulk(self):
+        """
+            Several nodes in one setnode go through the bulk API.
+        """
+        nodes = self.coords[-3:-1]
+        for node in nodes:
+            self.tmcmd.delete([node, ])
+
+        output = json.loads(self.tmcmd.set_node(nodes + [self.manifest]))
+        self.assertTrue('200' in output,
+            'Expected 200 on bulk setnode: %s instead' % output)
+        results = output['200']['nodes']
+        for node in nodes:
+            result = results['/' + node]
+            self.assertTrue(result['status'] in (200, 201),
+                'Bulk bind of %s failed: %s' % (node, result))
+            self.assertTrue(result['job_id'], 'No job_id for %s' % node)
+
+        for node in nodes:
+            status = json.loads(self.tmcmd.show([node, ]))['200']
+            while status['status'] == 'building':
+                time.sleep(10)
+                status = json.loads(self.tmcmd.show([node, ]))['200']
+            msg = '%s: expected status == ready, got %s' % (node, str(status))
+            self.assertTrue(status['status'] == 'ready', msg)
+            deleted = json.loads(self.tmcmd.delete([node, ]))
+            self.assertTrue('204' in deleted,
+                '204 was not returned after node delete: %s' % deleted)
+
 # =================================================================
 
     def node_status_fields(self, response):
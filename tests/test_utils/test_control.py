@@ -0,0 +1,98 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/control.py script against python-debian.
+"""
+from pdb import set_trace
+
+import gzip
+import io
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from debian.deb822 import Packages as debPackages
+
+import tmms.utils.control as Control
+
+CONTROL = b'''
+
+# comment before anything
+Package: vim
+Version: 2:8.0
+Depends: libc6 (>= 2.24), vim-common
+Description: Vi IMproved  
+ Vim is an almost compatible version of the UNIX editor Vi.
+# comment inside a value
+ .
+   
+\tMany new features have been added.  
+Section : editors
+
+# a stanza of only comments
+
+Task: L4TM_C_CPP
+Key:
+  gcc
+  make
+Relevance: 10 
+'''
+
+
+class ControlTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.expected = [ dict(p) for p in
+                         debPackages.iter_paragraphs(io.BytesIO(CONTROL)) ]
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_same_as_deb822(self):
+        """ bytes, str and files in small blocks all read alike. """
+        self.assertEqual(len(self.expected), 2)
+        self.assertEqual(list(Control.iter_paragraphs(CONTROL)), self.expected)
+        self.assertEqual(list(Control.iter_paragraphs(CONTROL.decode())),
+                         self.expected)
+        for block in (1, 7, 64, 1 << 20):
+            self.assertEqual(list(Control.iter_paragraphs(
+                io.BytesIO(CONTROL), block=block)), self.expected)
+        self.assertEqual(list(Control.iter_paragraphs(CONTROL, keys={ 'Key' })),
+                         [ { 'Key': '\n  gcc\n  make' } ])
+
+
+    def test_find(self):
+        """ One field of one stanza by offsets. """
+        spans = list(Control.stanzas(CONTROL))
+        self.assertEqual(len(spans), 3)
+        start, end = spans[0]
+        for key in ('Package', 'Description', 'Depends'):
+            bounds = Control.find(CONTROL, start, end, key.encode())
+            self.assertEqual(Control.value(CONTROL[bounds[0]:bounds[1]]),
+                             self.expected[0][key])
+        self.assertIsNone(Control.find(CONTROL, start, end, b'Task'))
+        self.assertIsNone(Control.find(CONTROL, *spans[1], key=b'Package'))
+
+
+    def test_benchmark(self):
+        """ Compressed indices are read, every parser agrees. """
+        path = self.tmp_folder + '/Packages.gz'
+        with gzip.open(path, 'wb') as f:
+            f.write(CONTROL * 10)
+        results = Control.benchmark(path, repeat=1)
+        self.assertEqual([ r['parser'] for r in results ],
+                         [ 'python-debian', 'control', 'control file' ])
+        for r in results:
+            self.assertEqual((r['paragraphs'], r['same']), (20, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,21 @@ class UtilsTest(unittest.TestCase):
         self.assertTrue(os.path.exists(uncompressed_dir + '/' + test_file_name))
 
 
+    def test_compress_by_suffix(self):
+        """ make_tar() compresses the way the file name says. """
+        import tmms.utils.extract as Extract
+        test_dir = '%s/to_compress' % self.tmp_folder
+        self.touch_folder(test_dir)
+        self.touch_file(test_dir + '/file')
+        for suffix, expected in (('', None), ('.gz', 'gzip'), ('.xz', 'xz'),
+                                 ('.zst', 'zstd')):
+            tarball = '%s/golden.arm64.tar%s' % (self.tmp_folder, suffix)
+            TmmsUtils.make_tar(tarball, test_dir)
+            self.assertEqual(Extract.compression(tarball), expected)
+            untarred = TmmsUtils.untar(self.tmp_folder + '/untar/', tarball)
+            self.assertTrue(os.path.exists(untarred + 'file'))
+
+
     def test_deb_components_valid(self):
         '''
             Validate sources.list url can be parsed properly by checking
@@ -0,0 +1,74 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/cpio.py script.
+"""
+from pdb import set_trace
+
+import io
+import os
+import stat
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.cpio as Cpio
+
+
+class CpioTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.tree = cls.tmp_folder + '/untar'
+        for d in ('boot/grub', 'etc', 'usr/bin', 'usr/share/boot'):
+            os.makedirs('%s/%s' % (cls.tree, d))
+        with open(cls.tree + '/usr/bin/vim', 'wb') as f:
+            f.write(b'\x7fELF' + b'x' * 4097)
+        os.link(cls.tree + '/usr/bin/vim', cls.tree + '/usr/bin/vi')
+        os.symlink('vim', cls.tree + '/usr/bin/editor')
+        for name in ('etc/hostname', 'vmlinuz', 'boot/grub/grub.cfg'):
+            with open('%s/%s' % (cls.tree, name), 'w') as f:
+                f.write(name + '\n')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_walk(self):
+        """ Parents come before children, ignored names are skipped. """
+        names = [ name for name, _, _ in Cpio.walk(
+            self.tree, ignore_files=['vmlinuz'], ignore_dirs=['boot']) ]
+        self.assertEqual(names, [ './etc', './usr', './etc/hostname',
+            './usr/bin', './usr/share', './usr/bin/editor', './usr/bin/vi',
+            './usr/bin/vim' ])
+
+
+    def test_roundtrip(self):
+        """ Hardlinks carry data once, symlinks carry their target. """
+        buf = io.BytesIO()
+        writer = Cpio.write_tree(self.tree, buf, ignore_files=['vmlinuz'],
+                                 ignore_dirs=['boot'])
+        self.assertEqual(len(buf.getvalue()) % 512, 0)
+        self.assertEqual(writer.nbytes, len(buf.getvalue()))
+
+        buf.seek(0)
+        entries = { e[0]: e[1:] for e in Cpio.iter_entries(buf) }
+        self.assertEqual(len(entries), writer.entries - 1)  # no trailer
+        self.assertEqual(entries['./etc/hostname'][3], b'etc/hostname\n')
+        self.assertTrue(stat.S_ISLNK(entries['./usr/bin/editor'][0]))
+        self.assertEqual(entries['./usr/bin/editor'][3], b'vim')
+        self.assertTrue(stat.S_ISDIR(entries['./usr'][0]))
+
+        vi, vim = entries['./usr/bin/vi'], entries['./usr/bin/vim']
+        self.assertEqual(vi[1], vim[1])             # same inode
+        self.assertEqual(vi[2], 2)
+        self.assertEqual(vi[3] + vim[3], b'\x7fELF' + b'x' * 4097)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/deb_cache.py script.
+"""
+from pdb import set_trace
+
+import gzip
+import hashlib
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.deb_cache as DebCache
+
+
+class DebCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.cache = cls.tmp_folder + '/debcache'
+        cls.chroot = cls.tmp_folder + '/untar'
+        cls.lists = cls.chroot + '/var/lib/apt/lists'
+        os.makedirs(cls.lists)
+
+        cls.debs = {
+            'vim': (b'v' * (3 << 19), '2:8.0.0197-4', 'arm64'),     # 1.5 MB
+            'bash': (b'b' * (3 << 19), '4.4-5', 'arm64'),
+        }
+        stanzas = []
+        for pkg, (content, version, arch) in cls.debs.items():
+            stanzas.append('\n'.join([
+                'Package: %s' % pkg,
+                'Version: %s' % version,
+                'Architecture: %s' % arch,
+                'Description: something',
+                ' long description',
+                'Size: %d' % len(content),
+                'SHA256: %s' % hashlib.sha256(content).hexdigest(),
+            ]))
+        with gzip.open(cls.lists + '/mirror_dists_stretch_main_binary-arm64_Packages.gz',
+                       'wt') as f:
+            f.write('\n\n'.join(stanzas) + '\n')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def download(self, build_id, pkg, content=None):
+        """ What install.sh does with a fresh download """
+        _, version, arch = self.debs[pkg]
+        if content is None:
+            content = self.debs[pkg][0]
+        incoming = self.cache + DebCache.incoming_dir(build_id)[
+            len(DebCache.CHROOT_PATH):]
+        os.makedirs(incoming, exist_ok=True)
+        name = DebCache.deb_name(pkg, version, arch)
+        with open(incoming + '/' + name, 'wb') as f:
+            f.write(content)
+        return name
+
+
+    def test_ingest_and_seed(self):
+        """ Only verified debs make it into the pool, then get seeded. """
+        with DebCache.in_use(self.cache):
+            vim = self.download(42, 'vim')
+            self.assertIn('%3a', vim)
+            self.download(42, 'bash', b'tampered')
+            self.assertEqual(DebCache.ingest(self.cache, 42, self.lists), (1, 1))
+            self.assertEqual(os.listdir(self.cache + '/pool'), [ vim ])
+
+            archives = self.chroot + '/var/cache/apt/archives'
+            self.assertEqual(DebCache.seed(self.cache, archives), 1)
+            self.assertEqual(os.readlink(archives + '/' + vim),
+                             DebCache.CHROOT_PATH + '/pool/' + vim)
+            DebCache.unseed(archives)
+            self.assertEqual(os.listdir(archives), [ ])
+
+            # Builds hold the cache, so no eviction
+            self.assertIsNone(DebCache.evict(self.cache, 0))
+
+
+    def test_evict_lru(self):
+        """ The most recently installed deb survives. """
+        with DebCache.in_use(self.cache):
+            names = [ self.download(1, pkg) for pkg in ('vim', 'bash') ]
+            DebCache.ingest(self.cache, 1, self.lists)
+        pool = self.cache + '/pool/'
+        os.utime(pool + names[0], (1000000000, 1000000000))
+        os.utime(pool + names[1], (1000000000, 1000000000))
+
+        status = self.tmp_folder + '/status'
+        with open(status, 'w') as f:
+            f.write('Package: vim\nStatus: install ok installed\n'
+                    'Architecture: arm64\nVersion: 2:8.0.0197-4\n\n')
+        DebCache.touch_installed(self.cache, status)
+
+        self.assertEqual(DebCache.evict(self.cache, 2), 1)
+        self.assertEqual(os.listdir(pool), [ names[0] ])
+
+
+if __name__ == '__main__':
+    unittest.main()
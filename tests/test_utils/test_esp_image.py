@@ -0,0 +1,88 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/esp_image.py script.
+"""
+from pdb import set_trace
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from shutil import rmtree
+
+import tmms.utils.esp_image as ESP
+
+
+class ESPImageTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.image = cls.tmp_folder + '/node01.ESP'
+        cls.vmlinuz = cls.tmp_folder + '/node01.vmlinuz.gz'
+        cls.kernel = os.urandom(3 << 20)
+        with open(cls.vmlinuz, 'wb') as f:
+            f.write(cls.kernel)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_layout(self):
+        """ Protective MBR, both GPT headers and a FAT32 ESP at 129 MiB. """
+        ESP.write_image(self.image, [ ('startup.nsh', b'x') ], name='node01')
+        self.assertEqual(os.path.getsize(self.image), 384 << 20)
+        with open(self.image, 'rb') as f:
+            lba = lambda n: (f.seek(n * 512), f.read(512))[1]
+            self.assertEqual(lba(0)[450], 0xEE)
+            total = (384 << 20) // 512
+            for header, my_lba in ((lba(1), 1), (lba(total - 1), total - 1)):
+                self.assertEqual(header[:8], b'EFI PART')
+                crc = struct.unpack_from('<I', header, 16)[0]
+                check = header[:16] + b'\0' * 4 + header[20:92]
+                self.assertEqual(zlib.crc32(check), crc)
+                self.assertEqual(struct.unpack_from('<Q', header, 24)[0], my_lba)
+            f.seek(1024)
+            entry = f.read(128)
+            self.assertEqual(entry[:16], ESP.ESP_TYPE.bytes_le)
+            self.assertEqual(struct.unpack_from('<Q', entry, 32)[0], 129 * 2048)
+            self.assertEqual(entry[56:68].decode('utf-16-le'), 'node01')
+            self.assertEqual(lba(129 * 2048)[82:90], b'FAT32   ')
+
+
+    def test_files(self):
+        """ Long names, nested directories and file data read back. """
+        files = [
+            ('startup.nsh', b'\\EFI\\debian\\grubaa64.efi\n'),
+            ('EFI/debian/node01.vmlinuz.gz', self.vmlinuz),
+            ('EFI/debian/0123abcd0123abcd0123abcd.cpio.gz', b'c' * 5000),
+            ('EFI/debian/grub.cfg', b'boot\n'),
+            ('EFI/debian/empty', b''),
+        ]
+        written = ESP.write_image(self.image, files, size_mb=256,
+                                  esp_offset_mb=1, name='node01')
+        self.assertEqual(written, len(self.kernel) + 5000 + 25 + 5)
+        for path, source in files:
+            if not isinstance(source, bytes):
+                with open(source, 'rb') as f:
+                    source = f.read()
+            self.assertEqual(ESP.read_file(self.image, path), source, path)
+        self.assertEqual(ESP.read_file(self.image, 'efi/DEBIAN/GRUB.CFG'), b'boot\n')
+        self.assertIsNone(ESP.read_file(self.image, 'EFI/debian/nope'))
+
+
+    def test_too_big(self):
+        """ Files that don't fit are an error, not a truncated image. """
+        files = [ ('big%d' % i, self.vmlinuz) for i in range(100) ]
+        self.assertRaises(RuntimeError, ESP.write_image, self.image, files)
+        self.assertEqual(os.listdir(self.tmp_folder), [ 'node01.vmlinuz.gz' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
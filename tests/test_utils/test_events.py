@@ -0,0 +1,56 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/events.py script.
+"""
+from pdb import set_trace
+
+import threading
+import time
+import unittest
+
+import tmms.utils.events as Events
+
+
+class EventsTest(unittest.TestCase):
+
+    def test_since(self):
+        """ Resume from a seq, filter, and reset when it's too old. """
+        log = Events.EventLog(maxlen=3, first_seq=100)
+        self.assertEqual(log.since(None), (100, None))
+        self.assertEqual(log.since(100), (100, []))
+        for node in ('a', 'b', 'a'):
+            log.append({ 'node': node })
+        seq, events = log.since(100)
+        self.assertEqual(seq, 103)
+        self.assertEqual([ (e['seq'], e['node']) for e in events ],
+                         [ (101, 'a'), (102, 'b'), (103, 'a') ])
+        seq, events = log.since(101, match=lambda e: e['node'] == 'a')
+        self.assertEqual([ e['seq'] for e in events ], [ 103 ])
+
+        log.append({ 'node': 'c' })      # 101 falls out
+        self.assertEqual(log.since(100), (104, None))
+        self.assertEqual(len(log.since(101)[1]), 3)
+        self.assertEqual(log.since(105), (104, None))
+
+
+    def test_wait(self):
+        """ A long poll returns as soon as a matching event arrives. """
+        log = Events.EventLog()
+        seq = log.seq
+        timer = threading.Timer(0.2, log.append, [{ 'node': 'b' }])
+        timer.start()
+        threading.Timer(0.4, log.append, [{ 'node': 'a' }]).start()
+        start = time.time()
+        last, events = log.since(seq, timeout=10,
+                                 match=lambda e: e['node'] == 'a')
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([ e['node'] for e in events ], [ 'a' ])
+        self.assertEqual(last, seq + 2)
+
+        start = time.time()
+        self.assertEqual(log.since(last, timeout=0.2), (last, []))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
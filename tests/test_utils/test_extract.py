@@ -0,0 +1,117 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/extract.py script.
+"""
+from pdb import set_trace
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.core_utils as TmmsUtils
+import tmms.utils.extract as Extract
+
+
+class ExtractTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.src = cls.tmp_folder + '/src'
+        os.makedirs(cls.src + '/etc/ro_dir')
+        os.makedirs(cls.src + '/usr/bin')
+        with open(cls.src + '/etc/hostname', 'w') as f:
+            f.write('golden\n')
+        with open(cls.src + '/usr/bin/big', 'wb') as f:
+            f.write(os.urandom(3 << 20))        # Above the inline threshold
+        os.chmod(cls.src + '/usr/bin/big', 0o4755)
+        os.link(cls.src + '/etc/hostname', cls.src + '/etc/hostname.hard')
+        os.symlink('hostname', cls.src + '/etc/hostname.sym')
+        os.symlink('/nonexistent', cls.src + '/etc/broken.sym')
+        os.utime(cls.src + '/etc/ro_dir', (1000000000, 1000000000))
+        os.chmod(cls.src + '/etc/ro_dir', 0o555)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            for root, dirs, files in os.walk(cls.tmp_folder):
+                for d in dirs:
+                    os.chmod(os.path.join(root, d), 0o755)
+            rmtree(cls.tmp_folder)
+
+
+    def make_tar(self, mode, suffix):
+        tarball = '%s/golden.arm64.tar%s' % (self.tmp_folder, suffix)
+        with tarfile.open(tarball, mode) as tar:
+            tar.add(self.src, arcname='.')
+        return tarball
+
+
+    def check_tree(self, dest):
+        with open(dest + '/etc/hostname') as f:
+            self.assertEqual(f.read(), 'golden\n')
+        with open(dest + '/usr/bin/big', 'rb') as f1, \
+             open(self.src + '/usr/bin/big', 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read(), 'Large file mangled')
+        self.assertEqual(os.stat(dest + '/usr/bin/big').st_mode & 0o7777, 0o4755)
+        self.assertEqual(os.stat(dest + '/etc/hostname').st_ino,
+                         os.stat(dest + '/etc/hostname.hard').st_ino)
+        self.assertEqual(os.readlink(dest + '/etc/hostname.sym'), 'hostname')
+        self.assertEqual(os.readlink(dest + '/etc/broken.sym'), '/nonexistent')
+        ro_dir = os.stat(dest + '/etc/ro_dir')
+        self.assertEqual(ro_dir.st_mode & 0o777, 0o555)
+        self.assertEqual(int(ro_dir.st_mtime), 1000000000)
+
+
+    def test_compression_formats(self):
+        """ Plain, gzip and xz tarballs extract to identical trees. """
+        for mode, suffix, name in (('w', '', None),
+                                   ('w:gz', '.gz', 'gzip'),
+                                   ('w:xz', '.xz', 'xz')):
+            tarball = self.make_tar(mode, suffix)
+            self.assertEqual(Extract.compression(tarball), name)
+            dest = '%s/dest%s' % (self.tmp_folder, suffix)
+            self.assertEqual(TmmsUtils.untar(dest, tarball), dest)
+            self.check_tree(dest)
+
+
+    @unittest.skipIf(shutil.which('zstd') is None, 'zstd is not installed')
+    def test_zstd(self):
+        """ zstd goes through the external program. """
+        tarball = self.make_tar('w', '')
+        subprocess.check_call(['zstd', '-qf', tarball])
+        tarball += '.zst'
+        self.assertEqual(Extract.compression(tarball), 'zstd')
+        TmmsUtils.untar(self.tmp_folder + '/dest', tarball)
+        self.check_tree(self.tmp_folder + '/dest')
+
+
+    def test_overwrite_and_progress(self):
+        """ Existing trees are replaced; progress sees every byte. """
+        tarball = self.make_tar('w', '')
+        dest = self.tmp_folder + '/dest'
+        os.makedirs(dest + '/etc/hostname')       # a dir where a file goes
+        calls = []
+        TmmsUtils.untar(dest, tarball, lambda n, s: calls.append(n))
+        self.check_tree(dest)
+        self.assertEqual(calls[-1], (3 << 20) + len('golden\n'))
+
+
+    def test_bad_tarball(self):
+        """ Garbage in raises RuntimeError like it always did. """
+        bad = self.tmp_folder + '/bad.tar'
+        with open(bad, 'wb') as f:
+            f.write(b'not a tarball' * 100)
+        with self.assertRaises(RuntimeError):
+            TmmsUtils.untar(self.tmp_folder + '/dest', bad)
+
+
+if __name__ == '__main__':
+    unittest.main()
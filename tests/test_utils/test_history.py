@@ -0,0 +1,141 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/history.py script.
+"""
+from pdb import set_trace
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from shutil import rmtree
+
+import tmms.utils.history as History
+import tmms.utils.status_cache as StatusCache
+
+
+class HistoryTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.path = cls.tmp_folder + '/history.sqlite'
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def status(self, status, stage, when, job_id=None):
+        '''What customize_node.update_status() writes.'''
+        result = { 'status': status, 'stage': stage, 'manifest': 'mani/fest',
+                   'message': stage, 'hostname': 'node01', 'updated': when }
+        if job_id is not None:
+            result['job_id'] = job_id
+        return result
+
+
+    def test_bindings(self):
+        """ Bind, transitions, finish, rebind and unbind. """
+        db = History.open_history(self.path)
+        self.assertTrue(db.created)
+        self.assertIs(db, History.open_history(self.path))
+        db.bind('/node/1', 'node01', 'mani/fest', when=100.0)
+        self.assertEqual(db.bindings()['/node/1']['status'], 'building')
+        db.transition('/node/1', self.status('building', 'provision', 101.0, 'j1'))
+        db.transition('/node/1', self.status('ready', 'ready', 160.0))
+        db.finish('/node/1', 'ready', 'done', started=110.0,
+                  artifact_bytes=1234, when=160.0)
+        self.assertEqual(db.statuses()['node01']['status'], 'ready')
+
+        db.bind('/node/1', 'node01', 'mani/fest', when=200.0)
+        db.unbind('/node/1', when=210.0)
+        self.assertEqual(db.bindings(), {})
+        latest, first = db.builds(node='/node/1')
+        self.assertEqual(latest['result'], 'cancelled')
+        self.assertEqual((first['result'], first['duration'], first['job_id'],
+                          first['artifact_bytes']), ('ready', 50.0, 'j1', 1234))
+        self.assertEqual([ t['stage'] for t in db.transitions(first['id']) ],
+                         [ 'provision', 'ready' ])
+
+        # Other threads get their own connection to the same data
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(
+            History.open_history(self.path).builds(limit=1)[0]['id']))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [ latest['id'] ])
+        self.assertFalse(History.History(self.path).created)
+
+
+    def test_after_fork(self):
+        """ A forked child connects afresh and leaves the parent's alone. """
+        db = History.open_history(self.path)
+        db.bind('/node/1', 'node01', 'mani/fest', when=100.0)
+        release = threading.Event()
+        other = threading.Thread(target=lambda: History.open_history(
+            self.path).bindings() and release.wait())
+        other.start()       # another thread's connection is inherited too
+        pid = os.fork()
+        if pid == 0:
+            try:
+                History.after_fork()
+                os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+                child = History.open_history(self.path)
+                child.bind('/node/2', 'node02', 'mani/fest', when=101.0)
+                os._exit(0 if child is not db else 1)
+            except BaseException:
+                os._exit(2)
+        release.set()
+        other.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(sorted(db.bindings()), [ '/node/1', '/node/2' ])
+        db.bind('/node/3', 'node03', 'mani/fest', when=102.0)
+        self.assertEqual(len(db.bindings()), 3)
+
+
+    def test_stats(self):
+        """ Nearest-rank percentiles of one manifest over a time window. """
+        db = History.open_history(self.path)
+        now = time.time()
+        for i in range(1, 21):      # durations 10..200
+            node = '/node/%d' % i
+            db.bind(node, 'node%02d' % i, 'mani/fest', when=now - 300)
+            db.finish(node, 'ready', started=now - 10 * i - 1, when=now - 1)
+        db.bind('/node/99', 'node99', 'mani/fest', when=now - 300)
+        db.finish('/node/99', 'error', started=now - 5000, when=now - 1)
+        db.bind('/node/98', 'node98', 'other', when=now - 30 * 86400)
+        db.finish('/node/98', 'ready', started=now - 30 * 86400,
+                  when=now - 29 * 86400)
+
+        stats = db.stats(manifest='mani/fest', since=now - 7 * 86400)
+        self.assertEqual(stats['count'], 20)
+        self.assertAlmostEqual(stats['p50'], 100.0)
+        self.assertAlmostEqual(stats['p95'], 190.0)
+        self.assertAlmostEqual(stats['max'], 200.0)
+        self.assertEqual(db.stats(since=now - 7 * 86400)['count'], 20)
+        self.assertEqual(db.stats(result='error')['count'], 1)
+        self.assertIsNone(db.stats(manifest='none')['p95'])
+
+
+    def test_seed_status_cache(self):
+        """ The status cache starts from the store without reading files. """
+        db = History.open_history(self.path)
+        db.bind('/node/1', 'node01', 'mani/fest')
+        db.transition('/node/1', self.status('ready', 'ready', time.time()))
+        images = self.tmp_folder + '/images'
+        os.makedirs(images + '/node01')     # no status.json (yet)
+        cache = StatusCache.StatusCache(images, use_inotify=False,
+                                        initial=db.statuses())
+        self.assertEqual(cache.get('node01')['status'], 'ready')
+        cache.rescan()                      # which does check them
+        self.assertIsNone(cache.get('node01'))
+
+
+if __name__ == '__main__':
+    unittest.main()
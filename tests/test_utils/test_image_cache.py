@@ -0,0 +1,146 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/image_cache.py script.
+"""
+from pdb import set_trace
+
+import argparse
+import functools
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from shutil import rmtree
+
+import tmms.utils.core_utils as TmmsUtils
+import tmms.utils.image_cache as ImageCache
+import tmms.utils.rootfs as Rootfs
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        golden_src = cls.tmp_folder + '/golden_src'
+        os.makedirs(golden_src + '/etc')
+        with open(golden_src + '/etc/hostname', 'w') as f:
+            f.write('golden\n')
+        os.makedirs(cls.tmp_folder + '/golden')
+        cls.golden_tar = cls.tmp_folder + '/golden/golden.arm64.tar'
+        TmmsUtils.make_tar(cls.golden_tar, golden_src)
+        cls.builds = []
+
+
+    @classmethod
+    def tearDown(cls):
+        for entry in os.listdir(cls.tmp_folder):
+            Rootfs.release('%s/%s' % (cls.tmp_folder, entry))
+        cache = cls.tmp_folder + '/_cache'
+        if os.path.isdir(cache):
+            for entry in os.listdir(cache):
+                Rootfs.release('%s/%s' % (cache, entry))
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def make_args(self, hostname, packages='vim', backend='auto'):
+        build_dir = '%s/%s' % (self.tmp_folder, hostname)
+        os.makedirs(build_dir, exist_ok=True)
+        return argparse.Namespace(build_dir=build_dir, hostname=hostname,
+            golden_tar=self.golden_tar, rootfs_backend=backend,
+            is_golden=False, logger=None, packages=packages, tasks=None,
+            postinst=None, tmconfig=None, other_mirrors=None,
+            repo_mirror='http://127.0.0.1:9/debian', repo_release='stretch',
+            repo_areas=('main', ),
+            image_cache=self.tmp_folder + '/_cache', image_cache_mb=100)
+
+
+    def build(self, shared):
+        """ Stand-in for customize_node.customize_shared() """
+        self.builds.append(shared.packages)
+        with open(shared.new_fs_dir + 'etc/installed', 'w') as f:
+            f.write(shared.packages)
+        with open(shared.build_dir + '/vmlinuz-4.14', 'w') as f:
+            f.write('kernel')
+
+
+    def test_shared_build_once(self):
+        """ Nodes with the same inputs share one build, whatever backend. """
+        trees = []
+        for hostname, backend in (('node01', 'untar'), ('node02', 'auto'),
+                                  ('node03', 'auto')):
+            args = self.make_args(hostname, backend=backend)
+            self.assertTrue(ImageCache.enabled(args))
+            trees.append(ImageCache.provision(args, self.build))
+            self.assertEqual(args.image_cache_hit, hostname != 'node01')
+            self.assertTrue(os.path.isfile(args.vmlinuz_golden))
+            with open(trees[-1] + 'etc/hostname', 'w') as f:
+                f.write(hostname)
+        self.assertEqual(self.builds, ['vim'])
+
+        for hostname, tree in zip(('node01', 'node02', 'node03'), trees):
+            with open(tree + 'etc/installed') as f:
+                self.assertEqual(f.read(), 'vim')
+            with open(tree + 'etc/hostname') as f:
+                self.assertEqual(f.read(), hostname, 'Clones are not private')
+
+
+    def test_key_and_eviction(self):
+        """ New inputs make a new entry; old ones go over budget. """
+        for packages in ('vim', 'emacs'):
+            args = self.make_args('node_' + packages, packages=packages)
+            ImageCache.provision(args, self.build)
+            self.assertFalse(args.image_cache_hit)
+            Rootfs.release(args.build_dir)
+        self.assertEqual(self.builds, ['vim', 'emacs'])
+
+        cache = self.tmp_folder + '/_cache'
+        removed = ImageCache.evict(cache, 0, keep=cache + '/' + args.image_cache_key)
+        self.assertEqual(len(removed), 1)
+        self.assertNotEqual(removed[0], args.image_cache_key)
+        self.assertTrue(os.path.isdir(cache + '/' + args.image_cache_key))
+
+
+
+    def test_index_snapshot(self):
+        """ An unreachable mirror keeps its last known state in the key. """
+        mirror = self.tmp_folder + '/mirror'
+        os.makedirs(mirror + '/debian/dists/stretch')
+        with open(mirror + '/debian/dists/stretch/InRelease', 'w') as f:
+            f.write('Suite: stretch\n')
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler,
+                                    directory=mirror)
+        handler.log_message = lambda *args: None
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        args = self.make_args('node01')
+        args.repo_mirror = 'http://127.0.0.1:%d/debian' % server.server_address[1]
+        os.makedirs(args.image_cache)
+        try:
+            first = ImageCache.index_snapshot(args)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertEqual(len(first), 1)
+        self.assertIn('/dists/stretch/InRelease', first[0])
+        self.assertEqual(ImageCache.index_snapshot(args), first)   # cached
+
+        ttl = ImageCache.SNAPSHOT_TTL
+        ImageCache.SNAPSHOT_TTL = 0         # now it has to ask, and can't
+        try:
+            self.assertEqual(ImageCache.index_snapshot(args), first)
+        finally:
+            ImageCache.SNAPSHOT_TTL = ttl
+        os.unlink(args.image_cache + '/indices.json')
+        self.assertEqual(ImageCache.index_snapshot(args), [ ])
+
+
+if __name__ == '__main__':
+    unittest.main()
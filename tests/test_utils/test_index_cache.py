@@ -0,0 +1,145 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/index_cache.py script against a local HTTP "mirror".
+"""
+from pdb import set_trace
+
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from shutil import rmtree
+
+import tmms.utils.index_cache as IndexCache
+
+PACKAGES = b'Package: vim\nVersion: 2:8.0\n\nPackage: libc6\nVersion: 2.24\n'
+
+
+class LoggingHandler(http.server.SimpleHTTPRequestHandler):
+    '''Answers If-Modified-Since with 304; remembers what was asked.'''
+
+    def log_request(self, code='-', size='-'):
+        self.server.log.append((self.path.split('/dists/')[-1], int(code)))
+
+    def log_message(self, *args):
+        pass
+
+
+class IndexCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.mirror = cls.tmp_folder + '/mirror'
+        cls.cache = cls.tmp_folder + '/indexcache'
+        dists = cls.mirror + '/dists/stretch'
+        os.makedirs(dists + '/main/binary-arm64')
+        with gzip.open(dists + '/main/binary-arm64/Packages.gz', 'wb') as f:
+            f.write(PACKAGES)
+        with open(dists + '/InRelease', 'w') as f:
+            f.write('-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n'
+                    'Origin: Debian\nSuite: stretch\nMD5Sum:\n'
+                    ' 0123 99 main/binary-arm64/Packages\nSHA256:\n'
+                    ' %s %d main/binary-arm64/Packages\n'
+                    ' abcd 10 main/binary-all/Packages\n'
+                    '-----BEGIN PGP SIGNATURE-----\n\n xyz\n' % (
+                        hashlib.sha256(PACKAGES).hexdigest(), len(PACKAGES)))
+
+        handler = functools.partial(LoggingHandler, directory=cls.mirror)
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        cls.server.log = []
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+
+    @classmethod
+    def tearDown(cls):
+        if cls.thread.is_alive():
+            cls.server.shutdown()
+            cls.thread.join()
+        cls.server.server_close()
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_parse_release(self):
+        with open(self.mirror + '/dists/stretch/InRelease') as f:
+            listed = IndexCache.parse_release(f.read())
+        self.assertEqual(sorted(listed), [ 'main/binary-all/Packages',
+                                           'main/binary-arm64/Packages' ])
+        self.assertEqual(listed['main/binary-all/Packages'], ('abcd', 10))
+
+
+    def test_restart(self):
+        """ A second load only revalidates InRelease. """
+        indices = IndexCache.IndexCache(self.cache)
+        self.assertEqual(indices.packages(self.url, 'stretch', 'main',
+                                          'binary-arm64'), PACKAGES)
+        self.assertIsNone(indices.packages(self.url, 'stretch', 'main',
+                                           'binary-all'))
+        self.assertEqual(indices.stats['downloaded'], 2)
+        self.assertEqual(os.path.basename(indices.packages_path(
+            self.url, 'stretch', 'main', 'binary-arm64')),
+            hashlib.sha256(PACKAGES).hexdigest())
+        self.server.log[:] = []
+
+        indices = IndexCache.IndexCache(self.cache)
+        self.assertEqual(indices.packages(self.url, 'stretch', 'main',
+                                          'binary-arm64'), PACKAGES)
+        self.assertEqual(self.server.log, [ ('stretch/InRelease', 304) ])
+        self.assertEqual((indices.stats['cached'],
+                          indices.stats['not_modified']), (1, 1))
+
+
+    def test_concurrent(self):
+        """ Many threads, one InRelease fetch, one Packages download. """
+        indices = IndexCache.IndexCache(self.cache,
+                                        session=IndexCache.session(8))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda arch: indices.packages(
+                self.url, 'stretch', 'main', arch), [ 'binary-arm64' ] * 8))
+        self.assertEqual(results, [ PACKAGES ] * 8)
+        self.assertEqual(
+            [ path for path, code in self.server.log ].count('stretch/InRelease'), 1)
+        self.assertEqual(sum(indices.stats.values()), 9)
+
+
+    def test_no_release(self):
+        """ Without (In)Release the Packages.gz itself is revalidated. """
+        os.unlink(self.mirror + '/dists/stretch/InRelease')
+        for i in range(2):
+            indices = IndexCache.IndexCache(self.cache)
+            self.assertEqual(indices.packages(self.url, 'stretch', 'main',
+                                              'binary-arm64'), PACKAGES)
+        self.assertEqual(self.server.log[-1],
+                         ('stretch/main/binary-arm64/Packages.gz', 304))
+
+
+    def test_offline_and_prune(self):
+        """ An unreachable mirror gets the last copy; prune drops the rest. """
+        indices = IndexCache.IndexCache(self.cache)
+        indices.packages(self.url, 'stretch', 'main', 'binary-arm64')
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        with open(self.cache + '/by-hash/leftover', 'w') as f:
+            f.write('old')
+        indices = IndexCache.IndexCache(self.cache)
+        self.assertEqual(indices.packages(self.url, 'stretch', 'main',
+                                          'binary-arm64'), PACKAGES)
+        self.assertEqual(indices.stats['stale'], 1)
+        self.assertEqual(indices.prune(), 1)
+        self.assertEqual(len(os.listdir(self.cache + '/by-hash')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
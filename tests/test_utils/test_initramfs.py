@@ -0,0 +1,99 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/initramfs.py script.
+"""
+from pdb import set_trace
+
+import gzip
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.initramfs as Initramfs
+
+
+class InitramfsTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.tree = cls.tmp_folder + '/untar'
+        os.makedirs(cls.tree + '/etc')
+        os.makedirs(cls.tree + '/boot')
+        with open(cls.tree + '/etc/services', 'wb') as f:
+            f.write(b'ssh\t22/tcp\n' * 5000)
+        cls.data = os.urandom(1000) * 300
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_names(self):
+        """ Default is gzip, unknown codecs are refused. """
+        self.assertEqual(Initramfs.filename('node01', None), 'node01.cpio.gz')
+        self.assertEqual(Initramfs.filename('node01', 'ZSTD'), 'node01.cpio.zst')
+        self.assertRaises(RuntimeError, Initramfs.validate, 'bzip2')
+
+
+    def test_writer(self):
+        """ Every available codec writes something its decompressor reads. """
+        readers = {
+            'gzip': gzip.decompress,
+            'xz': lambda d: lzma.decompress(d, format=lzma.FORMAT_XZ),
+            'zstd': lambda d: subprocess.run(['zstd', '-dc'], input=d,
+                                             stdout=subprocess.PIPE).stdout,
+            'lz4': lambda d: subprocess.run(['lz4', '-dc'], input=d,
+                                            stdout=subprocess.PIPE).stdout,
+        }
+        for codec, ext in Initramfs.CODECS.items():
+            if codec in ('zstd', 'lz4') and not shutil.which(codec):
+                continue
+            dest = '%s/x.cpio.%s' % (self.tmp_folder, ext)
+            with open(dest, 'wb') as raw:
+                with Initramfs.writer(codec, raw, threads=2) as f:
+                    f.write(self.data)
+            with open(dest, 'rb') as f:
+                compressed = f.read()
+            self.assertEqual(readers[codec](compressed), self.data, codec)
+            if codec == 'xz':   # the kernel only does CRC32
+                self.assertEqual(compressed[7], lzma.CHECK_CRC32)
+
+
+    def test_changes(self):
+        """ New files bring their directories along, removals are reported. """
+        before = Initramfs.snapshot(self.tree, ignore_dirs=['boot'])
+        os.makedirs(self.tree + '/home/l4mdc/.ssh')
+        with open(self.tree + '/home/l4mdc/.ssh/id_rsa', 'w') as f:
+            f.write('key')
+        entries, gone = Initramfs.changes(self.tree, before, ignore_dirs=['boot'])
+        self.assertEqual([ e[0] for e in entries ], [ './home', './home/l4mdc',
+            './home/l4mdc/.ssh', './home/l4mdc/.ssh/id_rsa' ])
+        self.assertEqual(gone, [ ])
+
+        os.unlink(self.tree + '/etc/services')
+        entries, gone = Initramfs.changes(self.tree, before, ignore_dirs=['boot'])
+        self.assertEqual(gone, [ './etc/services' ])
+
+
+    def test_benchmark(self):
+        """ A directory sample is archived first, each codec reports. """
+        results = Initramfs.benchmark(self.tree, [ 'gzip', 'xz' ],
+                                      tmpdir=self.tmp_folder)
+        self.assertEqual([ r['codec'] for r in results ], [ 'gzip', 'xz' ])
+        for r in results:
+            self.assertLess(r['ratio'], 0.1)
+            self.assertGreaterEqual(r['decompress'], 0.0)
+        self.assertEqual(sorted(os.listdir(self.tmp_folder)), [ 'untar' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -143,6 +143,26 @@ class UtilsLoggerTest(unittest.TestCase):
         isInLog = self.isEntryInLog(msg, level)
         self.assertTrue(isInLog, 'Parent\'s %s is not in log.' % level)
 
+    def test_after_fork(self):
+        """ A forked child's records reach the log, not a reused fd. """
+        msg = 'I am a forked child'
+        other = '/tmp/unittest_logging.other'
+        self.logger('before the fork')
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logging.tmmsLogger.after_fork()
+                os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+                with open(other, 'w') as f:     # takes the lowest free fd
+                    self.logger(msg)
+                os._exit(0)
+            except BaseException:
+                os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(self.isEntryInLog(msg, 'INFO'))
+        self.assertFalse(self.isEntryInLog(msg, logfile=other))
+        os.remove(other)
+
     def test_shutdown(self):
         self.logger.shutdown()
         threwRuntimeError = False
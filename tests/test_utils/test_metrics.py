@@ -0,0 +1,98 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/metrics.py script.
+"""
+from pdb import set_trace
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.metrics as Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.journal = cls.tmp_folder + '/metrics/builds.jsonl'
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_stages(self):
+        """ Stages count child CPU and I/O, the build its peak child RSS. """
+        stages = Metrics.Stages()
+        with stages.stage('compress'):
+            subprocess.run([ sys.executable, '-c',
+                'x = bytearray(64 << 20); open("%s/out", "wb").write(x)' %
+                self.tmp_folder ], check=True)
+        with stages.stage('grub'):
+            with stages.stage('menu'):
+                self.assertEqual(stages.current, 'menu')
+            self.assertEqual(stages.current, 'grub')
+        with stages.stage('grub'):
+            pass
+        self.assertIsNone(stages.current)
+        build = stages.todict(hostname='node01', result='ready')
+        compress = build['stages']['compress']
+        self.assertGreater(compress['cpu_seconds'], 0)
+        self.assertGreaterEqual(compress['write_bytes'], 64 << 20)
+        self.assertNotIn('child_max_rss_bytes', compress)
+        self.assertGreaterEqual(build['child_max_rss_bytes'], 64 << 20)
+        self.assertNotIn('child_max_rss_bytes',
+                         Metrics.Stages(own_process=False).todict())
+        self.assertEqual(list(build['stages']), [ 'compress', 'menu', 'grub' ])
+
+        per_build = self.tmp_folder + '/metrics.json'
+        Metrics.record(build, per_build=per_build, journal=self.journal)
+        Metrics.record(build, per_build=per_build, journal=self.journal)
+        with open(per_build) as f:
+            self.assertEqual(json.load(f)['hostname'], 'node01')
+        with open(self.journal) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+    def test_prometheus(self):
+        """ Histograms are cumulative, the journal is read incrementally. """
+        build = { 'result': 'ready', 'seconds': 42.0,
+                  'child_max_rss_bytes': 4096, 'stages': {
+            'provision': { 'seconds': 20.0, 'cpu_seconds': 3.5,
+                           'read_bytes': 100, 'write_bytes': 200 } } }
+        Metrics.record(build, journal=self.journal)
+        Metrics.record(dict(build, result='error', seconds=4000),
+                       journal=self.journal)
+        agg = Metrics.Aggregate(self.journal)
+        text = agg.prometheus()
+        self.assertIn('tmms_builds_total{result="ready"} 1\n', text)
+        self.assertIn('tmms_builds_total{result="error"} 1\n', text)
+        self.assertIn('tmms_build_seconds_bucket{le="30"} 0\n', text)
+        self.assertIn('tmms_build_seconds_bucket{le="60"} 1\n', text)
+        self.assertIn('tmms_build_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('tmms_build_seconds_count 2\n', text)
+        self.assertIn(
+            'tmms_build_stage_seconds_bucket{stage="provision",le="30"} 2\n', text)
+        self.assertIn(
+            'tmms_build_stage_cpu_seconds_total{stage="provision"} 7.000\n', text)
+        self.assertIn('tmms_build_child_max_rss_bytes 4096\n', text)
+        self.assertNotIn('stage_child_max_rss', text)
+
+        with open(self.journal, 'a') as f:     # half-written line waits
+            f.write(json.dumps(dict(build, kind='esp'))[:20])
+        agg.update()
+        self.assertEqual(sum(agg.builds.values()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/package_catalog.py script against python-debian.
+"""
+from pdb import set_trace
+
+import io
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from debian.deb822 import Packages as debPackages
+
+import tmms.utils.package_catalog as PackageCatalog
+
+MAIN = b'''Package: vim
+Version: 2:8.0
+Depends: libc6 (>= 2.24), vim-common
+Description: Vi IMproved  
+ Vim is an almost compatible version of the UNIX editor Vi.
+ .
+   
+\tMany new features have been added.  
+
+Package: libc6
+Version: 2.24
+Provides: libc
+'''
+
+OTHER = b'''
+
+Package: vim
+Version: 2:8.1
+Pre-Depends:
+ dpkg
+Description: newer
+'''
+
+
+class PackageCatalogTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        for name, content in (('main', MAIN), ('other', OTHER), ('empty', b'')):
+            with open('%s/%s' % (cls.tmp_folder, name), 'wb') as f:
+                f.write(content)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_same_as_deb822(self):
+        """ Fields and paragraphs read like python-debian reads them. """
+        catalog = PackageCatalog.Catalog()
+        self.assertEqual(catalog.add(PackageCatalog.Index(
+            self.tmp_folder + '/main', 'http://main')), 2)
+        for pkg in debPackages.iter_paragraphs(io.BytesIO(MAIN)):
+            name = pkg['Package']
+            self.assertEqual(dict(catalog[name]), dict(pkg))
+            for key in pkg:
+                self.assertEqual(catalog.field(name, key), pkg[key])
+        self.assertEqual(catalog.version('vim'), '2:8.0')
+        self.assertEqual(catalog.fields('libc6', ('Provides', 'Depends')),
+                         { 'Provides': 'libc' })
+        self.assertIsNone(catalog.get('emacs'))
+
+
+    def test_override(self):
+        """ Later indices win; empty ones are fine. """
+        catalog = PackageCatalog.Catalog()
+        for name in ('main', 'empty', 'other'):
+            catalog.add(PackageCatalog.Index(
+                '%s/%s' % (self.tmp_folder, name), 'http://' + name))
+        self.assertEqual(sorted(catalog.keys()), [ 'libc6', 'vim' ])
+        self.assertEqual((catalog.version('vim'), catalog.origin('vim')),
+                         ('2:8.1', 'http://other'))
+        self.assertEqual(catalog.origin('libc6'), 'http://main')
+        self.assertEqual(catalog.field('vim', 'Pre-Depends'), '\n dpkg')
+        self.assertIsNone(catalog.field('vim', 'Depends'))
+
+        # The mapping outlives the file, as after IndexCache.prune()
+        os.unlink(self.tmp_folder + '/other')
+        self.assertEqual(catalog['vim']['Description'], 'newer')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/package_search.py script.
+"""
+from pdb import set_trace
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.package_catalog as PackageCatalog
+import tmms.utils.package_search as PackageSearch
+
+PACKAGES = b'''Package: vim
+Version: 2:8.0
+Section: editors
+Priority: optional
+Architecture: arm64
+Description: Vi IMproved - enhanced vi editor
+ Vim is an almost compatible version of the UNIX editor Vi.
+
+Package: neovim
+Version: 0.1.7
+Section: editors
+Priority: extra
+Architecture: arm64
+Description: heavily refactored vim fork
+
+Package: nano
+Version: 2.7
+Section: editors
+Priority: important
+Architecture: arm64
+Description: small, friendly text editor
+
+Package: libzstd1
+Version: 1.1.2
+Section: libs
+Priority: optional
+Architecture: arm64
+Description: fast lossless compression algorithm
+
+Package: python3-zstd
+Version: 1.1.2
+Section: python
+Priority: optional
+Architecture: arm64
+Description: Python bindings to the zstd compression library
+
+Package: vim-doc
+Version: 2:8.0
+Section: doc
+Priority: optional
+Architecture: all
+Description: Vi IMproved - HTML documentation
+'''
+
+
+class PackageSearchTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        with open(cls.tmp_folder + '/Packages', 'wb') as f:
+            f.write(PACKAGES)
+        catalog = PackageCatalog.Catalog()
+        catalog.add(PackageCatalog.Index(cls.tmp_folder + '/Packages', 'http://m'))
+        cls.index = PackageSearch.SearchIndex(catalog)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_query(self):
+        """ Name substrings and description words; name matches first. """
+        search = self.index.search
+        self.assertEqual(search('vim'), (3, [ 'neovim', 'vim', 'vim-doc' ]))
+        self.assertEqual(search('VIM doc'), (1, [ 'vim-doc' ]))
+        self.assertEqual(search('zstd'), (2, [ 'libzstd1', 'python3-zstd' ]))
+        # "compress" starts a description word, "ython" is inside a name
+        self.assertEqual(search('compress'), (2, [ 'libzstd1', 'python3-zstd' ]))
+        self.assertEqual(search('ython'), (1, [ 'python3-zstd' ]))
+        # "editor" is in no name; "refactored" only in neovim's description
+        self.assertEqual(search('editor')[1], [ 'nano', 'vim' ])
+        self.assertEqual(search('refactored vi')[1], [ 'neovim' ])
+        self.assertEqual(search('emacs'), (0, [ ]))
+
+
+    def test_prefix_filters_pages(self):
+        """ Prefix and field filters combine with terms; paging. """
+        search = self.index.search
+        self.assertEqual(search(prefix='vi'), (2, [ 'vim', 'vim-doc' ]))
+        self.assertEqual(search(prefix='v', filters={ 'Architecture': 'all' }),
+                         (1, [ 'vim-doc' ]))
+        self.assertEqual(search('vi', filters={ 'Section': 'editors',
+                                                'Priority': 'optional' }),
+                         (1, [ 'vim' ]))
+        self.assertEqual(search(filters={ 'Section': 'games' }), (0, [ ]))
+        self.assertEqual(self.index.values('Priority'),
+                         [ 'extra', 'important', 'optional' ])
+        self.assertRaises(ValueError, search, filters={ 'Maintainer': 'me' })
+
+        self.assertEqual(search(offset=2, limit=2),
+                         (6, [ 'neovim', 'python3-zstd' ]))
+        self.assertEqual(search('zstd', offset=1, limit=5),
+                         (2, [ 'python3-zstd' ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
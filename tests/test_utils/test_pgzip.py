@@ -0,0 +1,68 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/pgzip.py script.
+"""
+from pdb import set_trace
+
+import gzip
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.pgzip as PGzip
+
+
+class PGzipTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        # Compressible but not trivially so, and not a multiple of a block
+        cls.data = b''.join(b'%08d some text %s\n' % (i, os.urandom(4).hex().encode())
+                            for i in range(40000))
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def compress(self, data, threads, blocksize=PGzip.BLOCKSIZE):
+        buf = io.BytesIO()
+        with PGzip.GzipWriter(buf, 6, threads, blocksize) as f:
+            for i in range(0, len(data), 10000):
+                f.write(data[i:i + 10000])
+        return buf.getvalue()
+
+
+    def test_roundtrip(self):
+        """ Any thread count gives one gzip member that decompresses. """
+        for threads in (1, 4):
+            gz = self.compress(self.data, threads, blocksize=1 << 16)
+            self.assertEqual(gzip.decompress(gz), self.data)
+        self.assertEqual(gzip.decompress(self.compress(b'', 4)), b'')
+
+        # Primed blocks keep the ratio close to plain gzip
+        plain = len(gzip.compress(self.data, 6))
+        self.assertLess(len(gz), plain * 1.05)
+
+
+    def test_compress_file(self):
+        """ The gzip program agrees, and no temporary file is left. """
+        source = self.tmp_folder + '/vmlinuz'
+        with open(source, 'wb') as f:
+            f.write(self.data)
+        dest = PGzip.compress_file(source, source + '.gz', threads=3)
+        self.assertEqual(sorted(os.listdir(self.tmp_folder)),
+                         [ 'vmlinuz', 'vmlinuz.gz' ])
+        self.assertEqual(subprocess.check_output(['gzip', '-dc', dest]), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/prefetch.py script against a local HTTP "mirror".
+"""
+from pdb import set_trace
+
+import functools
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from shutil import rmtree
+
+import tmms.utils.prefetch as Prefetch
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PrefetchTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.mirror = cls.tmp_folder + '/mirror'
+        cls.dest = cls.tmp_folder + '/archives'
+        os.makedirs(cls.mirror + '/pool/main')
+        os.makedirs(cls.dest)
+
+        handler = functools.partial(QuietHandler, directory=cls.mirror)
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+        url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+        cls.debs = []
+        for pkg in ('vim', 'vim-common', 'libc6', 'bad'):
+            content = (pkg * 1000).encode()
+            fname = 'pool/main/%s_1.0_arm64.deb' % pkg
+            with open('%s/%s' % (cls.mirror, fname), 'wb') as f:
+                f.write(content)
+            cls.debs.append({
+                'package': pkg, 'version': '1.0', 'architecture': 'arm64',
+                'url': '%s/%s' % (url, fname), 'size': len(content),
+                'sha256': hashlib.sha256(
+                    b'tampered' if pkg == 'bad' else content).hexdigest(),
+            })
+
+
+    @classmethod
+    def tearDown(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_prefetch(self):
+        """ Verified downloads land in dest, installed deps are skipped. """
+        stats = Prefetch.prefetch(self.debs, self.dest,
+            installed={ 'libc6': ('1.0', 'arm64'), 'vim': ('1.0', 'arm64') },
+            explicit=[ 'vim' ], workers=4)
+        self.assertEqual((stats['fetched'], stats['skipped'], stats['failed']),
+                         (2, 1, 1))
+        self.assertEqual(sorted(os.listdir(self.dest)),
+            [ 'vim-common_1.0_arm64.deb', 'vim_1.0_arm64.deb' ])
+
+        stats = Prefetch.prefetch(self.debs, self.dest, workers=4)
+        self.assertEqual((stats['fetched'], stats['present']), (1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
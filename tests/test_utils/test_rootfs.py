@@ -0,0 +1,92 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/rootfs.py script.
+"""
+from pdb import set_trace
+
+import argparse
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tmms.utils.core_utils as TmmsUtils
+import tmms.utils.rootfs as Rootfs
+
+
+class RootfsTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        golden_src = cls.tmp_folder + '/golden_src'
+        os.makedirs(golden_src + '/etc')
+        with open(golden_src + '/etc/hostname', 'w') as f:
+            f.write('golden\n')
+        os.makedirs(cls.tmp_folder + '/golden')
+        cls.golden_tar = cls.tmp_folder + '/golden/golden.arm64.tar'
+        TmmsUtils.make_tar(cls.golden_tar, golden_src)
+
+
+    @classmethod
+    def tearDown(cls):
+        for build in glob_builds(cls.tmp_folder):
+            Rootfs.release(build)
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_golden_cache_once(self):
+        """ The cache is extracted once and reused afterwards. """
+        cache = Rootfs.golden_cache(self.golden_tar)
+        self.assertTrue(os.path.isfile(cache + '/etc/hostname'))
+        marker = cache + '/marker'
+        open(marker, 'w').close()
+        self.assertEqual(cache, Rootfs.golden_cache(self.golden_tar))
+        self.assertTrue(os.path.exists(marker), 'Cache was re-extracted')
+
+
+    def test_prune_old_golden(self):
+        """ A rebuilt golden image replaces the old copy, not adds to it. """
+        old = Rootfs.golden_cache(self.golden_tar)
+        st = os.stat(self.golden_tar)
+        os.utime(self.golden_tar, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        new = Rootfs.golden_cache(self.golden_tar)
+        self.assertNotEqual(old, new)
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(sorted(os.listdir(self.tmp_folder + '/golden')), sorted(
+            [ 'golden.arm64.tar', os.path.basename(new),
+              os.path.basename(new) + '.lock' ]))
+
+
+    def test_provision_is_private(self):
+        """ Writes into a provisioned tree never reach the cache. """
+        for backend in ('untar', 'auto'):
+            build_dir = '%s/build_%s' % (self.tmp_folder, backend)
+            os.makedirs(build_dir)
+            args = argparse.Namespace(build_dir=build_dir,
+                golden_tar=self.golden_tar, rootfs_backend=backend,
+                is_golden=False, logger=None)
+            new_fs_dir = Rootfs.provision(args)
+            self.assertTrue(new_fs_dir.endswith('/untar/'))
+            self.assertIn(args.rootfs_backend_used, Rootfs.BACKENDS)
+            with open(new_fs_dir + 'etc/hostname', 'w') as f:
+                f.write(backend)
+
+            cache = Rootfs.golden_cache(self.golden_tar)
+            with open(cache + '/etc/hostname') as f:
+                self.assertEqual(f.read(), 'golden\n')
+
+            Rootfs.release(build_dir)
+            self.assertFalse(os.path.exists(build_dir + '/untar'))
+
+
+def glob_builds(tmp_folder):
+    return [ '%s/%s' % (tmp_folder, d) for d in os.listdir(tmp_folder)
+             if d.startswith('build_') ]
+
+
+if __name__ == '__main__':
+    unittest.main()
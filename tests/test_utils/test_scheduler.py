@@ -0,0 +1,174 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/scheduler.py script.
+"""
+from pdb import set_trace
+
+import argparse
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from shutil import rmtree
+
+import tmms.utils.scheduler as Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.jobs_dir = cls.tmp_folder + '/jobs'
+        cls.log = cls.tmp_folder + '/log'
+        cls.reports = []
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def run_job(self, job):
+        '''Forked child: log start and end with an exclusive append.'''
+        with open(self.log, 'a') as f:
+            f.write('start %s %f\n' % (job.hostname, time.time()))
+        time.sleep(0.3)
+        with open(self.log, 'a') as f:
+            f.write('end %s %f\n' % (job.hostname, time.time()))
+
+
+    def report(self, job, message, status):
+        self.reports.append((job.hostname, job.position, status))
+
+
+    def args(self, hostname):
+        return argparse.Namespace(hostname=hostname, node_coord='/' + hostname)
+
+
+    def wait_idle(self, sched, timeout=20):
+        deadline = time.time() + timeout
+        while sched.jobs() and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(sched.jobs(), [])
+
+
+    def events(self):
+        with open(self.log) as f:
+            return [ line.split() for line in f ]
+
+
+    def test_limit_and_priority(self):
+        """ Never more than max_jobs at once, higher priority first. """
+        sched = Scheduler.Scheduler(self.jobs_dir, self.run_job, max_jobs=2,
+            order='priority', report=self.report, poll=0.05)
+        with sched._cond:      # hold the dispatcher until all are queued
+            sched._thread = 'held'
+            for i, prio in enumerate((0, 0, 0, 5, 0)):
+                job = sched.submit(self.args('node%d' % i), 'm', prio)
+                with open('%s/%s.json' % (self.jobs_dir, job.job_id)) as f:
+                    self.assertEqual(json.load(f)['state'], 'queued')
+            self.assertEqual(sched.position(job.job_id), 5)
+            sched._thread = None
+        self.assertIn(('node3', 1, 'building'), self.reports)
+        sched.start()
+        self.wait_idle(sched)
+
+        running = peak = 0
+        started = []
+        for what, host, when in sorted(self.events(), key=lambda e: float(e[2])):
+            running += 1 if what == 'start' else -1
+            peak = max(peak, running)
+            if what == 'start':
+                started.append(host)
+        self.assertEqual(peak, 2)
+        self.assertEqual(sorted(started[:2]), [ 'node0', 'node3' ])
+        self.assertEqual(started[2:], [ 'node1', 'node2', 'node4' ])
+        self.assertEqual(glob.glob(self.jobs_dir + '/*.json'), [])
+
+
+    def test_after(self):
+        """ Followers start only once their leader has finished. """
+        sched = Scheduler.Scheduler(self.jobs_dir, self.run_job, max_jobs=3,
+                                    poll=0.05)
+        with sched._cond:
+            leader = sched.submit(self.args('node0'), 'm')
+            for i in (1, 2):
+                sched.submit(self.args('node%d' % i), 'm', after=leader.job_id)
+        self.wait_idle(sched)
+        events = sorted(self.events(), key=lambda e: float(e[2]))
+        self.assertEqual(events[:2], [ ['start', 'node0', events[0][2]],
+                                       ['end', 'node0', events[1][2]] ])
+
+
+    def test_fork_unlocked(self):
+        """ The child is not forked holding the scheduler's lock. """
+        def run_job(job):
+            free = []
+            probe = threading.Thread(target=lambda: free.append(
+                sched._cond.acquire(blocking=False)))
+            probe.start()
+            probe.join()
+            with open(self.log, 'a') as f:
+                f.write('free %s %s\n' % (job.hostname, free[0]))
+
+        sched = Scheduler.Scheduler(self.jobs_dir, run_job, max_jobs=2,
+                                    poll=0.05)
+        for i in range(3):
+            sched.submit(self.args('node%d' % i), 'm')
+        self.wait_idle(sched)
+        self.assertEqual(sorted(self.events()), [
+            [ 'free', 'node%d' % i, 'True' ] for i in range(3) ])
+
+
+    def test_recover_and_cancel(self):
+        """ Queued jobs survive a restart, cancel drops a queued one. """
+        sched = Scheduler.Scheduler(self.jobs_dir, self.run_job, max_jobs=1)
+        sched._thread = 'not started'
+        for i in range(3):
+            sched.submit(self.args('node%d' % i), 'manifest%d' % i)
+        self.assertTrue(sched.cancel('/node1'))
+        self.assertFalse(sched.cancel('/node1'))
+
+        again = Scheduler.Scheduler(self.jobs_dir, self.run_job, max_jobs=1,
+                                    poll=0.05)
+        made = []
+        make = lambda job: made.append(job.manifest) or self.args(job.hostname)
+        self.assertEqual(again.recover(make), 2)
+        self.assertEqual(made, [ 'manifest0', 'manifest2' ])
+        self.wait_idle(again)
+        self.assertEqual([ e[1] for e in self.events() if e[0] == 'start' ],
+                         [ 'node0', 'node2' ])
+
+
+    def test_slot(self):
+        """ Slots are shared through lock files, 0 means no limit. """
+        slots = self.tmp_folder + '/slots'
+        waited = []
+        with Scheduler.slot(slots, 'cpu', 1):
+            pid = os.fork()
+            if pid == 0:
+                with open(slots + '/cpu.0', 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os._exit(1)
+                    except OSError:
+                        os._exit(0)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            with Scheduler.slot(slots, 'cpu', 2):
+                with Scheduler.slot(slots, 'cpu', 0):
+                    pass
+        with Scheduler.slot(slots, 'cpu', 1, waiting=lambda: waited.append(1)):
+            pass
+        self.assertEqual(waited, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/serving.py script.
+"""
+from pdb import set_trace
+
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from shutil import rmtree
+
+import tmms.utils.serving as Serving
+
+# Started by test_reload: every start is logged, /slow is still in flight
+# when the SIGHUP arrives.
+_SERVER = '''
+import os, sys, time
+import tmms.utils.serving as Serving
+
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(1.0)
+    body = str(os.getpid()).encode()
+    start_response('200 OK', [ ('Content-Length', str(len(body))) ])
+    return [ body ]
+
+with open(sys.argv[1], 'a') as f:
+    f.write('started\\n')
+Serving.serve(app, '127.0.0.1', int(sys.argv[2]), workers=4, graceful=5,
+    on_drain=lambda: open(sys.argv[1], 'a').write('drained\\n'))
+'''
+
+
+class ServingTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_pool(self):
+        """ At most "workers" requests at once, connections kept alive. """
+        lock = threading.Lock()
+        active = [ 0, 0 ]   # now, most
+
+        def app(environ, start_response):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.2)
+            with lock:
+                active[0] -= 1
+            start_response('200 OK', [ ('Content-Length', '2') ])
+            return [ b'ok' ]
+
+        server = Serving.PooledWSGIServer('127.0.0.1', 0, app, workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port)
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b'ok')
+            sock = conn.sock
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b'ok')
+            self.assertIs(conn.sock, sock)      # same connection
+            conn.close()
+
+            results = []
+
+            def get():
+                c = http.client.HTTPConnection('127.0.0.1', server.port)
+                c.request('GET', '/')
+                results.append(c.getresponse().status)
+                c.close()
+
+            clients = [ threading.Thread(target=get) for i in range(5) ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, [ 200 ] * 5)
+            self.assertEqual(active[1], 2)
+        finally:
+            server.shutdown()
+            thread.join()
+            self.assertTrue(server.drain(5))
+            server.server_close()
+
+
+    def test_reload(self):
+        """ SIGHUP finishes the request in flight and re-execs in place. """
+        script = self.tmp_folder + '/server.py'
+        log = self.tmp_folder + '/log'
+        with open(script, 'w') as f:
+            f.write(_SERVER)
+        with socket.socket() as probe:      # a free port
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        proc = subprocess.Popen([ sys.executable, script, log, str(port) ],
+                                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline:   # until it listens
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.1)
+
+            slow = []
+
+            def get_slow():
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                conn.request('GET', '/slow')
+                slow.append(conn.getresponse().read())
+
+            thread = threading.Thread(target=get_slow)
+            thread.start()
+            time.sleep(0.3)
+            proc.send_signal(signal.SIGHUP)
+            thread.join()
+            self.assertEqual(slow, [ str(proc.pid).encode() ])
+
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', '/')        # waits in the backlog if need be
+            self.assertEqual(conn.getresponse().read(), str(proc.pid).encode())
+            conn.close()
+            with open(log) as f:
+                self.assertEqual(f.read().split(), [ 'started', 'drained', 'started' ])
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(10), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
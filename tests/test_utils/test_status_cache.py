@@ -0,0 +1,120 @@
+#!/usr/bin/python3 -tt
+"""
+    Test utils/status_cache.py script.
+"""
+from pdb import set_trace
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from shutil import rmtree
+
+import tmms.utils.status_cache as StatusCache
+
+
+class StatusCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        os.makedirs(cls.tmp_folder + '/node01')
+        cls.write_status('node01', 'ready')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    @classmethod
+    def write_status(cls, hostname, status):
+        '''Like customize_node.update_status(): write aside and rename.'''
+        path = '%s/%s/status.json' % (cls.tmp_folder, hostname)
+        with open(path + '.new', 'w') as f:
+            f.write(json.dumps({ 'status': status, 'manifest': 'm' }))
+        os.replace(path + '.new', path)
+
+
+    def wait_for(self, cache, hostname, expected, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = cache.get(hostname)
+            if (status and status['status']) == expected:
+                return
+            time.sleep(0.02)
+        self.fail('%s never became %s, is %s' % (hostname, expected, status))
+
+
+    def check_updates(self, cache):
+        self.assertEqual(cache.get('node01')['status'], 'ready')
+        self.assertIsNone(cache.get('node02'))
+        cache.start()
+        try:
+            os.makedirs(self.tmp_folder + '/node02')
+            self.write_status('node02', 'building')
+            self.wait_for(cache, 'node02', 'building')
+            self.write_status('node02', 'ready')
+            self.wait_for(cache, 'node02', 'ready')
+            os.unlink(self.tmp_folder + '/node01/status.json')
+            self.wait_for(cache, 'node01', None)
+            rmtree(self.tmp_folder + '/node02')
+            self.wait_for(cache, 'node02', None)
+            self.assertEqual(cache.all(), {})
+        finally:
+            cache.stop()
+
+
+    def test_inotify(self):
+        """ inotify picks up creation, replacement and removal. """
+        cache = StatusCache.StatusCache(self.tmp_folder, poll=3600)
+        self.assertIsNotNone(cache._inotify, 'no inotify on this system')
+        self.check_updates(cache)
+
+
+    def test_polling(self):
+        """ Without inotify the mtime rescans do the same. """
+        cache = StatusCache.StatusCache(self.tmp_folder, poll=0.05,
+                                        use_inotify=False)
+        self.check_updates(cache)
+
+
+    def test_on_change(self):
+        """ Changes are reported once each, not the initial scan. """
+        changes = []
+        cache = StatusCache.StatusCache(self.tmp_folder, use_inotify=False,
+            on_change=lambda host, status: changes.append(
+                (host, status and status['status'])))
+        self.assertEqual(changes, [])
+        cache.refresh('node01')
+        self.write_status('node01', 'building')
+        cache.refresh('node01')
+        cache.refresh('node01')
+        os.unlink(self.tmp_folder + '/node01/status.json')
+        cache.rescan()
+        self.assertEqual(changes, [ ('node01', 'building'), ('node01', None) ])
+
+        self.write_status('node01', 'ready')
+        cache.rescan()
+        rmtree(self.tmp_folder + '/node01')
+        cache.rescan()
+        self.assertEqual(changes[2:], [ ('node01', 'ready'), ('node01', None) ])
+
+
+    def test_refresh(self):
+        """ refresh() reads now; garbage is an error status, not an exception. """
+        cache = StatusCache.StatusCache(self.tmp_folder, use_inotify=False)
+        with open(self.tmp_folder + '/node01/status.json', 'w') as f:
+            f.write('{ not json')
+        self.assertEqual(cache.get('node01')['status'], 'ready')
+        self.assertEqual(cache.refresh('node01')['status'], 'error')
+        cache.get('node01')['status'] = 'mangled'
+        self.assertEqual(cache.get('node01')['status'], 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -78,7 +78,19 @@ class TmNode(tm_base.TmCmd):
             'Missing argument: unsetnode <node coordinate>'
         node_coords = self._resolve_nodes(target)
         responses = {}
+        every = {}
+        if len(node_coords) > 1:     # one request for all of them
+            data = self.http_request('%s%s' % (self.url, 'nodes/status'))
+            if data.status_code == 200:
+                every = json.loads(data.text)['nodes']
         for node_coord in node_coords:
+            status = every.get('/' + node_coord)
+            if status is not None:
+                if status['status'] == 'unbound':
+                    responses[node_coord] = { 204: '' }
+                else:
+                    responses[node_coord] = { 200: json.dumps(status) }
+                continue
             api_url = "%s%s%s" % (self.url, 'node/', node_coord)
             data = self.http_request(api_url)
             responses[node_coord] = { data.status_code: data.text }
@@ -98,6 +110,13 @@ class TmNode(tm_base.TmCmd):
             'Missing argument: setnode <node coordinate> <manifest>'
         node_coords = self._resolve_nodes(target[:-1])
         manifest = target[-1]
+        if len(node_coords) > 1:
+            # One request: the server builds the manifest image once.
+            api_url = '%s%s' % (self.url, 'nodes/')
+            payload = json.dumps({ 'manifest': manifest, 'nodes': node_coords })
+            data = self.http_request(api_url, payload=payload)
+            if not self._no_bulk_route(data):
+                return self.to_json(data)
         payload = '{ "manifest" :  "%s" }' % manifest
         responses = {}
         for node_coord in node_coords:
@@ -110,6 +129,23 @@ class TmNode(tm_base.TmCmd):
             return self.to_json(data)   # Per the ERS
         return json.dumps(responses)
 
+    @staticmethod
+    def _no_bulk_route(response):
+        """
+            An older server without PUT nodes/ answers 405, or 404 with its
+        HTML not-found page.  The bulk route's own 404 (eg no such manifest)
+        is JSON with a "status" and is the answer.
+        """
+        if response.status_code == 405:
+            return True
+        if response.status_code != 404:
+            return False
+        try:
+            body = response.json()
+        except ValueError:
+            return True
+        return not (isinstance(body, dict) and 'status' in body)
+
     def delete(self, target, **options):
         """
         unsetnode <node coord>
@@ -141,6 +177,9 @@ class TmNode(tm_base.TmCmd):
         assert len(target) >= 1, \
             'Missing argument: waitnode <node coordinate>'
         node_coords = self._resolve_nodes(target)
+        responses = self._wait_events(node_coords)
+        if responses is not None:
+            return json.dumps({'200': responses})
         responses = {}      # only add them when non-building state is reached
         coordset = frozenset(node_coords)
         remaining = coordset - frozenset(responses.keys())
@@ -165,3 +204,31 @@ class TmNode(tm_base.TmCmd):
             remaining = coordset - frozenset(responses.keys())
             sleepy = 5
         return json.dumps({'200': responses})   # Just like other commands
+
+    def _wait_events(self, node_coords):
+        '''Long-poll the node event stream until none is building.  None
+           if the server doesn't have one, so the caller polls instead.'''
+        if not all('/' in node_coord for node_coord in node_coords):
+            return None     # node numbers: events only name coordinates
+        remaining = set(node_coords)
+        responses = {}
+        since = ''
+        while remaining:
+            api_url = '%snodes/events?timeout=30&nodes=%s&since=%s' % (
+                self.url, ','.join(sorted(remaining)), since)
+            data = self.http_request(api_url)
+            if data.status_code != 200:
+                if data.status_code in (404, 405) and not responses:
+                    return None     # older server
+                for node_coord in remaining:
+                    responses[node_coord] = 'unknown' \
+                        if data.status_code == 404 else 'error'
+                break
+            body = json.loads(data.text)
+            since = body['seq']
+            for event in body['events']:
+                node_coord = event['node'].lstrip('/')
+                if node_coord in remaining and event['status'] != 'building':
+                    responses[node_coord] = event['status']
+                    remaining.discard(node_coord)
+        return responses
@@ -9,6 +9,8 @@ __copyright__ = "Copyright 2017 Hewlett Packard Enterprise Development LP"
 __maintainer__ = "Rocky Craig, Zakhar Volchak"
 __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
+import urllib.parse
+
 from . import tm_base
 
 
@@ -21,7 +23,8 @@ class TmPackage(tm_base.TmCmd):
         super().__init__()
         self.args = {
             'listpkgs' : self.listall,
-            'showpkg' : self.show
+            'showpkg' : self.show,
+            'searchpkgs' : self.search
         }
 
     def listall(self, arg_list=None, **options):
@@ -46,3 +49,19 @@ class TmPackage(tm_base.TmCmd):
         url = "%s%s%s" % (self.url, 'package/', self.show_name)
         data = self.http_request(url)
         return self.to_json(data)
+
+
+    def search(self, target, **options):
+        """
+        searchpkgs <term> [<term> ...]
+
+        List the packages whose name or short description matches every term,
+        in JSON format (the first 1000).
+        """
+        super().show(target, **options)
+        query = urllib.parse.urlencode({
+            'q': ' '.join(target) if isinstance(target, list) else target,
+            'per_page': 1000 })
+        url = "%s%s%s" % (self.url, 'packages/search?', query)
+        data = self.http_request(url)
+        return self.to_json(data)
@@ -0,0 +1,195 @@
+#!/usr/bin/python3 -tt
+'''
+    Parser for Debian control files (RFC822-style stanzas): Packages
+indices, the tasksel description file.  It reads the way debian.deb822
+does, for the files this server reads, but works on offsets into a bytes
+object or mmap:
+
+  - stanzas() finds stanza boundaries (empty lines) with bytes.find().
+  - find() gets the extent of one field's value, continuation lines
+    included, so a caller holding only offsets decodes just that value.
+  - parse() takes all fields of a stanza with one compiled regex, one
+    match per field rather than a Python step per line.
+  - iter_paragraphs() streams a file in blocks, whole stanzas at a time.
+
+Values come out as deb822 hands them out: the first line stripped,
+continuation lines as they are, joined with "\\n"; lines of only whitespace
+and "#" comment lines are left out.  Field names are not case folded.
+Invalid UTF-8 is replaced rather than guessed at.
+
+    python3 -m tmms.utils.control /path/to/Packages[.gz|.xz]
+
+compares it with python-debian on a real index.
+'''
+
+import argparse
+import gzip
+import io
+import lzma
+import re
+import time
+
+from pdb import set_trace
+
+# A field: name, optional blanks, colon, then the rest of the line and any
+# continuation (leading blank) or comment lines after it.
+_FIELD = re.compile(rb'^([^#:\s][^:\s]*)[ \t]*:([^\n]*(?:\n[ \t#][^\n]*)*)',
+                    re.M)
+
+
+def stanzas(buf, start=0, end=None):
+    """
+        Stanza boundaries of a control file.
+
+    :param 'buf': [bytes] or anything else with find() and indexing, eg
+                  mmap.  A stanza ends at an empty line.
+    :return: [iterator] of (start, end) offsets, end after the stanza's
+             last "\\n" (or at the end of buf).
+    """
+    end = len(buf) if end is None else end
+    while start < end:
+        if buf[start] == 0x0a:      # more empty lines
+            start += 1
+            continue
+        stop = buf.find(b'\n\n', start, end)
+        stop = end if stop == -1 else stop + 1
+        yield start, stop
+        start = stop
+
+
+def find(buf, start, end, key):
+    """
+        Where one field's value is, without looking at the other fields.
+
+    :param 'key': [bytes] field name as spelled in the file.
+    :return: [tuple] (start, end) of the raw value, None if the stanza
+             buf[start:end] has no such field.
+    """
+    key += b':'
+    if buf[start:start + len(key)] == key:
+        pos = start + len(key)
+    else:
+        pos = buf.find(b'\n' + key, start, end)
+        if pos == -1:
+            return None
+        pos += 1 + len(key)
+    stop = buf.find(b'\n', pos, end)
+    while stop != -1 and stop + 1 < end and buf[stop + 1] in b' \t#':
+        stop = buf.find(b'\n', stop + 1, end)
+    return pos, end if stop == -1 else stop
+
+
+def value(raw):
+    '''Raw value bytes (after the colon) as deb822 reads them.'''
+    if b'\n' not in raw:
+        return raw.decode('utf-8', 'replace').strip()
+    lines = raw.decode('utf-8', 'replace').split('\n')
+    return '\n'.join([ lines[0].strip() ] + [ line for line in lines[1:]
+        if line and not line.isspace() and line[0] != '#' ])
+
+
+def parse(buf, start=0, end=None, keys=None):
+    """
+        One stanza as a dict.
+
+    :param 'keys': [set] only these fields (names as spelled), default all.
+    """
+    result = {}
+    end = len(buf) if end is None else end
+    for key, raw in _FIELD.findall(buf, start, end):
+        key = key.decode('utf-8', 'replace')
+        if keys is None or key in keys:
+            result[key] = value(raw)
+    return result
+
+
+def iter_paragraphs(source, keys=None, block=1 << 20):
+    """
+        Every stanza of a control file as a dict; for debian.deb822's
+    iter_paragraphs().  Stanzas without fields (only comments) are skipped.
+
+    :param 'source': [bytes, str, mmap or binary file object] a file is
+                     read "block" bytes at a time, not all at once.
+    :param 'keys': [set] see parse().
+    """
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if not hasattr(source, 'read'):
+        for start, end in stanzas(source):
+            paragraph = parse(source, start, end, keys)
+            if paragraph:
+                yield paragraph
+        return
+
+    pending = b''
+    while True:
+        data = source.read(block)
+        buf = pending + data
+        cut = len(buf) if not data else buf.rfind(b'\n\n') + 1
+        for start, end in stanzas(buf, 0, cut):
+            paragraph = parse(buf, start, end, keys)
+            if paragraph:
+                yield paragraph
+        if not data:
+            return
+        pending = buf[cut:]
+
+
+def _read(path):
+    opener = gzip.open if path.endswith('.gz') else \
+             lzma.open if path.endswith('.xz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def benchmark(path, repeat=3):
+    """
+        Parse a control file with python-debian and with this module.
+
+    :param 'path': [str] eg a Packages, Packages.gz or Packages.xz file.
+    :return: [list] of dicts with parser, paragraphs, seconds (best of
+             "repeat", decompression not included) and same (whether it
+             read the same as python-debian).
+    """
+    from debian.deb822 import Packages as debPackages
+
+    content = _read(path)
+    parsers = (
+        ('python-debian', lambda: [ dict(p) for p in
+            debPackages.iter_paragraphs(io.BytesIO(content)) ]),
+        ('control', lambda: list(iter_paragraphs(content))),
+        ('control file', lambda: list(iter_paragraphs(io.BytesIO(content)))),
+    )
+    results = []
+    expected = None
+    for name, parser in parsers:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            parsed = parser()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if expected is None:
+            expected = parsed
+        results.append(dict(parser=name, paragraphs=len(parsed),
+                            seconds=best, same=parsed == expected))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare control file parsers on a Packages index')
+    parser.add_argument('path', help='Packages file, may be .gz or .xz')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per parser, the best one counts')
+    args = parser.parse_args()
+
+    print('%-14s %10s %9s %8s %5s' % (
+        'parser', 'paragraphs', 'seconds', 'speedup', 'same'))
+    results = benchmark(args.path, args.repeat)
+    for r in results:
+        print('%-14s %10d %8.3fs %7.1fx %5s' % (
+            r['parser'], r['paragraphs'], r['seconds'],
+            results[0]['seconds'] / r['seconds'] if r['seconds'] else 0.0,
+            r['same']))
+    raise SystemExit(0)
@@ -18,6 +18,7 @@ import tarfile
 import time
 from pdb import set_trace
 
+from . import extract
 from . import file_utils
 
 
@@ -101,32 +102,37 @@ def piper(cmdstr, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         raise RuntimeError('"%s" failed: %s' % (cmdstr, str(e)))
 
 
-def untar(destination, source):
+def untar(destination, source, progress=None):
     """
-        Untar source file into destination folder. tar.tarfile.extractall
-    will create all necessary (sub)directories.
+        Untar source file into destination folder.  The extract module
+    streams (optionally gzip/xz/zstd compressed) tarballs with parallel
+    file writes and creates all necessary (sub)directories.
     Note: When untaring into the existing folder to overwrite files,
-    tarfile.extractall function will throw a FileExistsError
-    if it can not overwrite broken symlinks of the tar'ed file.
+    stale trees and broken symlinks just get in the way.
     Nuke it from orbit, it's the only way to be sure.
 
     :param 'destination': [str] path to where to extract target into.
-    :param 'source': [str] path to a .tar file to untar.
+    :param 'source': [str] path to a .tar[.gz|.xz|.zst] file to untar.
+    :param 'progress': callable(nbytes, seconds), see extract.Extractor.
     :return: [str] path to untared content.  Raise RuntimeError on problems.
     """
 
     try:
         file_utils.remove_target(destination)  # succeeds even if missing
-        with tarfile.open(source) as tar_obj:
-            tar_obj.extractall(path=destination)
+        extract.Extractor(destination, progress=progress).extract(source)
         return destination
-    except (AssertionError, tarfile.ReadError, tarfile.ExtractError) as err:
+    except (AssertionError, OSError, tarfile.ReadError,
+            tarfile.ExtractError) as err:
         raise RuntimeError('Error occured while untaring "%s": %s' % (source, str(err)))
 
 
 def make_tar(destination, source):
-    """ Make a "source" folder into "tar" destination. No compression involved."""
-    with tarfile.open(destination, 'w') as tar:
+    """
+        Make a "source" folder into "tar" destination, compressed the way
+    its name says: .tar.gz, .tar.xz, .tar.zst (through the zstd program)
+    or plain .tar.  Raise RuntimeError on problems.
+    """
+    def add_all(tar):
         if os.path.isfile(source):
             tar.add(source, arcname=os.path.basename(source))
         else:
@@ -134,6 +140,28 @@ def make_tar(destination, source):
             for to_compress in glob.glob(source + '/*'):
                 tar.add(to_compress, arcname=os.path.basename(to_compress))
 
+    if not destination.endswith('.zst'):
+        mode = { '.gz': 'w:gz', '.xz': 'w:xz' }.get(
+            os.path.splitext(destination)[1], 'w')
+        with tarfile.open(destination, mode) as tar:
+            add_all(tar)
+        return
+
+    try:
+        proc = subprocess.Popen(['zstd', '-q', '-f', '-T0', '-o', destination],
+                                stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        raise RuntimeError('zstd is needed to write %s: %s' % (destination, err))
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+            add_all(tar)
+    finally:
+        proc.stdin.close()
+        stderr = proc.stderr.read()
+        ret = proc.wait()
+    if ret:
+        raise RuntimeError('zstd -o %s failed: %s' % (destination, stderr))
+
 
 def deb_components(full_source):
     """
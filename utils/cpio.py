@@ -0,0 +1,209 @@
+#!/usr/bin/python3 -tt
+'''
+    Native "newc" cpio writer for initramfs images.  A scandir walk of the
+file system feeds the archive writer, which writes straight into whatever
+file object it is given (usually a compressor on a file in the TFTP
+directory).  No intermediate .cpio, no list of every path in memory, no
+external cpio program.
+
+Layout follows the kernel's Documentation/early-userspace/buffer-format:
+110-byte ASCII header, NUL-terminated name, data, each padded to 4 bytes,
+then a TRAILER!!! entry.  For hardlinks the first name carries the data;
+later names have size 0 and the kernel links them to the first.
+
+Standard python3 libraries only.
+'''
+
+import os
+import stat
+
+from pdb import set_trace
+
+_MAGIC = b'070701'
+_TRAILER = 'TRAILER!!!'
+_BUFSIZE = 1 << 20
+_CHUNK = 1 << 20
+
+
+def walk(top, ignore_files=(), ignore_dirs=()):
+    """
+        Depth-first, parents before children, like "find ." would list it.
+    Names in ignore_files and directories in ignore_dirs are skipped at any
+    depth (directories with everything below them).
+
+    :param 'top': [str] directory to walk.
+    :return: generator of (archive name './x/y', full path, os.stat_result)
+    """
+    ignore_files = frozenset(ignore_files)
+    ignore_dirs = frozenset(ignore_dirs)
+    stack = [ ('.', top) ]
+    while stack:
+        relname, path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            st = entry.stat(follow_symlinks=False)
+            name = relname + '/' + entry.name
+            if stat.S_ISDIR(st.st_mode):
+                if entry.name in ignore_dirs:
+                    continue
+                yield name, entry.path, st
+                subdirs.append((name, entry.path))
+            else:
+                if entry.name in ignore_files or entry.name in ignore_dirs:
+                    continue
+                yield name, entry.path, st
+        stack.extend(reversed(subdirs))
+
+
+class NewcWriter(object):
+    """
+        Append entries to a newc archive on a writable binary file object.
+    The caller owns (and closes) fileobj; close() here only ends the archive.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.nbytes = 0         # archive bytes written so far
+        self.entries = 0
+        self._buf = bytearray()
+        self._inodes = {}       # (st_dev, st_ino) -> archive inode number
+        self._next_ino = 1
+
+    def _write(self, data):
+        self._buf += data
+        if len(self._buf) >= _BUFSIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self.fileobj.write(self._buf)
+            self.nbytes += len(self._buf)
+            self._buf = bytearray()
+
+    def _pad(self, size):
+        if size % 4:
+            self._write(b'\0' * (4 - size % 4))
+
+    def _header(self, name, ino, mode, uid, gid, nlink, mtime, size,
+                rdevmajor=0, rdevminor=0):
+        name = name.encode('utf-8', 'surrogateescape') + b'\0'
+        fields = (ino, mode, uid, gid, nlink, int(mtime), size,
+                  0, 0, rdevmajor, rdevminor, len(name), 0)
+        self._write(_MAGIC + ''.join('%08X' % f for f in fields).encode())
+        self._write(name)
+        self._pad(110 + len(name))
+        self.entries += 1
+
+    def add(self, name, path, st):
+        """
+            Add one file system object.
+
+        :param 'name': [str] name in the archive, e.g. './etc/hostname'
+        :param 'path': [str] where to read it (regular files and symlinks)
+        :param 'st': [os.stat_result] lstat() of path
+        """
+        mode = st.st_mode
+        key = (st.st_dev, st.st_ino)
+        first = True
+        if st.st_nlink > 1 and not stat.S_ISDIR(mode):
+            first = key not in self._inodes
+            if first:
+                self._inodes[key] = self._next_ino
+                self._next_ino += 1
+            ino = self._inodes[key]
+        else:
+            ino = self._next_ino
+            self._next_ino += 1
+
+        rdevmajor = rdevminor = 0
+        data = None
+        size = 0
+        if stat.S_ISLNK(mode):
+            data = os.readlink(path).encode('utf-8', 'surrogateescape')
+            size = len(data)
+        elif stat.S_ISREG(mode) and first:
+            size = st.st_size
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            rdevmajor, rdevminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+
+        self._header(name, ino, mode, st.st_uid, st.st_gid, st.st_nlink,
+                     st.st_mtime, size, rdevmajor, rdevminor)
+        if data is not None:
+            self._write(data)
+        elif size:
+            self._copy(path, size)
+        self._pad(size)
+
+    def _copy(self, path, size):
+        '''Exactly size bytes, even if the file changed since stat().'''
+        remaining = size
+        with open(path, 'rb') as f:
+            while remaining:
+                chunk = f.read(min(_CHUNK, remaining))
+                if not chunk:
+                    break
+                self._write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            self._write(b'\0' * remaining)
+
+    def close(self):
+        '''Trailer, and pad the archive to a 512-byte boundary like cpio(1).'''
+        self._header(_TRAILER, 0, 0, 0, 0, 1, 0, 0)
+        total = self.nbytes + len(self._buf)
+        if total % 512:
+            self._write(b'\0' * (512 - total % 512))
+        self.flush()
+
+
+def write_entries(entries, fileobj, names=None):
+    """
+        Archive (name, path, stat) tuples, as walk() yields them, into fileobj.
+
+    :param 'names': [file object] if given, each archive name is logged there.
+    :return: [NewcWriter] for its entries/nbytes counters.
+    """
+    writer = NewcWriter(fileobj)
+    for name, path, st in entries:
+        writer.add(name, path, st)
+        if names is not None:
+            names.write(name + '\n')
+    writer.close()
+    return writer
+
+
+def write_tree(top, fileobj, ignore_files=(), ignore_dirs=(), names=None):
+    '''Archive everything under top into fileobj, see write_entries().'''
+    return write_entries(walk(top, ignore_files, ignore_dirs), fileobj, names)
+
+
+def iter_entries(fileobj):
+    """
+        Read a newc archive back, for tests and troubleshooting.
+
+    :return: generator of (name, mode, ino, nlink, data) up to the trailer.
+    """
+    def read_padded(size):
+        data = fileobj.read(size)
+        if size % 4:
+            fileobj.read(4 - size % 4)
+        return data
+
+    while True:
+        header = fileobj.read(110)
+        if len(header) < 110 or header[:6] != _MAGIC:
+            raise ValueError('Not a newc cpio archive')
+        fields = [ int(header[6 + 8 * i:14 + 8 * i], 16) for i in range(13) ]
+        ino, mode, nlink, size, namesize = (
+            fields[0], fields[1], fields[4], fields[6], fields[11])
+        name = fileobj.read(namesize)[:-1].decode('utf-8', 'surrogateescape')
+        if (110 + namesize) % 4:
+            fileobj.read(4 - (110 + namesize) % 4)
+        if name == _TRAILER:
+            return
+        yield name, mode, ino, nlink, read_padded(size)
@@ -14,9 +14,11 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
 import argparse
+import concurrent.futures
 import contextlib
+import fcntl
 import glob
-import gzip
+import hashlib
 import json
 import magic  # to get file type and check if gzipped
 import os
@@ -28,8 +30,19 @@ import time
 from pdb import set_trace
 
 from tmms.utils import core_utils
+from tmms.utils import cpio
+from tmms.utils import deb_cache
+from tmms.utils import esp_image
 from tmms.utils import file_utils
+from tmms.utils import history
+from tmms.utils import image_cache
+from tmms.utils import initramfs
 from tmms.utils import logging
+from tmms.utils import metrics
+from tmms.utils import pgzip
+from tmms.utils import prefetch
+from tmms.utils import rootfs
+from tmms.utils import scheduler
 from tmms.utils import utils
 
 #==============================================================================
@@ -549,46 +562,135 @@ def rewrite_rclocal(args):
 #==============================================================================
 
 
+def initramfs_codec(args):
+    '''The manifest's "initramfs_codec" if it has one, else the server's.'''
+    codec = None
+    if getattr(args, 'manifest', None) is not None:
+        codec = args.manifest.thedict.get('initramfs_codec', None)
+    return initramfs.validate(codec or getattr(args, 'initramfs_codec', None))
+
+
+# Kept out of every initramfs
+_cpio_ignore = dict(ignore_files=['vmlinuz', 'initrd.img'], ignore_dirs=['boot'])
+
+
+def _write_cpio(args, cpio_file, codec, entries, names=None):
+    """
+        Stream (name, path, stat) entries as a newc cpio through the
+    compressor into cpio_file, which only appears once it's complete.
+
+    :return: [NewcWriter] for its counters.
+    """
+    tmp_file = '%s/.%s.tmp%d' % (os.path.dirname(cpio_file),
+                                 os.path.basename(cpio_file), os.getpid())
+    try:
+        with open(tmp_file, 'wb') as raw:
+            with initramfs.writer(codec, raw,
+                    threads=getattr(args, 'compress_threads', None)) as f_out:
+                writer = cpio.write_entries(entries, f_out, names=names)
+        os.replace(tmp_file, cpio_file)
+        return writer
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def layered(args):
+    '''Nodes cloned from a shared image boot its base cpio plus their own.'''
+    return bool(getattr(args, 'layered_initramfs', False) and
+                getattr(args, 'image_cache_key', None) and
+                not args.is_golden)
+
+
+def create_base_cpio(args):
+    """
+        Before the per-node steps: make sure the base cpio of the shared
+    image exists (the first node of a manifest build writes it), link the
+    node to it, and remember the tree so create_cpio() can find what the
+    per-node steps changed.  Does nothing unless layered().
+
+    :param 'args.image_cache_key': [str] set by image_cache.provision()
+    :return: [str] base cpio path or None.  Sets args.initrd_base and
+             args.initrd_snapshot.
+    """
+    args.initrd_base = args.initrd_snapshot = None
+    if not layered(args):
+        return None
+    images_dir = os.path.dirname(args.tftp_dir)
+    file_utils.make_dir('%s/%s' % (images_dir, initramfs.BASE_DIR))
+    base = initramfs.base_path(images_dir, args.image_cache_key,
+                               initramfs_codec(args))
+    try:
+        with initramfs.base_lock(base):
+            if os.path.exists(base):
+                os.utime(base)
+                update_status(args, 'Using base cpio %s' % base)
+            else:
+                update_status(args, 'Create base cpio %s' % base)
+                writer = _write_cpio(args, base, initramfs_codec(args),
+                    cpio.walk(args.new_fs_dir, **_cpio_ignore))
+                update_status(args, 'Base cpio has %d entries, %d MB uncompressed' % (
+                    writer.entries, writer.nbytes >> 20))
+            initramfs.link_base(args.tftp_dir, args.hostname, base)
+    except Exception as err:
+        raise RuntimeError('Couldn\'t create base cpio "%s": %s' % (base, str(err)))
+    args.initrd_snapshot = initramfs.snapshot(args.new_fs_dir, **_cpio_ignore)
+    args.initrd_base = base
+    return base
+
+
 def create_cpio(args):
     """
-        Get the non-boot pieces, ignoring initrd, kernel, and /boot.
+        Get the non-boot pieces, ignoring initrd, kernel, and /boot, and
+    stream them as a newc cpio through the compressor straight into the TFTP
+    directory.  After create_base_cpio() only what the per-node steps
+    changed goes in, unless they removed something; then it's everything.
 
-    :param 'dest_file': [str] path to save cpio archive
     :param 'args.new_fs_dir': [str] folder to create .cpio from.
-    :return: cpio_file
+    :param 'args.tftp_dir': [str] where the compressed cpio goes.
+    :return: [list] compressed cpio paths in the order grub should load them.
     """
-    cpio_file = '%s/%s.cpio' % (args.build_dir, args.hostname)
+    codec = initramfs_codec(args)
+    cpio_file = '%s/%s' % (args.tftp_dir, initramfs.filename(args.hostname, codec))
+    base = getattr(args, 'initrd_base', None)
+    if base is not None:
+        entries, gone = initramfs.changes(args.new_fs_dir,
+                                          args.initrd_snapshot, **_cpio_ignore)
+        if gone:
+            update_status(args, 'Per-node steps removed %s, no base cpio' %
+                          ', '.join(gone[:5]))
+            base = args.initrd_base = None
+    if base is None:
+        initramfs.link_base(args.tftp_dir, args.hostname, None)
+        entries = cpio.walk(args.new_fs_dir, **_cpio_ignore)
     update_status(args, 'Create %s from %s' % (cpio_file, args.new_fs_dir))
     try:
-        # Skip things even though they may have been moved
-        found_data = core_utils.find(
-            args.new_fs_dir,
-            ignore_files=['vmlinuz', 'initrd.img'],
-            ignore_dirs=['boot'])
-
-        cmd = 'cpio --create --format \'newc\''
-        cpio_stdin = '\n'.join(found_data).encode()  # needed for Popen pipe.
-
-        with open(cpio_file, 'w') as dest_obj:
-            # create CPIO relative to the 'find' path, to avoid '/' in archive
-            # names.  Note: searching outside of untar folder results in a
-            # "full path" string (e.g. whatever/untar/boot...., instead
-            # ./boot...). This causes Kernel Panic when trying to boot with
-            # such a cpio file.
-            with file_utils.workdir(args.new_fs_dir):
-                ret, cpio_out, cpio_err = core_utils.piper(
-                    cmd, stdin=cpio_stdin, stdout=dest_obj)
-                assert not ret, 'cpio failed: %s' % cpio_err
-
-        # output find data to a log file
-        if args.verbose:
-            with open('/tmp/man_find.log', 'w') as file_obj:
-                file_obj.write('\n'.join(found_data))   # FIXME proper logging
-        return cpio_file
+        # Names are relative to new_fs_dir ("./boot..."), a "full path"
+        # name (whatever/untar/boot...) causes a Kernel Panic when trying
+        # to boot with such a cpio file.
+        names = open('/tmp/man_find.log', 'w') if args.verbose else None
+        try:
+            writer = _write_cpio(args, cpio_file, codec, entries, names)
+        finally:
+            if names is not None:
+                names.close()
+        # A previous build may have used another codec
+        for ext in initramfs.CODECS.values():
+            stale = '%s/%s.cpio.%s' % (args.tftp_dir, args.hostname, ext)
+            if stale != cpio_file and os.path.exists(stale):
+                os.unlink(stale)
+        update_status(args, 'cpio has %d entries, %d MB uncompressed (%s)' % (
+            writer.entries, writer.nbytes >> 20, codec))
+        if base is None:
+            return [ cpio_file ]
+        return [ base, cpio_file ]
 
     except Exception as err:
         raise RuntimeError('Couldn\'t create "%s" from "%s": %s' % (
             cpio_file, args.new_fs_dir, str(err)))
+    finally:
+        if layered(args):
+            initramfs.collect_bases(os.path.dirname(args.tftp_dir))
 
 #==============================================================================
 # Automatically answering yes is harder than it looks.
@@ -617,6 +719,77 @@ else
 fi
 '''
 
+# Things from the repo OUGHT to work.
+_aptget_install = 'apt-get install -q -y --force-yes -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold"'
+
+# dpkg runs each trigger once, after everything is unpacked and configured.
+_defer_triggers = '-o DPkg::NoTriggers=true -o DPkg::ConfigurePending=true -o DPkg::TriggersPending=true'
+
+_batchtemplate = '''
+echo -e "\\n---------- {what} in one transaction\\n"
+{install}
+if [ $? -ne 0 ]; then
+    echo "Batched install had problems, retrying one at a time" >&2
+    dpkg --configure -a
+{fallback}
+fi
+'''
+
+# The union of all task packages, or nothing (so the batch "fails") if
+# tasksel doesn't know one of them.  No --reinstall, like tasksel itself.
+_tasks_batch = '''TASKPKGS=""
+for T in {tasks}; do
+    P=$(tasksel --task-packages $T) && [ -n "$P" ] || {{ TASKPKGS=""; break; }}
+    TASKPKGS="$TASKPKGS $P"
+done
+[ -n "$TASKPKGS" ] && {install} $TASKPKGS'''
+
+
+# apt really downloaded these, give them to the shared cache (see deb_cache).
+_debcache_harvest = '''
+mkdir -p {0}
+find /var/cache/apt/archives -maxdepth 1 -type f -name '*.deb' -exec mv -t {0} {{}} +
+'''
+
+
+def _install_one(pkg):
+    return ('\necho -e "\\n---------- Installing %s\\n"\n' % pkg +
+            '%s --reinstall %s\n' % (_aptget_install, pkg) +
+            '[ $? -ne 0 ] && echo "Install %s failed" && exit 1\n' % pkg)
+
+
+def _tasksel_one(task):
+    return ('\necho -e "\\n---------- Executing task  %s\\n"\n' % task +
+            'tasksel install %s\n' % task +
+            '[ $? -ne 0 ] && echo "Tasksel %s failed" && exit 1\n' % task)
+
+
+def prefetch_debs(args, packages, dest_dir):
+    """
+        Download the manifest's dependency closure (args.prefetch, written
+    by the nodes blueprint) concurrently before the chroot runs, so apt in
+    there finds the .debs already "downloaded".  Failures aren't fatal,
+    apt just downloads those itself.
+
+    :param 'packages': [list] package names from the manifest.
+    :param 'dest_dir': [str] where apt (or deb_cache.seed()) will find them.
+    """
+    debs = prefetch.load(getattr(args, 'prefetch', None))
+    if not debs:
+        return
+    update_status(args, 'Prefetching up to %d .debs' % len(debs))
+    file_utils.make_dir(dest_dir)
+    stats = prefetch.prefetch(debs, dest_dir,
+        installed=deb_cache.installed(args.new_fs_dir + '/var/lib/dpkg/status'),
+        explicit=packages or (),
+        workers=getattr(args, 'prefetch_workers', 8))
+    update_status(args,
+        'Prefetched %d .debs (%d MB in %.1fs), %d present, %d installed, %d failed' % (
+        stats['fetched'], stats['bytes'] >> 20, stats['seconds'],
+        stats['present'], stats['skipped'], stats['failed']))
+    for error in stats['errors']:
+        args.logger.warning(error)
+
 
 def install_packages(args):
     """
@@ -633,6 +806,7 @@ def install_packages(args):
     :return [boolean] True if it worked, False otherwise with updated status.
     """
     is_debug = getattr(args, 'debug', False)
+    use_debcache = deb_cache.enabled(args)
     localdebs = None
     packages = None
     downloads = None
@@ -699,30 +873,38 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
         # install.write("this isn't legal this cannot work\n")
         install.write(script_header)
 
+        # Batched: one resolver run and one round of dpkg triggers (man-db,
+        # ldconfig, initramfs...) instead of one per package, which really
+        # adds up under qemu-aarch64-static.  Failures redo it one at a time
+        # so install.log still names the culprit.
+        batch = getattr(args, 'install_batch', True)
+
         install.write('\n# Packages: %s\n' % packages)
-        if packages is not None:
-            for pkg in packages:
-                install.write(
-                    '\necho -e "\\n---------- Installing %s\\n"\n' % pkg)
-                cmd = 'apt-get install -q -y --reinstall --force-yes -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" %s\n' % pkg
-                install.write(cmd)
-                # Things from the repo OUGHT to work.
-                install.write(
-                    '[ $? -ne 0 ] && echo "Install %s failed" && exit 1\n' %
-                    pkg)
+        if packages:
+            fallback = ''.join(_install_one(pkg) for pkg in packages)
+            if batch and len(packages) > 1:
+                install.write(_batchtemplate.format(
+                    what='Installing %d packages' % len(packages),
+                    install='%s --reinstall %s %s' % (
+                        _aptget_install, _defer_triggers, ' '.join(packages)),
+                    fallback=fallback))
+            else:
+                install.write(fallback)
 
         tasks = getattr(args, 'tasks', None)
         install.write('\n# Tasks: %s\n' % tasks)
         if tasks is not None:
-            for task in tasks.split(','):
-                install.write(
-                    '\necho -e "\\n---------- Executing task  %s\\n"\n' % task)
-                cmd = 'tasksel install %s\n' % task
-                install.write(cmd)
-                # Things from the repo OUGHT to work.
-                install.write(
-                    '[ $? -ne 0 ] && echo "Tasksel %s failed" && exit 1' %
-                    task)
+            tasks = tasks.split(',')
+            fallback = ''.join(_tasksel_one(task) for task in tasks)
+            if batch and len(tasks) > 1:
+                install.write(_batchtemplate.format(
+                    what='Installing packages of %d tasks' % len(tasks),
+                    install=_tasks_batch.format(
+                        tasks=' '.join(tasks),
+                        install='%s %s' % (_aptget_install, _defer_triggers)),
+                    fallback=fallback))
+            else:
+                install.write(fallback)
 
         # These are one-offs so relax the expectation of correctness
         if downloads is not None:
@@ -770,10 +952,16 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
         install.write('\necho systemctl status says...\n')
         install.write('\nsystemctl status\n')
         install.write('\necho chroot installer complete at `date`\n')
+        if use_debcache:
+            install.write(_debcache_harvest.format(
+                deb_cache.incoming_dir(os.getpid())))
         install.write('\nexec apt-get clean\n')     # Final exit value
 
     os.chmod(script_file, 0o744)
 
+    archives = args.new_fs_dir + '/var/cache/apt/archives'
+    debmount = args.new_fs_dir + deb_cache.CHROOT_PATH
+    debcache = contextlib.ExitStack()       # Holds the .deb cache lock
     try:
         procmount = args.new_fs_dir + '/proc'
         os.makedirs(procmount, exist_ok=True)
@@ -789,6 +977,20 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
 
         umount = 'umount -fl %s %s' % (procmount, ptsmount)
 
+        if use_debcache:
+            debcache.enter_context(deb_cache.in_use(args.deb_cache))
+            os.makedirs(debmount, exist_ok=True)
+            ret, stdout, sterr = core_utils.piper(
+                'mount -obind %s %s' % (args.deb_cache, debmount))
+            assert not ret, 'Cannot bind mount %s' % args.deb_cache
+            umount += ' ' + debmount
+
+        prefetch_debs(args, packages, deb_cache.pool_dir(args.deb_cache)
+                      if use_debcache else archives)
+        if use_debcache:
+            update_status(args, 'Seeded %d .debs from %s' % (
+                deb_cache.seed(args.deb_cache, archives), args.deb_cache))
+
         # In case the script never gets to run.
         with open(log_file, 'w') as prelog:
             prelog.write(
@@ -808,6 +1010,14 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
                 stdouterr += str(stderr) + '\n'
             raise RuntimeError(
                 'chroot install.sh retval=%d: %s' % (ret, stdouterr))
+
+        if use_debcache:
+            accepted, rejected = deb_cache.ingest(args.deb_cache, os.getpid(),
+                args.new_fs_dir + '/var/lib/apt/lists')
+            deb_cache.touch_installed(args.deb_cache,
+                args.new_fs_dir + '/var/lib/dpkg/status')
+            update_status(args, 'Added %d new .debs to %s (%d rejected)' % (
+                accepted, args.deb_cache, rejected))
         return True     # but see finally
     except Exception as err:
         args.logger.error( '%s' % (err))
@@ -817,6 +1027,14 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
     finally:
         umountret, _, _ = core_utils.piper(umount)
         utils.kill_chroot_daemons(args.build_dir)
+        if use_debcache:
+            deb_cache.unseed(archives)
+            try:
+                os.removedirs(debmount)     # Keep it out of the cpio
+            except OSError:
+                pass
+            debcache.close()
+            deb_cache.evict(args.deb_cache, args.deb_cache_mb)
     return False
 
 
@@ -842,8 +1060,15 @@ def customize_grub(args):
         from tmms.templates import networking
     except ImportError as err:
         raise RuntimeError('Failed to import grub template for networking configs!')
+    images_dir = '/images/' + args.hostname
+    initrds = [ '%s/%s' % (images_dir,
+                initramfs.filename(args.hostname, initramfs_codec(args))) ]
+    if getattr(args, 'initrd_base', None) is not None:
+        initrds.insert(0, '/images/%s/%s' % (
+            initramfs.BASE_DIR, os.path.basename(args.initrd_base)))
     grub_menu = networking.grub_menu.render(hostname=args.hostname,
-                                images_dir='/images/' + args.hostname,
+                                images_dir=images_dir,
+                                initrds=initrds,
                                 append=kernel_cmd)
     destination = args.tftp_dir + '/../../grub/menus/' + args.hostname + '.menu'
     with open(destination, 'w') as file_obj:
@@ -852,6 +1077,20 @@ def customize_grub(args):
 #==============================================================================
 
 
+def build_slot(args, kind):
+    """
+        Hold one of the server-wide "io" (golden image extraction and
+    shared steps) or "cpu" (compression) slots for the next phase.
+
+    :param 'args.slots_dir': [str] slot lock files, None for no limit.
+    :param 'args.io_slots', 'args.cpu_slots': [int] 0 for no limit.
+    """
+    return scheduler.slot(getattr(args, 'slots_dir', None), kind,
+        getattr(args, kind + '_slots', 0) or 0,
+        waiting=lambda: update_status(args,
+            'Waiting for a free %s slot' % kind.upper()))
+
+
 def update_status(args, message, status='building'):
     """
         Update status of the node at the given state in its tftp/images/nodeX
@@ -882,28 +1121,55 @@ def update_status(args, message, status='building'):
     response['DhcpClientId'] = getattr(args, 'DhcpClientId', 'Not set')
     response['node_id'] = getattr(args, 'node_id', 'Not set')
     response['hostname'] = args.hostname
+    if getattr(args, 'job_id', None) is not None:
+        response['job_id'] = args.job_id
+    if getattr(args, 'queue_position', None) is not None:
+        response['queue_position'] = args.queue_position
+
+    # Machine-readable progress for the bulk status API
+    stages = getattr(args, 'build_stages', None)
+    if getattr(args, 'queue_position', None) is not None:
+        response['stage'] = 'queued'
+    elif stages is not None and stages.current is not None:
+        response['stage'] = stages.current
+    else:
+        response['stage'] = 'preparing' if status == 'building' else status
+    if stages is not None:
+        response['started'] = stages.started
+    response['updated'] = time.time()
 
     # Rally DE118: make it an atomic update
     newstatus = args.status_file + '.new'
     file_utils.write_to_file(newstatus, json.dumps(response, indent=4))
     os.replace(newstatus, args.status_file)
 
+    # status.json is what counts; the history is for the server and reports
+    if getattr(args, 'history', None):
+        try:
+            history.open_history(args.history).transition(
+                args.node_coord, response)
+        except (history.Error, OSError) as err:
+            args.logger.warning('Could not record status history: %s' % err)
+
 #=============================================================================
 # ESP == EFI System Partition, where EFI wants to scan for FS0:.
+# tftp_dir has "images/nodeZZ" tacked onto it from caller.
+# Grub itself is pulled live from a fixed location.
+# Plain grubaa64.efi was built with prefix "/EFI/debian" as opposed
+# to the '/grub' of grubnetaa64.efi.  In either case, grub[net]aa64.efi
+# turns around and grabs <prefix>/grub.cfg, where "prefix" was set at
+# grub construction.
 
 
-def create_ESP(args, blockdev, vmlinuz, cpio):
-    update_status(args, 'Creating and filling ESP')
-    ESP_mnt = '%s/mnt' % (args.build_dir)   # Going to be a VFAT FS image
-    file_utils.remove_target(ESP_mnt)
-    os.makedirs(ESP_mnt)
+def ESP_files(tftp_dir, vmlinuz, cpio):
+    """
+        What goes into the ESP: the EFI default startup script at /, the
+    grub stuff under "prefix".
 
-    # tftp_dir has "images/nodeZZ" tacked onto it from caller.
-    # Grub itself is pulled live from a fixed location.
-    # Plain grubaa64.efi was built with prefix "/EFI/debian" as opposed
-    # to the '/grub' of grubnetaa64.efi.  In either case, grub[net]aa64.efi
-    # turns around and grabs <prefix>/grub.cfg, where "prefix" was set at
-    # grub construction.
+    :param 'tftp_dir': [str] the node's TFTP directory.
+    :param 'cpio': [list] cpio paths in boot order.
+    :return: [list] of (path in the ESP, file name or bytes)
+    """
     follow_Linns_advice = True
     if follow_Linns_advice:
         grubbase = 'grubaa64.efi'
@@ -911,53 +1177,27 @@ def create_ESP(args, blockdev, vmlinuz, cpio):
     else:
         grubbase = 'grubnetaa64.efi'    # gzipped files still choke it
         prefix = '/grub'
-    getgrub = '/'.join(args.tftp_dir.split('/')[:-2]) + '/grub/%s' % grubbase
-    grubdir = ESP_mnt + prefix
-
-    undo_mount = False
-    try:
-        # This happens on containers. I think I solved it but paranoia is ok.
-        assert os.path.exists(blockdev), \
-            'Cannot find mapper file %s' % blockdev
-
-        cmd = 'mkfs.vfat ' + blockdev
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-        # Step 3: Make, mount, and fill the VFAT FS.  The EFI default startup
-        # script goes at /, but the grub stuff lives under "prefix".
-
-        cmd = 'mount %s %s' % (blockdev, ESP_mnt)
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-        undo_mount = True
-        update_status(args, 'SDHC GRUB DIR established at %s' % grubdir)
-
-        # The EFI directory separator is backslash, while grub is forward.
-        with open(ESP_mnt + '/startup.nsh', 'w') as f:
-            f.write(prefix.replace('/', '\\') + '\\%s\n' % grubbase)
-        os.makedirs(grubdir)
-        shutil.copy(vmlinuz, grubdir)
-        shutil.copy(cpio, grubdir)
-        shutil.copy(getgrub, grubdir)
-
-        with open(grubdir + '/grub.cfg', 'w') as f:
-            # Originally for SNBU but worth keeping
-            f.write('set debug=linux,linuxefi,efi\n')
-            f.write('set pager=1\n')
-            f.write('linux %s/%s\n' % (prefix, os.path.basename(vmlinuz)))
-            f.write('initrd %s/%s\n' % (prefix, os.path.basename(cpio)))
-            f.write('boot\n')
-
-    except Exception as e:
-        pass    # Just keep it here
-
-    if undo_mount:
-        cmd = 'umount ' + ESP_mnt
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-    return undo_mount   # suppress final copy if this didn't work
+    getgrub = '/'.join(tftp_dir.split('/')[:-2]) + '/grub/%s' % grubbase
+    assert os.path.isfile(getgrub), 'Missing %s' % getgrub
+
+    grub_cfg = [
+        'set debug=linux,linuxefi,efi',     # Originally for SNBU but worth keeping
+        'set pager=1',
+        'linux %s/%s' % (prefix, os.path.basename(vmlinuz)),
+        'initrd %s' % ' '.join('%s/%s' % (
+            prefix, os.path.basename(cpio_file)) for cpio_file in cpio),
+        'boot',
+    ]
+    # The EFI directory separator is backslash, while grub is forward.
+    files = [
+        ('startup.nsh', (prefix.replace('/', '\\') + '\\%s\n' % grubbase).encode()),
+        (prefix + '/' + os.path.basename(vmlinuz), vmlinuz),
+    ]
+    files.extend((prefix + '/' + os.path.basename(cpio_file), cpio_file)
+                 for cpio_file in cpio)
+    files.append((prefix + '/' + grubbase, getgrub))
+    files.append((prefix + '/grub.cfg', ('\n'.join(grub_cfg) + '\n').encode()))
+    return files
 
 #=============================================================================
 # SNBU == Single Node Bringup, the first turnon of node boards.
@@ -966,91 +1206,92 @@ def create_ESP(args, blockdev, vmlinuz, cpio):
 # Most cpio.gz are under 200M, vmlinuz.gz under 7M, so this leaves
 # at least 50M of space for copying log files, etc.  SNBU shouldn't
 # make all that much data, he says with a smile.
+# The GPT and FAT32 are written straight into the image file (esp_image.py):
+# no parted/kpartx/mkfs.vfat/mount, so no loop devices to run out of.
+# Few nodes ever need one, so a build only records what the image is made
+# of; the first download builds it and later ones get the cached copy until
+# the inputs change.
+
+whitney_FW_image = True     # FW updates for Whitney need 128M hole
+if whitney_FW_image:
+    SNBU_SIZE_MB = 384
+    SNBU_ESP_OFFSET_MB = 129
+else:
+    SNBU_SIZE_MB = 256          # Downloads and boots much faster
+    SNBU_ESP_OFFSET_MB = 1
+
+
+def record_SNBU_inputs(args, vmlinuz, cpio):
+    """
+        Remember the kernel and cpio files for SNBU_image() and drop any
+    image built from an earlier binding.
+    """
+    ESP_target = '%s/%s.ESP' % (args.tftp_dir, args.hostname)
+    for stale in glob.glob(ESP_target + '*'):
+        os.unlink(stale)
+    file_utils.write_to_file(ESP_target + '.json',
+                             json.dumps({ 'vmlinuz': vmlinuz, 'cpio': cpio }))
+
+
+def _SNBU_digest(files):
+    '''Identity of an ESP: names plus content (bytes) or size/mtime (files).'''
+    digest = hashlib.sha256()
+    for path, source in files:
+        digest.update(path.encode() + b'\0')
+        if isinstance(source, bytes):
+            digest.update(source)
+        else:
+            st = os.stat(source)
+            digest.update(('%s:%d:%d:%d' % (
+                source, st.st_ino, st.st_size, st.st_mtime_ns)).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
 
 
-def create_SNBU_image(args, vmlinuz, cpio):
-    update_status(args, 'Building SNBU SDHC image')
-    ESP_img = '%s/%s.ESP' % (args.build_dir, args.hostname)
-    ESP_target = '%s/%s' % (args.tftp_dir, ESP_img)     # node-specific by now
-    if os.path.exists(ESP_target):                      # shutil.copy below
-        os.unlink(ESP_target)
-
-    # Step 1: create the image file, burn GPT and ESP on it.
+def SNBU_image(tftp_dir, hostname, journal=None):
+    """
+        The SNBU SDHC/USB image of a node, built now if there isn't one for
+    its current kernel and cpio files.  Concurrent callers wait for one
+    build.
 
-    whitney_FW_image = True     # FW updates for Whitney need 128M hole
-    if whitney_FW_image:
-        img_size = 384 << 20
-        ESP_offset = 129
-    else:
-        img_size = 256 << 20    # Downloads and boots much faster
-        ESP_offset = 1
-
-    with open(ESP_img, 'wb') as f:
-        os.posix_fallocate(f.fileno(), 0, img_size)
-    undo_kpartx = do_copy = False     # until I make it that far.
-
-    try:    # piper catches many things, asserts get me out early
-        cmd = 'parted -s %s ' % ESP_img    # Yes, -s goes right here
-        cmd += 'mklabel gpt '
-        cmd += 'unit MiB mkpart primary fat32 %d 100%% ' % ESP_offset
-        cmd += 'set 1 boot on set 1 esp on '
-        cmd += 'name 1 %s ' % args.hostname
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-        # Step 2: located the partition and create a block device.
-        # Ass-u-me enough loopback devics to go around.
-
-        cmd = 'kpartx -asv %s' % ESP_img
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-        undo_kpartx = True
-        stdout = stdout.decode()
-        assert stdout.startswith('add map loop'), \
-            'Unexpected kpartx output: %s' % stdout
-        blockdev = '/dev/mapper/' + stdout.split()[2]
-        assert blockdev.endswith('p1'), \
-            'Unexpected kpartx partition: %s' % blockdev
-
-        # Step 3: fill it out
-
-        do_copy = create_ESP(args, blockdev, vmlinuz, cpio)
-
-    except AssertionError as e:
-        args.logger.error('%s failed:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-    except RuntimeError as e:
-        args.logger.error('%s:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-    except Exception as e:
-        args.logger.critical('%s:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-
-    if undo_kpartx:
-        # Sometimes this fails, especially with overloaded/underpowered
-        # server and "setnodes all".   Early in diagnosis, not sure what
-        # to do about it.   Just move along for now and see what happens
-        cmd = 'kpartx -d %s' % ESP_img
-        ret, stdout, stderr = core_utils.piper(cmd)
-        # assert not ret, cmd
-        if ret or stderr:
-            args.logger.warning('kpartx -d returned %d:\n - %s' % (ret, stderr))
-
-    if do_copy:
+    :param 'tftp_dir': [str] the node's TFTP directory.
+    :param 'journal': [str] metrics journal to record a build in.
+    :return: [str] path of the image, None if the node was never built.
+    """
+    ESP_target = '%s/%s.ESP' % (tftp_dir, hostname)
+    try:
+        with open(ESP_target + '.json', 'r') as f:
+            inputs = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    files = ESP_files(tftp_dir, inputs['vmlinuz'], inputs['cpio'])
+    digest = _SNBU_digest(files)
+
+    with open(ESP_target + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)    # released on close
         try:
-            shutil.copy(ESP_img, args.tftp_dir)
+            with open(ESP_target + '.key', 'r') as f:
+                built = f.read().strip()
         except OSError:
-            return
-        except Exception as err:
-            msg = ' - ERROR - Unexpected error duing create_SNBU_image:'
-            msg += '\n -- last step duing shutil.copy: %s' % err;
-            update_status(args, msg)
-            return
+            built = None
+        if built != digest or not os.path.isfile(ESP_target):
+            stages = metrics.Stages(own_process=False)    # in the server
+            with stages.stage('esp'):
+                esp_image.write_image(ESP_target, files,
+                                      size_mb=SNBU_SIZE_MB,
+                                      esp_offset_mb=SNBU_ESP_OFFSET_MB,
+                                      name=hostname)
+            file_utils.write_to_file(ESP_target + '.key', digest)
+            metrics.record(stages.todict(hostname=hostname, kind='esp'),
+                           journal=journal)
+    return ESP_target
 
 #=============================================================================
-# This is just as fast as gzip standalone program and gives better error
-# handling.  500M cpio file takes about 20 seconds for reduction to 180M.
-# Use gzip command's default compression level (6).  For 180M (base) FS:
+# Single-threaded python gzip was just as fast as the gzip standalone program
+# and gave better error handling: a 500M cpio took about 20 seconds for
+# reduction to 180M.  pgzip spreads that over COMPRESS_THREADS cores, and the
+# kernel is compressed alongside the cpio.  Output is still one ordinary gzip
+# member at gzip command's default compression level (6).  For 180M (base) FS:
 # TMAS PXE is about 100 MB / hour xfer then 500 seconds to uncompress
 #          so about two hours to boot
 # FAME PXE is about   6 MB / sec  xfer then  30 seconds to uncompress
@@ -1078,25 +1319,29 @@ def _is_gzipped(fname):
         raise RuntimeError('Failed in _is_gzipped(%s)! Error: %s' % (fname, err))
 
 
-def compress_bootfiles(args, cpio_file):
-    update_status(args, 'Compressing kernel and file system')
+def _compress_kernel(args):
     vmlinuz_gzip = args.tftp_dir + '/' + args.hostname + '.vmlinuz.gz'
     if _is_gzipped(args.vmlinuz_golden):
         shutil.copy(args.vmlinuz_golden, vmlinuz_gzip)
     else:
-        with open(args.vmlinuz_golden, 'rb') as f_in:
-            with gzip.open(vmlinuz_gzip, mode='wb', compresslevel=6) as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        pgzip.compress_file(args.vmlinuz_golden, vmlinuz_gzip, compresslevel=6,
+                            threads=getattr(args, 'compress_threads', None))
+    return vmlinuz_gzip
 
-    cpio_gzip = args.tftp_dir + '/' + os.path.basename(cpio_file) + '.gz'
-    if _is_gzipped(cpio_file):
-        shutil.copy(cpio_file, cpio_gzip)
-    else:
-        with open(cpio_file, 'rb') as f_in:
-            with gzip.open(cpio_gzip, mode='wb', compresslevel=6) as f_out:
-                shutil.copyfileobj(f_in, f_out)
 
-    return vmlinuz_gzip, cpio_gzip
+def compress_bootfiles(args):
+    """
+        Compress the kernel (block-parallel gzip, grub wants that) and stream
+    the file system cpio into the TFTP directory at the same time.
+
+    :return: [tuple] (vmlinuz_gzip path, list of cpio paths).
+    """
+    update_status(args, 'Compressing kernel and file system')
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        kernel = pool.submit(_compress_kernel, args)
+        cpio_files = create_cpio(args)
+        vmlinuz_gzip = kernel.result()
+    return vmlinuz_gzip, cpio_files
 
 
 def get_foreign_from_vmd(args):
@@ -1110,6 +1355,60 @@ def get_foreign_from_vmd(args):
 #==============================================================================
 
 
+def customize_shared(args, keep_kernel):
+    """
+        Everything that only depends on the manifest, not on the node: APT
+    setup, package installation and the boot file shuffle.  The result
+    may be cached and cloned for other nodes (see image_cache.py), so
+    nothing here may use hostname, node_id, DhcpClientId or keys.
+    """
+    # Move kernel that comes with golden image.
+    extract_bootfiles(args, keep_kernel)
+
+    set_foreign_package(args, 'qemu-aarch64-static')
+
+    # Golden image contrived args has no "manifest" attribute.  Besides,
+    # a manifest should not contain distro-specific data structures.
+    cleanup_sources_list(args)
+    set_apt_proxy(args)
+    add_other_mirror(args)
+
+    # Global and account config files
+    set_resolv_conf(args)
+
+    set_environment(args)
+    set_sudo(args)
+
+    install_packages(args)
+
+    #Move installed "kernel" from boot/ (if any).
+    extract_bootfiles(args, keep_kernel)
+    assert args.vmlinuz_golden, 'No golden/add-on kernel can be found'
+
+    persist_initrd(args)
+
+    localhost2torms(args)
+
+
+def customize_per_node(args):
+    """
+        The cheap steps that differ per node, run on a private clone of the
+    shared tree.  sources.list and /etc/environment are rewritten so their
+    "Created by TMMS for <hostname>" headers are right.
+    """
+    cleanup_sources_list(args)
+    set_environment(args)
+    set_hostname(args)
+    set_hosts(args)
+    set_client_id(args)
+    set_sshkeys(args)
+
+    hack_LFS_autostart(args)    # Temporary; must come before...
+    rewrite_rclocal(args)
+
+#==============================================================================
+
+
 def execute(args):
     """
         Customize Filesystem image: set hostname, cleanup sources.list,
@@ -1146,7 +1445,7 @@ def execute(args):
 
     logger = getattr(args, 'logger', None)
 
-    if not args.debug:
+    if not args.debug and not getattr(args, 'scheduled', False):
         # Ass-u-me I am the first child in a fork-setsid-fork daemon chain
         try:
             os.chdir('/tmp')
@@ -1189,42 +1488,38 @@ def execute(args):
     # It's a big try block because individual exception handling
     # is done inside those functions that throw RuntimeError.
     # When some of them fail they'll handle last update_status themselves.
+    stages = args.build_stages = metrics.Stages()
+    artifacts = []
     try:
-        update_status(args, 'Untar golden image')
-        args.new_fs_dir = core_utils.untar(args.build_dir + '/untar/', args.golden_tar)
-
-        # Move kernel that comes with golden image.
-        extract_bootfiles(args, is_keep_kernel)
-
-        set_foreign_package(args, 'qemu-aarch64-static')
-
-        # Golden image contrived args has no "manifest" attribute.  Besides,
-        # a manifest should not contain distro-specific data structures.
-        cleanup_sources_list(args)
-        set_apt_proxy(args)
-        add_other_mirror(args)
-
-        # Global and account config files
-        set_resolv_conf(args)
-
-        set_environment(args)
-        set_hostname(args)
-        set_hosts(args)
-        set_client_id(args)
-        set_sudo(args)
-        set_sshkeys(args)
-
-        install_packages(args)
-
-        #Move installed "kernel" from boot/ (if any).
-        extract_bootfiles(args, is_keep_kernel)
-        assert args.vmlinuz_golden, 'No golden/add-on kernel can be found'
-
-        persist_initrd(args)
-
-        localhost2torms(args)
-        hack_LFS_autostart(args)    # Temporary; must come before...
-        rewrite_rclocal(args)
+        progress = lambda nbytes, seconds: update_status(args,
+            'Extracting golden image: %d MB at %.1f MB/s' % (
+                nbytes >> 20, (nbytes >> 20) / max(seconds, 0.001)))
+
+        def build_shared(shared):
+            with stages.stage('shared'):
+                customize_shared(shared, is_keep_kernel)
+
+        # "provision" includes "shared" when it builds the shared image
+        with build_slot(args, 'io'), stages.stage('provision'):
+            update_status(args, 'Provision root file system from golden image')
+            if image_cache.enabled(args):
+                args.new_fs_dir = image_cache.provision(args, build_shared,
+                    progress=progress,
+                    waiting=lambda: update_status(args,
+                        'Waiting for another node to build the shared image'))
+                update_status(args, 'Shared image %s %s (%s)' % (
+                    args.image_cache_key,
+                    'reused' if args.image_cache_hit else 'built',
+                    args.rootfs_backend_used))
+            else:
+                args.new_fs_dir = rootfs.provision(args, progress=progress)
+                update_status(args, 'Root file system ready (%s)' % args.rootfs_backend_used)
+                build_shared(args)
+
+        with build_slot(args, 'cpu'), stages.stage('base_cpio'):
+            create_base_cpio(args)
+        with stages.stage('per_node'):
+            customize_per_node(args)
 
         #------------------------------------------------------------------
 
@@ -1232,9 +1527,10 @@ def execute(args):
             response['message'] = 'Golden image ready for use'
             status = 'ready'
         else:
-            cpio_file = create_cpio(args)
-            vmlinuz_gzip, cpio_gzip = compress_bootfiles(args, cpio_file)
-            create_SNBU_image(args, vmlinuz_gzip, cpio_gzip)
+            with build_slot(args, 'cpu'), stages.stage('compress'):
+                vmlinuz_gzip, cpio_files = compress_bootfiles(args)
+            artifacts = [ vmlinuz_gzip ] + list(cpio_files)
+            record_SNBU_inputs(args, vmlinuz_gzip, cpio_files)
 
             # Free up space someday, but not during active development
             # remove_target(args.build_dir)
@@ -1245,7 +1541,8 @@ def execute(args):
                                 args.tftp_dir + '/' + manifest_tftp_file)
 
             update_status(args, 'Updating grub menu for the node.')
-            customize_grub(args)
+            with stages.stage('grub'):
+                customize_grub(args)
 
             response['message'] = 'PXE files ready to boot'
             status = 'ready'
@@ -1264,6 +1561,24 @@ def execute(args):
             (os.path.basename(__file__), sys.exc_info()[2].tb_lineno, str(err))
         status = 'error'
 
+    try:
+        metrics.record(stages.todict(hostname=args.hostname, result=status,
+                            image_cache_hit=getattr(args, 'image_cache_hit', None)),
+                       per_build=args.build_dir + '/metrics.json',
+                       journal=getattr(args, 'metrics_journal', None))
+    except OSError as err:
+        args.logger.warning('Could not record build metrics: %s' % str(err))
+
+    if getattr(args, 'history', None):
+        try:
+            history.open_history(args.history).finish(
+                args.node_coord, status, response['message'],
+                started=stages.started,
+                artifact_bytes=sum(os.path.getsize(artifact)
+                    for artifact in artifacts if os.path.isfile(artifact)))
+        except (history.Error, OSError) as err:
+            args.logger.warning('Could not record build history: %s' % str(err))
+
     args.logger.propagate = True   # push final messages to root logger
     update_status(args, response, status)
     if not args.debug:  # I am the grandhild; release the wait() by init()
@@ -1304,6 +1619,39 @@ if __name__ == '__main__':
                         help='Scratch folder for building FS images.')
     parser.add_argument('--tftp_dir', default=None,
                         help='Absolute path to the dnsmasq TFTP folder.')
+    parser.add_argument('--rootfs_backend', default='auto',
+                        help='How to provision untar/: %s or auto.' % (
+                            ', '.join(rootfs.BACKENDS)))
+    parser.add_argument('--image_cache', default=None,
+                        help='Directory of shared post-install images.')
+    parser.add_argument('--image_cache_mb', type=int, default=0,
+                        help='Disk budget of image_cache, 0 disables it.')
+    parser.add_argument('--deb_cache', default=None,
+                        help='Shared .deb cache directory on this host.')
+    parser.add_argument('--deb_cache_mb', type=int, default=0,
+                        help='Disk budget of deb_cache, 0 disables it.')
+    parser.add_argument('--prefetch', default=None,
+                        help='JSON list of .debs to download before the chroot.')
+    parser.add_argument('--compress_threads', type=int, default=None,
+                        help='Threads for boot file compression, default all cores.')
+    parser.add_argument('--initramfs_codec', default=initramfs.DEFAULT,
+                        help='cpio compression: %s.' % ', '.join(sorted(initramfs.CODECS)))
+    parser.add_argument('--layered_initramfs', default=False,
+                        type=lambda val: val.lower() not in ('false', '0'),
+                        help='Shared base cpio plus a per-node one (needs image_cache).')
+    parser.add_argument('--metrics_journal', default=None,
+                        help='Append the per-stage build metrics to this file.')
+    parser.add_argument('--history', default=None,
+                        help='SQLite file of bindings and build history.')
+    parser.add_argument('--slots_dir', default=None,
+                        help='Lock files shared with other builds for --io_slots and --cpu_slots.')
+    parser.add_argument('--io_slots', type=int, default=0,
+                        help='Builds extracting at once, 0 for no limit.')
+    parser.add_argument('--cpu_slots', type=int, default=0,
+                        help='Builds compressing at once, 0 for no limit.')
+    parser.add_argument('--install_batch', default=True,
+                        type=lambda val: val.lower() not in ('false', '0'),
+                        help='One apt transaction for all packages/tasks.')
     parser.add_argument('-v', '--verbose',
                         help='Make it talk. Verbosity levels from 1 to 5',
                         action='store_true')
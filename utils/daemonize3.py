@@ -85,6 +85,16 @@ class Daemon(object):
             else:
                 raise RuntimeError('Failed to stop process %s!' % pid)
 
+    def reload(self):
+        """
+            Ask the daemon to reload itself (SIGHUP, see utils/serving.py).
+        Throw a RuntimeError if it isn't running.
+        """
+        pid = self.isAlive
+        if not pid:
+            raise RuntimeError('Daemon is not running. Nothing to reload.')
+        os.kill(pid, signal.SIGHUP)
+
     def status(self):
         """ Get status string of the daemon. """
         pid = self.isAlive
@@ -0,0 +1,252 @@
+#!/usr/bin/python3 -tt
+'''
+    Server-wide cache of .deb files shared by every node build chroot.
+
+    MANIFESTING_ROOT/debcache/
+        pool/               verified debs, named the way apt names them
+        incoming/<id>/      fresh downloads handed over by one install.sh
+        .lock               builds hold it shared, eviction exclusive
+
+install_packages() bind-mounts the cache at CHROOT_PATH (next to /proc and
+/dev/pts) and seeds /var/cache/apt/archives with symlinks into pool/, so
+apt finds those debs already "downloaded".  Before "apt-get clean" the
+script moves whatever apt really downloaded into incoming/<id>/; ingest()
+then checks size and SHA256 against the chroot's own APT indices and
+renames good ones into pool/.  Anything that doesn't check out is dropped.
+
+Standard python3 libraries only.
+'''
+
+import contextlib
+import fcntl
+import glob
+import gzip
+import hashlib
+import itertools
+import lzma
+import os
+
+from pdb import set_trace
+
+from . import file_utils
+
+CHROOT_PATH = '/var/cache/tmms/debs'
+
+_POOL = 'pool'
+_INCOMING = 'incoming'
+
+
+def enabled(args):
+    return bool(getattr(args, 'deb_cache', None) and
+                getattr(args, 'deb_cache_mb', 0))
+
+
+def deb_name(package, version, arch):
+    '''What apt calls the file in /var/cache/apt/archives.'''
+    return '%s_%s_%s.deb' % (package, version.replace(':', '%3a'), arch)
+
+
+@contextlib.contextmanager
+def in_use(cache_dir):
+    """
+        Hold the cache shared for the duration of a build so evict() leaves
+    it alone.  Creates the cache layout if needed.
+    """
+    for d in (_POOL, _INCOMING):
+        file_utils.make_dir('%s/%s' % (cache_dir, d))
+    with open(cache_dir + '/.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_SH)     # released on close
+        yield cache_dir
+
+
+def seed(cache_dir, archives):
+    """
+        Symlink every pooled deb into an apt archives directory.  The links
+    point through the bind mount so they resolve inside the chroot.
+
+    :param 'archives': [str] host path of the chroot's /var/cache/apt/archives
+    :return: [int] number of links made.
+    """
+    file_utils.make_dir(archives)
+    count = 0
+    with os.scandir('%s/%s' % (cache_dir, _POOL)) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.deb'):
+                continue
+            link = '%s/%s' % (archives, entry.name)
+            if os.path.lexists(link):
+                continue
+            os.symlink('%s/%s/%s' % (CHROOT_PATH, _POOL, entry.name), link)
+            count += 1
+    return count
+
+
+def unseed(archives):
+    '''Remove whatever seed() links apt-get clean didn't get to.'''
+    try:
+        with os.scandir(archives) as entries:
+            for entry in entries:
+                if (entry.is_symlink() and
+                    os.readlink(entry.path).startswith(CHROOT_PATH + '/')):
+                    os.unlink(entry.path)
+    except OSError:
+        pass
+
+
+def pool_dir(cache_dir):
+    return '%s/%s' % (cache_dir, _POOL)
+
+
+def incoming_dir(build_id):
+    '''Where install.sh (inside the chroot) puts new downloads.'''
+    return '%s/%s/%s' % (CHROOT_PATH, _INCOMING, build_id)
+
+
+def _open_index(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_indices(lists_dir):
+    """
+        Scan the Packages files apt left in a chroot's /var/lib/apt/lists.
+
+    :return: [dict] deb_name() -> (size, sha256)
+    """
+    checksums = {}
+    for path in glob.glob(lists_dir + '/*_Packages*'):
+        if not path.endswith(('_Packages', '.gz', '.xz')):
+            continue            # .lz4 and friends: nothing verified, no harm
+        stanza = {}
+        with _open_index(path) as f:
+            for line in itertools.chain(f, [ b'' ]):    # flush the last one
+                line = line.decode('utf-8', 'replace').rstrip('\n')
+                if not line:
+                    if 'SHA256' in stanza and 'Package' in stanza:
+                        checksums[deb_name(stanza['Package'],
+                            stanza.get('Version', ''),
+                            stanza.get('Architecture', ''))] = (
+                                int(stanza.get('Size', -1)), stanza['SHA256'])
+                    stanza = {}
+                    continue
+                if line[0] in ' \t':
+                    continue
+                key, _, value = line.partition(':')
+                if key in ('Package', 'Version', 'Architecture', 'Size', 'SHA256'):
+                    stanza[key] = value.strip()
+    return checksums
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ingest(cache_dir, build_id, lists_dir):
+    """
+        Move verified debs from incoming/<build_id> into the pool, drop the
+    rest.  rename() is atomic so concurrent builds never see half a file.
+
+    :param 'lists_dir': [str] host path of the chroot's /var/lib/apt/lists
+    :return: [tuple] (accepted, rejected) counts
+    """
+    incoming = '%s/%s/%s' % (cache_dir, _INCOMING, build_id)
+    if not os.path.isdir(incoming):
+        return 0, 0
+    checksums = read_indices(lists_dir)
+    accepted = rejected = 0
+    for name in os.listdir(incoming):
+        path = '%s/%s' % (incoming, name)
+        expected = checksums.get(name)
+        if (expected is not None and not os.path.islink(path) and
+            os.path.getsize(path) == expected[0] and
+            _sha256(path) == expected[1]):
+            os.rename(path, '%s/%s/%s' % (cache_dir, _POOL, name))
+            accepted += 1
+        else:
+            os.unlink(path)
+            rejected += 1
+    os.rmdir(incoming)
+    return accepted, rejected
+
+
+def installed(status_file):
+    """
+        Packages installed in a chroot.
+
+    :param 'status_file': [str] host path of the chroot's /var/lib/dpkg/status
+    :return: [dict] package -> (version, architecture)
+    """
+    result = {}
+    stanza = {}
+    try:
+        with open(status_file, 'r', errors='replace') as f:
+            lines = f.read().split('\n') + [ '' ]
+    except OSError:
+        return result
+    for line in lines:
+        if line:
+            key, _, value = line.partition(':')
+            if key in ('Package', 'Version', 'Architecture', 'Status'):
+                stanza[key] = value.strip()
+            continue
+        if stanza.get('Status', '').endswith(' installed'):
+            result[stanza.get('Package', '')] = (
+                stanza.get('Version', ''), stanza.get('Architecture', ''))
+        stanza = {}
+    return result
+
+
+def touch_installed(cache_dir, status_file):
+    """
+        Mark pooled debs of every package installed in a chroot as recently
+    used.  That's the LRU clock for evict().
+
+    :param 'status_file': [str] host path of the chroot's /var/lib/dpkg/status
+    """
+    pool = '%s/%s' % (cache_dir, _POOL)
+    for package, (version, arch) in installed(status_file).items():
+        try:
+            os.utime('%s/%s' % (pool, deb_name(package, version, arch)))
+        except OSError:
+            pass
+
+
+def evict(cache_dir, budget_mb):
+    """
+        Remove least recently used debs until the pool fits budget_mb.
+    Does nothing while any build holds the cache.
+
+    :return: [int] number of debs removed, None if the cache was busy.
+    """
+    lockname = cache_dir + '/.lock'
+    if not os.path.exists(lockname):
+        return 0
+    with open(lockname, 'a') as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+        debs = []
+        with os.scandir('%s/%s' % (cache_dir, _POOL)) as entries:
+            for entry in entries:
+                s = entry.stat(follow_symlinks=False)
+                debs.append((s.st_mtime, entry.path, s.st_size))
+        total = sum(size for _, _, size in debs)
+        removed = 0
+        for _, path, size in sorted(debs):
+            if total <= budget_mb << 20:
+                break
+            os.unlink(path)
+            total -= size
+            removed += 1
+        # Leftovers of builds that died before ingest()
+        for stale in os.listdir('%s/%s' % (cache_dir, _INCOMING)):
+            file_utils.remove_target('%s/%s/%s' % (cache_dir, _INCOMING, stale))
+    return removed
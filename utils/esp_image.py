@@ -0,0 +1,420 @@
+#!/usr/bin/python3 -tt
+'''
+    Write a GPT disk image with one FAT32 EFI System Partition straight into
+a file: no parted, kpartx, loop devices, device mapper, mkfs.vfat or mount.
+Builds can then make their SNBU images in parallel and inside containers.
+
+The image is laid out in one pass.  Everything that goes into the ESP is
+known up front, so directories and files get contiguous cluster runs, the
+FAT is a string of simple chains, and file data is copied to its final
+offset.  Unwritten space stays sparse.  Names that aren't plain 8.3 get
+VFAT long name entries (grub and EFI firmware both read those).
+
+Standard python3 libraries only.
+'''
+
+import os
+import struct
+import time
+import uuid
+import zlib
+
+from pdb import set_trace
+
+SECTOR = 512
+MiB = 1 << 20
+
+ESP_TYPE = uuid.UUID('C12A7328-F81F-11D2-BA4B-00A0C93EC93B')
+
+_GPT_ENTRIES = 128
+_GPT_ENTRY_SIZE = 128
+_GPT_SECTORS = _GPT_ENTRIES * _GPT_ENTRY_SIZE // SECTOR     # 32
+
+_RESERVED = 32          # FAT32 reserved sectors, boot sector backup at 6
+_MIN_CLUSTERS = 65525   # fewer and it's FAT16 by definition
+_EOC = 0x0FFFFFFF
+
+_ATTR_DIR = 0x10
+_ATTR_ARCHIVE = 0x20
+_ATTR_LFN = 0x0F
+
+_SHORT_OK = frozenset(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&')
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def _fat_datetime(when):
+    t = time.localtime(when)
+    year = min(max(t.tm_year, 1980), 2107)
+    date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    hms = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return date, hms
+
+#==============================================================================
+# Directory entries
+
+
+def _split(name):
+    if '.' in name.strip('.'):
+        base, ext = name.rsplit('.', 1)
+        return base, ext
+    return name, ''
+
+
+def _short_name(name, taken):
+    """
+        8.3 name for a directory entry.
+
+    :param 'taken': [set] short names already used in the directory.
+    :return: [tuple] (11-byte short name, NT case flags, True if it needs
+             long name entries)
+    """
+    base, ext = _split(name)
+    if (0 < len(base) <= 8 and len(ext) <= 3 and
+        all(c.upper() in _SHORT_OK for c in base + ext) and
+        base in (base.upper(), base.lower()) and
+        ext in (ext.upper(), ext.lower())):
+        short = ('%-8s%-3s' % (base.upper(), ext.upper())).encode('ascii')
+        if short not in taken:
+            flags = (0x08 if base != base.upper() else 0) | \
+                    (0x10 if ext != ext.upper() else 0)
+            return short, flags, False
+
+    clean = lambda s: ''.join(c if c in _SHORT_OK else '_'
+                              for c in s.upper().replace(' ', ''))
+    base, ext = clean(base.replace('.', '')), clean(ext)[:3]
+    for n in range(1, 1000000):
+        tail = '~%d' % n
+        short = ('%-8s%-3s' % (base[:8 - len(tail)] + tail, ext)).encode('ascii')
+        if short not in taken:
+            return short, 0, True
+    raise RuntimeError('Too many names like "%s"' % name)
+
+
+def _lfn_checksum(short):
+    total = 0
+    for c in short:
+        total = (((total & 1) << 7) + (total >> 1) + c) & 0xFF
+    return total
+
+
+def _lfn_entries(name, short):
+    '''Long name entries, in on-disk order (last piece first).'''
+    chars = name.encode('utf-16-le')
+    if len(chars) % 26:                 # exact fit needs no terminator
+        chars += b'\0\0'
+        chars += b'\xff' * (-len(chars) % 26)
+    pieces = [ chars[i:i + 26] for i in range(0, len(chars), 26) ]
+    checksum = _lfn_checksum(short)
+    entries = []
+    for seq, piece in enumerate(pieces, 1):
+        order = seq | (0x40 if seq == len(pieces) else 0)
+        entries.append(struct.pack('<B10sBBB12sH4s', order, piece[:10],
+                                   _ATTR_LFN, 0, checksum, piece[10:22],
+                                   0, piece[22:26]))
+    return entries[::-1]
+
+
+def _dir_entry(short, attr, flags, cluster, size, when):
+    date, hms = _fat_datetime(when)
+    return struct.pack('<11sBBBHHHHHHHI', short, attr, flags, 0, hms, date,
+                       date, cluster >> 16, hms, date, cluster & 0xFFFF, size)
+
+
+class _Node(object):
+    def __init__(self, name, source=None, is_dir=False):
+        self.name = name
+        self.source = source        # path or bytes for files
+        self.is_dir = is_dir
+        self.children = []
+        self.cluster = 0
+        self.nclusters = 0
+        if is_dir:
+            self.size = 0
+        elif isinstance(source, bytes):
+            self.size = len(source)
+        else:
+            self.size = os.path.getsize(source)
+
+
+def _tree(files):
+    root = _Node('', is_dir=True)
+    for path, source in files:
+        parts = [ p for p in path.split('/') if p ]
+        node = root
+        for part in parts[:-1]:
+            for child in node.children:
+                if child.name.lower() == part.lower() and child.is_dir:
+                    node = child
+                    break
+            else:
+                child = _Node(part, is_dir=True)
+                node.children.append(child)
+                node = child
+        assert not [ c for c in node.children
+                     if c.name.lower() == parts[-1].lower() ], \
+            'Duplicate ESP file %s' % path
+        node.children.append(_Node(parts[-1], source))
+    return root
+
+
+def _dir_entries(node, parent, when):
+    '''Bytes of a directory's cluster run, clusters already assigned.'''
+    entries = []
+    if parent is not None:      # not root
+        entries.append(_dir_entry(b'.          ', _ATTR_DIR, 0,
+                                  node.cluster, 0, when))
+        entries.append(_dir_entry(b'..         ', _ATTR_DIR, 0,
+                                  parent.cluster if parent.name else 0,
+                                  0, when))
+    taken = set()
+    for child in node.children:
+        short, flags, needs_lfn = _short_name(child.name, taken)
+        taken.add(short)
+        if needs_lfn:
+            entries.extend(_lfn_entries(child.name, short))
+        entries.append(_dir_entry(short,
+            _ATTR_DIR if child.is_dir else _ATTR_ARCHIVE,
+            flags, child.cluster, 0 if child.is_dir else child.size, when))
+    return b''.join(entries)
+
+#==============================================================================
+# Layout
+
+
+def _geometry(part_sectors):
+    '''FAT32 sectors per cluster, FAT size and cluster count for a partition.'''
+    for spc in (8, 4, 2, 1):
+        fatsz = 1
+        while True:
+            clusters = (part_sectors - _RESERVED - 2 * fatsz) // spc
+            need = ((clusters + 2) * 4 + SECTOR - 1) // SECTOR
+            if need <= fatsz:
+                break
+            fatsz = need
+        if clusters >= _MIN_CLUSTERS + 16:
+            return spc, fatsz, clusters
+    raise RuntimeError('%d sectors is too small for FAT32' % part_sectors)
+
+
+def _gpt(total_lbas, first, last, name, disk_guid, part_guid):
+    entry = struct.pack('<16s16sQQQ72s', ESP_TYPE.bytes_le, part_guid.bytes_le,
+                        first, last, 0, name.encode('utf-16-le')[:72])
+    entries = entry.ljust(_GPT_ENTRIES * _GPT_ENTRY_SIZE, b'\0')
+
+    def header(my_lba, alt_lba, entries_lba):
+        fields = [ b'EFI PART', 0x00010000, 92, 0, 0, my_lba, alt_lba,
+                   2 + _GPT_SECTORS, total_lbas - 2 - _GPT_SECTORS,
+                   disk_guid.bytes_le, entries_lba, _GPT_ENTRIES,
+                   _GPT_ENTRY_SIZE, _crc(entries) ]
+        fmt = '<8sIIIIQQQQ16sQIII'
+        fields[3] = _crc(struct.pack(fmt, *fields))
+        return struct.pack(fmt, *fields).ljust(SECTOR, b'\0')
+
+    # Protective MBR: one partition of type 0xEE covering the disk
+    mbr = bytearray(SECTOR)
+    mbr[446:462] = struct.pack('<B3sB3sII', 0, b'\x00\x02\x00', 0xEE,
+                               b'\xff\xff\xff', 1,
+                               min(total_lbas - 1, 0xFFFFFFFF))
+    mbr[510:512] = b'\x55\xaa'
+
+    primary = header(1, total_lbas - 1, 2)
+    backup = header(total_lbas - 1, 1, total_lbas - 1 - _GPT_SECTORS)
+    return [ (0, bytes(mbr)), (SECTOR, primary), (2 * SECTOR, entries),
+             ((total_lbas - 1 - _GPT_SECTORS) * SECTOR, entries),
+             ((total_lbas - 1) * SECTOR, backup) ]
+
+
+def _boot_sectors(part_first, part_sectors, spc, fatsz, free, next_free,
+                  volume_id, label):
+    bs = bytearray(SECTOR)
+    bs[0:3] = b'\xeb\x58\x90'
+    struct.pack_into('<8sHBHBHHBHHHIIIHHIHH', bs, 3, b'TMMS    ', SECTOR,
+                     spc, _RESERVED, 2, 0, 0, 0xF8, 0, 32, 64, part_first,
+                     part_sectors, fatsz, 0, 0, 2, 1, 6)
+    struct.pack_into('<BBBI11s8s', bs, 64, 0x80, 0, 0x29, volume_id,
+                     ('%-11s' % label.upper()[:11]).encode('ascii', 'replace'),
+                     b'FAT32   ')
+    bs[510:512] = b'\x55\xaa'
+
+    fsinfo = bytearray(SECTOR)
+    struct.pack_into('<I', fsinfo, 0, 0x41615252)
+    struct.pack_into('<III', fsinfo, 484, 0x61417272, free, next_free)
+    struct.pack_into('<I', fsinfo, 508, 0xAA550000)
+    return bytes(bs), bytes(fsinfo)
+
+
+def _copy(source, f, offset):
+    f.seek(offset)
+    if isinstance(source, bytes):
+        f.write(source)
+        return
+    with open(source, 'rb') as src:
+        while True:
+            chunk = src.read(MiB)
+            if not chunk:
+                break
+            f.write(chunk)
+
+
+def write_image(image, files, size_mb=384, esp_offset_mb=129, name='ESP',
+                when=None):
+    """
+        Create image (a regular file) holding a GPT with one FAT32 EFI
+    System Partition from esp_offset_mb to the last whole MiB, filled with
+    files.
+
+    :param 'files': [list] of (path in the ESP, source) where source is a
+                    file name or bytes.  Directories are implied.
+    :param 'name': [str] GPT partition name (hostname, like parted did).
+    :param 'when': [float] time stamp for the FAT entries, default now.
+    :return: [int] bytes of file data written.
+    """
+    when = time.time() if when is None else when
+    total_lbas = size_mb * MiB // SECTOR
+    part_first = esp_offset_mb * MiB // SECTOR
+    part_last = ((total_lbas - 1 - _GPT_SECTORS) // (MiB // SECTOR)) * \
+                (MiB // SECTOR) - 1
+    assert part_first < part_last, 'ESP offset beyond end of image'
+    part_sectors = part_last - part_first + 1
+    spc, fatsz, nclusters = _geometry(part_sectors)
+    cluster_bytes = spc * SECTOR
+    data_offset = (part_first + _RESERVED + 2 * fatsz) * SECTOR
+
+    # Directory sizes need the names, names need nothing else: lay out
+    # directories first (root at cluster 2), then file data.
+    root = _tree(files)
+    dirs, order = [ (root, None) ], []
+    while dirs:
+        node, parent = dirs.pop(0)
+        order.append((node, parent))
+        dirs.extend((c, node) for c in node.children if c.is_dir)
+    next_cluster = 2
+    for node, parent in order:
+        nbytes = len(_dir_entries(node, parent, when))
+        node.nclusters = max(1, (nbytes + cluster_bytes - 1) // cluster_bytes)
+        node.cluster = next_cluster
+        next_cluster += node.nclusters
+    files_in_order = []
+    for node, _ in order:
+        for child in node.children:
+            if not child.is_dir and child.size:
+                child.nclusters = (child.size + cluster_bytes - 1) // cluster_bytes
+                child.cluster = next_cluster
+                next_cluster += child.nclusters
+                files_in_order.append(child)
+    used = next_cluster - 2
+    if used > nclusters:
+        raise RuntimeError('ESP needs %d MB, partition has %d MB' % (
+            used * cluster_bytes >> 20, nclusters * cluster_bytes >> 20))
+
+    fat = bytearray(next_cluster * 4)
+    struct.pack_into('<II', fat, 0, 0x0FFFFFF8, _EOC)
+    for node in [ n for n, _ in order ] + files_in_order:
+        for c in range(node.cluster, node.cluster + node.nclusters):
+            last = c == node.cluster + node.nclusters - 1
+            struct.pack_into('<I', fat, c * 4, _EOC if last else c + 1)
+
+    bs, fsinfo = _boot_sectors(part_first, part_sectors, spc, fatsz,
+                               nclusters - used, next_cluster,
+                               _crc(('%s%f' % (name, when)).encode()), 'NO NAME')
+
+    tmp = '%s.tmp%d' % (image, os.getpid())
+    written = 0
+    try:
+        with open(tmp, 'wb') as f:
+            f.truncate(size_mb * MiB)
+            for offset, data in _gpt(total_lbas, part_first, part_last, name,
+                                     uuid.uuid4(), uuid.uuid4()):
+                f.seek(offset)
+                f.write(data)
+            part = part_first * SECTOR
+            for sector, data in ((0, bs), (1, fsinfo), (6, bs), (7, fsinfo)):
+                f.seek(part + sector * SECTOR)
+                f.write(data)
+            for copy in range(2):
+                f.seek(part + (_RESERVED + copy * fatsz) * SECTOR)
+                f.write(fat)
+            for node, parent in order:
+                f.seek(data_offset + (node.cluster - 2) * cluster_bytes)
+                f.write(_dir_entries(node, parent, when))
+            for node in files_in_order:
+                _copy(node.source, f,
+                      data_offset + (node.cluster - 2) * cluster_bytes)
+                written += node.size
+        os.replace(tmp, image)
+        return written
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+#==============================================================================
+# Reading it back, for tests and troubleshooting
+
+
+def read_file(image, path):
+    """
+        Contents of one file in the ESP of an image made by write_image().
+
+    :param 'path': [str] e.g. 'EFI/debian/grub.cfg', case-insensitive.
+    :return: [bytes] or None if there is no such file.
+    """
+    with open(image, 'rb') as f:
+        f.seek(2 * SECTOR)
+        entry = f.read(_GPT_ENTRY_SIZE)
+        first = struct.unpack_from('<Q', entry, 32)[0]
+        part = first * SECTOR
+        f.seek(part)
+        bs = f.read(SECTOR)
+        spc, reserved, nfats = struct.unpack_from('<BHB', bs, 13)
+        fatsz, _, _, root_cluster = struct.unpack_from('<IHHI', bs, 36)
+        cluster_bytes = spc * SECTOR
+        data_offset = part + (reserved + nfats * fatsz) * SECTOR
+
+        def chain(cluster, size=None):
+            data = b''
+            while 2 <= cluster < 0x0FFFFFF8:
+                f.seek(data_offset + (cluster - 2) * cluster_bytes)
+                data += f.read(cluster_bytes)
+                f.seek(part + reserved * SECTOR + cluster * 4)
+                cluster = struct.unpack('<I', f.read(4))[0] & 0x0FFFFFFF
+            return data if size is None else data[:size]
+
+        def listing(data):
+            lfn = {}
+            for i in range(0, len(data), 32):
+                e = data[i:i + 32]
+                if e[0] == 0:
+                    break
+                if e[0] == 0xE5:
+                    continue
+                if e[11] == _ATTR_LFN:
+                    piece = e[1:11] + e[14:26] + e[28:32]
+                    lfn[e[0] & 0x3F] = piece.decode('utf-16-le').split('\0')[0]
+                    continue
+                short = e[:11].decode('ascii')
+                base, ext = short[:8].rstrip(), short[8:].rstrip()
+                if e[12] & 0x08:
+                    base = base.lower()
+                if e[12] & 0x10:
+                    ext = ext.lower()
+                name = ''.join(lfn[k] for k in sorted(lfn)) if lfn else \
+                    base + ('.' + ext if ext else '')
+                lfn = {}
+                hi, lo, size = struct.unpack_from('<H4xHI', e, 20)
+                yield name, e[11], (hi << 16) | lo, size
+
+        data = chain(root_cluster)
+        parts = [ p for p in path.split('/') if p ]
+        for i, part_name in enumerate(parts):
+            for name, attr, cluster, size in listing(data):
+                if name.lower() == part_name.lower():
+                    break
+            else:
+                return None
+            if i == len(parts) - 1:
+                return None if attr & _ATTR_DIR else chain(cluster, size)
+            data = chain(cluster)
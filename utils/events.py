@@ -0,0 +1,78 @@
+#!/usr/bin/python3 -tt
+'''
+    Node status transitions for clients that want to be told instead of
+polling.  The status cache (status_cache.py) sees every status.json that
+update_status() writes and appends an event here; long-poll and SSE
+requests wait on the log.
+
+Sequence numbers increase by one per event and start at the server's
+start time in milliseconds, so they keep increasing across restarts.  A
+client resumes with the last one it saw ("since").  If that is older than
+what the log still holds, or from the future, it gets None and should
+start over from the current state.
+
+Standard python3 libraries only.
+'''
+
+import collections
+import threading
+import time
+
+from pdb import set_trace
+
+
+class EventLog(object):
+
+    def __init__(self, maxlen=10000, first_seq=None):
+        self.seq = int(time.time() * 1000) if first_seq is None else first_seq
+        self._events = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def close(self):
+        '''Release every waiter now, for a server that is shutting down.'''
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def append(self, event):
+        '''Stamp event (a dict) with the next seq and time, wake waiters.'''
+        with self._cond:
+            self.seq += 1
+            event = dict(event, seq=self.seq, time=time.time())
+            self._events.append(event)
+            self._cond.notify_all()
+            return self.seq
+
+    def _after(self, seq):
+        '''Events after seq, None if some of those were already dropped.'''
+        oldest = self._events[0]['seq'] if self._events else self.seq + 1
+        if seq > self.seq or seq < oldest - 1:
+            return None
+        first = seq + 1 - oldest    # seqs in the deque are consecutive
+        return [ self._events[i] for i in range(first, len(self._events)) ]
+
+    def since(self, seq, timeout=0.0, match=None):
+        """
+            Events after seq, waiting up to timeout seconds for one.
+
+        :param 'seq': [int] last seq the client saw, None for "now".
+        :param 'match': callable(event) to pick events of interest.
+        :return: [tuple] (current seq, list of events or None if seq
+                 can't be resumed).
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if seq is None:
+                return self.seq, None
+            while True:
+                events = self._after(seq)
+                if events is None:
+                    return self.seq, None
+                if match is not None:
+                    events = [ event for event in events if match(event) ]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0 or self.closed:
+                    return self.seq, events
+                seq = self.seq      # nothing of interest up to here
+                self._cond.wait(remaining)
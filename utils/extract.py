@@ -0,0 +1,271 @@
+#!/usr/bin/python3 -tt
+'''
+    Tarball extraction engine behind core_utils.untar().  tarfile.extractall
+spends most of its time on per-member metadata syscalls on a single thread.
+This streams the archive once (plain, gzip, xz, bzip2 or zstd compressed),
+creates directories as a batch, hands regular file writes to a thread pool
+and applies directory metadata last.  Hardlinks, symlinks, device nodes,
+FIFOs, numeric ownership and SCHILY.xattr.* (capabilities, ACLs) are kept.
+
+Standard python3 libraries only (see core_utils); zstd needs the "zstd"
+program since there is no zstd module in the python3 library.
+'''
+
+import concurrent.futures
+import errno
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import time
+
+from pdb import set_trace
+
+# Magic numbers, longest first matters only for readability.
+_MAGIC = (
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+)
+
+_SMALL_FILE = 1 << 20       # Bigger than this is written inline, in chunks
+_MAX_INFLIGHT = 64 << 20    # Bytes read but not yet written by the pool
+_XATTR_PREFIX = 'SCHILY.xattr.'
+
+
+def compression(path):
+    '''Return "zstd", "xz", "gzip", "bzip2" or None (plain tar).'''
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, name in _MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+class Extractor(object):
+    """
+        One extraction of one tarball into one destination directory.
+
+    :param 'destination': [str] directory to extract into; created if needed.
+    :param 'workers': [int] file writer threads.  Default: 2 per CPU, max 16.
+    :param 'progress': callable(nbytes, seconds) invoked every 'interval'
+                       seconds with the amount of member data extracted.
+    """
+
+    def __init__(self, destination, workers=None, progress=None, interval=5.0):
+        self.destination = os.path.realpath(destination)
+        if workers is None:
+            workers = min(16, 2 * (os.cpu_count() or 1))
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.interval = interval
+        self.is_root = os.geteuid() == 0
+        self.nbytes = 0
+        self._made_dirs = set()
+        self._dir_members = []
+        self._hardlinks = []
+
+    # Archive names are relative; anything trying to climb out is dropped.
+    def _target(self, name):
+        name = name.lstrip('/')
+        parts = [ p for p in name.split('/') if p not in ('', '.') ]
+        if '..' in parts:
+            return None
+        return os.path.join(self.destination, *parts)
+
+    def _makedirs(self, path):
+        if path in self._made_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        while path.startswith(self.destination) and path not in self._made_dirs:
+            self._made_dirs.add(path)
+            path = os.path.dirname(path)
+
+    def _unlink(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _set_attrs(self, member, path, fd=None):
+        '''Ownership, xattrs, permissions, times; in that order.'''
+        islink = member.issym()
+        if self.is_root:
+            try:
+                if fd is not None:
+                    os.fchown(fd, member.uid, member.gid)
+                else:
+                    os.chown(path, member.uid, member.gid,
+                             follow_symlinks=False)
+            except OSError:
+                pass
+        for key, value in member.pax_headers.items():
+            if not key.startswith(_XATTR_PREFIX):
+                continue
+            try:
+                os.setxattr(fd if fd is not None else path,
+                    key[len(_XATTR_PREFIX):],
+                    value.encode('utf-8', 'surrogateescape'),
+                    follow_symlinks=False if fd is None else True)
+            except OSError:     # No user.* on symlinks, no xattr on tmpfs...
+                pass
+        if islink:
+            try:
+                os.utime(path, (member.mtime, member.mtime),
+                         follow_symlinks=False)
+            except (OSError, NotImplementedError):
+                pass
+            return
+        if fd is not None:
+            os.fchmod(fd, member.mode)
+            os.utime(fd, (member.mtime, member.mtime))
+        else:
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+
+    def _open_new(self, path):
+        '''Never write through a symlink or into a directory left there.'''
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+        try:
+            return os.open(path, flags, 0o600)
+        except (IsADirectoryError, OSError) as err:
+            if not isinstance(err, IsADirectoryError) and \
+               err.errno != errno.ELOOP:
+                raise
+            self._unlink(path)
+            return os.open(path, flags, 0o600)
+
+    def _write_small(self, member, path, data):
+        fd = self._open_new(path)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            self._set_attrs(member, path, fd)
+        finally:
+            os.close(fd)
+        return len(data)
+
+    def _write_large(self, member, path, fileobj):
+        with open(self._open_new(path), 'wb') as f:
+            shutil.copyfileobj(fileobj, f, 1 << 20)
+            f.flush()
+            self._set_attrs(member, path, f.fileno())
+
+    def _report(self, start, last):
+        now = time.time()
+        if self.progress is not None and now - last >= self.interval:
+            self.progress(self.nbytes, now - start)
+            return now
+        return last
+
+    def _extract_stream(self, tar):
+        start = last = time.time()
+        inflight = []           # (future, nbytes)
+        inflight_bytes = 0
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for member in tar:
+                path = self._target(member.name)
+                if path is None:
+                    continue
+                if path != self.destination:
+                    self._makedirs(os.path.dirname(path))
+
+                if member.isdir():
+                    self._makedirs(path)
+                    self._dir_members.append((member, path))
+                elif member.isreg():
+                    fileobj = tar.extractfile(member)
+                    if member.size > _SMALL_FILE:
+                        self._write_large(member, path, fileobj)
+                    else:
+                        data = fileobj.read()
+                        inflight.append((pool.submit(
+                            self._write_small, member, path, data), len(data)))
+                        inflight_bytes += len(data)
+                    self.nbytes += member.size
+                elif member.islnk():
+                    target = self._target(member.linkname)
+                    if target is not None:
+                        self._hardlinks.append((member, path, target))
+                elif member.issym():
+                    if os.path.lexists(path):
+                        self._unlink(path)
+                    os.symlink(member.linkname, path)
+                    self._set_attrs(member, path)
+                elif member.ischr() or member.isblk() or member.isfifo():
+                    if os.path.lexists(path):
+                        self._unlink(path)
+                    try:
+                        if member.isfifo():
+                            os.mkfifo(path)
+                        else:
+                            kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                            os.mknod(path, kind | 0o600,
+                                     os.makedev(member.devmajor, member.devminor))
+                        self._set_attrs(member, path)
+                    except PermissionError:     # Not root or in a container
+                        pass
+
+                # Bound the memory held by file data waiting for the pool.
+                while inflight and (inflight_bytes > _MAX_INFLIGHT or
+                                    inflight[0][0].done()):
+                    future, nbytes = inflight.pop(0)
+                    future.result()             # re-raise writer errors here
+                    inflight_bytes -= nbytes
+                last = self._report(start, last)
+
+            for future, nbytes in inflight:
+                future.result()
+
+        # Every file now exists, so every hardlink target does too.
+        for member, path, target in self._hardlinks:
+            if os.path.lexists(path):
+                self._unlink(path)
+            os.link(target, path, follow_symlinks=False)
+
+        # Deepest first so read-only parents don't block their children,
+        # and mtimes aren't disturbed by later creation inside them.
+        for member, path in sorted(self._dir_members,
+                                   key=lambda mp: mp[1], reverse=True):
+            self._set_attrs(member, path)
+
+        if self.progress is not None:
+            self.progress(self.nbytes, time.time() - start)
+
+    def extract(self, source):
+        """
+            Extract tarball "source" into self.destination.
+
+        :param 'source': [str] path to a .tar, .tar.gz, .tar.xz or .tar.zst
+        :return: [int] bytes of file data extracted.
+        """
+        os.makedirs(self.destination, exist_ok=True)
+        self._made_dirs.add(self.destination)
+        if compression(source) != 'zstd':
+            with tarfile.open(source, mode='r|*') as tar:
+                self._extract_stream(tar)
+            return self.nbytes
+
+        try:
+            proc = subprocess.Popen(['zstd', '-dcq', source],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError('zstd is needed to extract %s' % source)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                self._extract_stream(tar)
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read()
+            proc.stderr.close()
+            ret = proc.wait()
+        if ret:
+            raise RuntimeError('zstd -d %s failed: %s' % (source, stderr))
+        return self.nbytes
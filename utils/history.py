@@ -0,0 +1,286 @@
+#!/usr/bin/python3 -tt
+'''
+    SQLite store of node bindings and their build history, kept in
+MANIFESTING_ROOT/history.sqlite.  status.json in each TFTP directory
+stays what the node boots by; this is what the server answers from and
+what survives a rebind.
+
+    bindings      one row per bound node: its latest status.json
+    builds        one row per bind: manifest, when it was bound, started
+                  and finished, duration, result and artifact bytes
+    transitions   every status update of every build
+
+The server records binds and unbinds, update_status() (in the server and
+in the forked builds) records transitions and execute() the outcome.  WAL
+mode lets all of them write while the server reads; every process and
+thread gets its own connection.
+
+Standard python3 libraries only.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from pdb import set_trace
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bindings (
+    node        TEXT PRIMARY KEY,
+    hostname    TEXT NOT NULL,
+    manifest    TEXT,
+    status      TEXT,
+    stage       TEXT,
+    message     TEXT,
+    job_id      TEXT,
+    bound       REAL,
+    updated     REAL,
+    status_json TEXT
+);
+CREATE TABLE IF NOT EXISTS builds (
+    id          INTEGER PRIMARY KEY,
+    node        TEXT NOT NULL,
+    hostname    TEXT NOT NULL,
+    manifest    TEXT,
+    job_id      TEXT,
+    bound       REAL NOT NULL,
+    started     REAL,
+    finished    REAL,
+    duration    REAL,
+    result      TEXT,
+    message     TEXT,
+    artifact_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_node ON builds (node, bound);
+CREATE INDEX IF NOT EXISTS builds_manifest ON builds (manifest, finished);
+CREATE INDEX IF NOT EXISTS builds_finished ON builds (finished);
+CREATE TABLE IF NOT EXISTS transitions (
+    id          INTEGER PRIMARY KEY,
+    build_id    INTEGER,
+    node        TEXT NOT NULL,
+    time        REAL NOT NULL,
+    status      TEXT,
+    stage       TEXT,
+    message     TEXT
+);
+CREATE INDEX IF NOT EXISTS transitions_build ON transitions (build_id, time);
+CREATE INDEX IF NOT EXISTS transitions_node ON transitions (node, time);
+'''
+
+_BUILD_FIELDS = ('id', 'node', 'hostname', 'manifest', 'job_id', 'bound',
+                 'started', 'finished', 'duration', 'result', 'message',
+                 'artifact_bytes')
+
+Error = sqlite3.Error
+
+_local = threading.local()      # .opened = (pid, { path: History })
+_schema_ready = set()           # paths whose schema this process checked
+_connections = weakref.WeakSet()    # every History of this process
+
+
+def open_history(path):
+    '''The History of path for this thread, a new one after fork().'''
+    opened = getattr(_local, 'opened', None)
+    if opened is None or opened[0] != os.getpid():
+        opened = _local.opened = (os.getpid(), {})
+    if path not in opened[1]:
+        opened[1][path] = History(path)
+    return opened[1][path]
+
+
+def after_fork():
+    """
+        In a forked child, before it closes fds: close every connection
+    the parent's threads had open.  SQLite keeps per-process state for each
+    open database file, and while inherited connections hold on to it
+    the child can't open the file again.  Closing is safe for the parent:
+    fcntl() locks belong to the process that took them.  The next
+    open_history() connects afresh.
+    """
+    for db in list(_connections):
+        db.close()
+    _local.opened = None
+
+
+class History(object):
+    """
+        Connection to the store.  Use it from the thread that made it;
+    open_history() hands out one per thread.
+
+    :param 'path': [str] database file, created if missing.
+    :attr 'created': [bool] True if this made the schema, ie, there is
+                     nothing in it yet.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        # Not shared between threads, but after_fork() closes them all
+        self._db = sqlite3.connect(path, timeout=timeout,
+                                   isolation_level=None,     # autocommit
+                                   check_same_thread=False)
+        _connections.add(self)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self.created = False
+        if path in _schema_ready:
+            return
+        self._db.execute('PRAGMA journal_mode=WAL')     # sticks to the file
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE "
+                                  "type='table' AND name='builds'").fetchone()
+        self.created = exists is None
+        self._db.executescript(_SCHEMA)
+        _schema_ready.add(path)
+
+    def close(self):
+        self._db.close()
+
+    def _latest_build(self, node):
+        row = self._db.execute('SELECT id FROM builds WHERE node=? '
+            'ORDER BY bound DESC, id DESC LIMIT 1', (node, )).fetchone()
+        return row['id'] if row else None
+
+    def bind(self, node, hostname, manifest, job_id=None, when=None):
+        '''A new build of node.  Returns its id.'''
+        when = time.time() if when is None else when
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute(
+                "UPDATE builds SET result='superseded', finished=? "
+                'WHERE node=? AND result IS NULL', (when, node))
+            build_id = self._db.execute(
+                'INSERT INTO builds (node, hostname, manifest, job_id, bound) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (node, hostname, manifest, job_id, when)).lastrowid
+            self._db.execute(
+                'INSERT OR REPLACE INTO bindings (node, hostname, manifest, '
+                'job_id, bound, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (node, hostname, manifest, job_id, when, when))
+        return build_id
+
+    def transition(self, node, status):
+        '''status is the dict update_status() writes to status.json.'''
+        when = status.get('updated') or time.time()
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            build_id = self._latest_build(node)
+            self._db.execute(
+                'INSERT INTO transitions (build_id, node, time, status, '
+                'stage, message) VALUES (?, ?, ?, ?, ?, ?)',
+                (build_id, node, when, status.get('status'),
+                 status.get('stage'), str(status.get('message'))))
+            if status.get('job_id') is not None:    # known after bind()
+                self._db.execute(
+                    'UPDATE builds SET job_id=? WHERE id=? AND job_id IS NULL',
+                    (status['job_id'], build_id))
+            self._db.execute(
+                'UPDATE bindings SET status=?, stage=?, message=?, '
+                'job_id=COALESCE(?, job_id), updated=?, status_json=? '
+                'WHERE node=?',
+                (status.get('status'), status.get('stage'),
+                 str(status.get('message')), status.get('job_id'), when,
+                 json.dumps(status), node))
+
+    def finish(self, node, result, message=None, started=None,
+               artifact_bytes=None, when=None):
+        '''Outcome of the node's latest build.'''
+        when = time.time() if when is None else when
+        build_id = self._latest_build(node)
+        if build_id is None:
+            return
+        self._db.execute(
+            'UPDATE builds SET result=?, message=?, started=?, finished=?, '
+            'duration=?, artifact_bytes=? WHERE id=?',
+            (result, message, started, when,
+             None if started is None else when - started,
+             artifact_bytes, build_id))
+
+    def unbind(self, node, when=None):
+        when = time.time() if when is None else when
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute(
+                "UPDATE builds SET result='cancelled', finished=? "
+                'WHERE node=? AND result IS NULL', (when, node))
+            self._db.execute('DELETE FROM bindings WHERE node=?', (node, ))
+
+    def import_status(self, node, status):
+        '''Adopt a binding found on disk (first start with a new store).'''
+        hostname = status.get('hostname', '')
+        self.bind(node, hostname, status.get('manifest'),
+                  status.get('job_id'), status.get('updated'))
+        self.transition(node, status)
+        if status.get('status') in ('ready', 'error'):
+            self.finish(node, status['status'], status.get('message'),
+                        status.get('started'), when=status.get('updated'))
+
+    def bindings(self):
+        '''node -> latest status dict of every bound node.'''
+        out = {}
+        for row in self._db.execute('SELECT * FROM bindings ORDER BY node'):
+            if row['status_json']:
+                status = json.loads(row['status_json'])
+            else:   # bound, the first status isn't written yet
+                status = { 'status': 'building', 'manifest': row['manifest'],
+                           'message': '', 'hostname': row['hostname'] }
+            out[row['node']] = status
+        return out
+
+    def statuses(self):
+        '''hostname -> latest status dict, to seed the status cache.'''
+        return { status.get('hostname') or node: status
+                 for node, status in self.bindings().items() }
+
+    def builds(self, node=None, manifest=None, since=None, limit=100):
+        '''Newest first, as dicts.'''
+        where, params = self._where(node, manifest, since, 'bound')
+        rows = self._db.execute(
+            'SELECT * FROM builds%s ORDER BY bound DESC, id DESC LIMIT ?' %
+            where, params + [ int(limit) ])
+        return [ { field: row[field] for field in _BUILD_FIELDS }
+                 for row in rows ]
+
+    def transitions(self, build_id):
+        rows = self._db.execute(
+            'SELECT time, status, stage, message FROM transitions '
+            'WHERE build_id=? ORDER BY time, id', (build_id, ))
+        return [ dict(row) for row in rows ]
+
+    def _where(self, node, manifest, since, column):
+        clauses, params = [], []
+        for clause, value in (('node=?', node), ('manifest=?', manifest),
+                              ('%s>=?' % column, since)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def stats(self, manifest=None, node=None, since=None, result='ready',
+              percentiles=(50, 95)):
+        """
+            Build durations, eg the p95 of a manifest over the last week:
+        stats(manifest='x', since=time.time() - 7 * 86400)
+
+        :return: [dict] count, mean, max and pNN for each percentile
+                 (nearest rank), None where there are no builds.
+        """
+        where, params = self._where(node, manifest, since, 'finished')
+        where += (' AND ' if where else ' WHERE ') + \
+            'result=? AND duration IS NOT NULL'
+        params.append(result)
+        row = self._db.execute('SELECT COUNT(*) AS n, AVG(duration) AS mean, '
+            'MAX(duration) AS max FROM builds' + where, params).fetchone()
+        out = { 'count': row['n'], 'mean': row['mean'], 'max': row['max'] }
+        for pct in percentiles:
+            value = None
+            if row['n']:
+                rank = max(1, -(-pct * row['n'] // 100))   # ceil
+                value = self._db.execute(
+                    'SELECT duration FROM builds%s ORDER BY duration '
+                    'LIMIT 1 OFFSET ?' % where, params + [ rank - 1 ]
+                    ).fetchone()['duration']
+            out['p%d' % pct] = value
+        return out
@@ -0,0 +1,327 @@
+#!/usr/bin/python3 -tt
+'''
+    Cache of post-install root file systems, shared by every node bound to
+the same manifest.  Everything up to and including install_packages() only
+depends on the golden image, packages, tasks, postinst scriptlet, mirrors
+and the state of their indices.  That result is built once per digest of
+those inputs under sys-images/_cache/<key>/ and each node build gets a
+copy-on-write clone of it (see rootfs.py) before its per-node steps.
+
+    <key>/untar/       full tree (btrfs subvolume, reflink or plain copy)
+    <key>/upper/       OR an overlay upper dir stacked on the golden cache
+    <key>/vmlinuz-*    boot files moved out of the tree by extract_bootfiles
+    <key>/meta.json    inputs, layout and size; its mtime is the LRU clock
+
+Entries are evicted least recently used first once the cache exceeds its
+disk budget.  Builders hold a shared flock on <key>.lock while cloning so
+an entry is never removed from under them.
+'''
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import requests as HTTP_REQUESTS
+import time
+
+from pdb import set_trace
+
+from . import core_utils
+from . import file_utils
+from . import rootfs
+
+_VERSION = 1    # Bump when the shared steps in customize_node change
+
+SNAPSHOT_TTL = 60   # seconds a mirror's InRelease validators are trusted
+
+_BOOTFILES = ('vmlinuz*', 'initrd.img*', 'config*', 'System.map*')
+
+
+def enabled(args):
+    '''No cache for golden builds, dry runs or a zero budget.'''
+    return not (getattr(args, 'is_golden', False) or
+                getattr(args, 'dryrun', False) or
+                not getattr(args, 'image_cache', None) or
+                not getattr(args, 'image_cache_mb', 0))
+
+
+def _mirrors(args):
+    main = 'deb %s %s %s' % (args.repo_mirror, args.repo_release,
+                             ' '.join(args.repo_areas))
+    other = getattr(args, 'other_mirrors', None) or []
+    if isinstance(other, str):
+        other = other.split(',')
+    return [ main ] + sorted(other)
+
+
+def _head(URL):
+    """
+        The validators of one index file.
+
+    :return: [str] for the key, None if the mirror says there is no such
+             file.  Raise OSError if the mirror can't tell right now.
+    """
+    try:
+        resp = HTTP_REQUESTS.head(URL, timeout=10, allow_redirects=True)
+    except HTTP_REQUESTS.RequestException as err:
+        raise OSError(str(err))
+    if resp.status_code in (404, 410):
+        return None
+    if resp.status_code != 200:
+        raise OSError('HTTP %d' % resp.status_code)
+    return '%s %s %s %s' % (URL,
+        resp.headers.get('ETag', ''),
+        resp.headers.get('Last-Modified', ''),
+        resp.headers.get('Content-Length', ''))
+
+
+def index_snapshot(args):
+    """
+        Identify the current state of every mirror by the validators of its
+    InRelease (or Release) file, so a mirror update means a new cache entry.
+    What each mirror answered is kept in image_cache/indices.json and
+    trusted for SNAPSHOT_TTL seconds, so a burst of binds asks each mirror
+    once.  A mirror that can't be reached keeps its last known answer
+    (with a warning): an outage must not look like a mirror update and
+    force a rebuild.  One never reached contributes nothing.
+
+    :return: [list] of str, one per mirror that has a Release file.
+    """
+    logger = getattr(args, 'logger', None)
+    known_file = '%s/indices.json' % args.image_cache
+    try:
+        with open(known_file, 'r') as f:
+            known = json.loads(f.read())
+    except (OSError, ValueError):
+        known = {}
+
+    now = time.time()
+    changed = False
+    snapshot = []
+    for full_source in _mirrors(args):
+        components = core_utils.deb_components(full_source)
+        if not components.url:
+            continue
+        base = '%s/dists/%s/' % (components.url.rstrip('/'), components.release)
+        last = known.get(base)
+        if last is not None and now - last['checked'] < SNAPSHOT_TTL:
+            value = last['value']
+        else:
+            try:
+                value = _head(base + 'InRelease') or _head(base + 'Release')
+                known[base] = { 'value': value, 'checked': now }
+                changed = True
+            except OSError as err:
+                value = None if last is None else last['value']
+                if logger is not None:
+                    logger.warning('%s unreachable (%s), %s' % (base, err,
+                        'using its last known state' if last is not None
+                        else 'not part of the image cache key'))
+        if value is not None:
+            snapshot.append(value)
+
+    if changed:
+        partial = '%s.new%d' % (known_file, os.getpid())
+        file_utils.write_to_file(partial, json.dumps(known))
+        os.replace(partial, known_file)
+    return snapshot
+
+
+def _tmconfig_ident(args):
+    tmconfig = getattr(args, 'tmconfig', None)
+    try:
+        s = os.stat(tmconfig)
+        return '%s:%d:%d' % (tmconfig, s.st_size, s.st_mtime_ns)
+    except (OSError, TypeError):
+        return None
+
+
+def inputs(args):
+    '''Everything the shared part of a node build depends on.'''
+    return {
+        'version':      _VERSION,
+        'golden':       rootfs.cache_key(args.golden_tar),
+        'packages':     getattr(args, 'packages', None),
+        'tasks':        getattr(args, 'tasks', None),
+        'postinst':     getattr(args, 'postinst', None),
+        'mirrors':      _mirrors(args),
+        'tmconfig':     _tmconfig_ident(args),
+        'indices':      index_snapshot(args),
+    }
+
+
+def cache_key(inputs):
+    text = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def _du(path):
+    '''Bytes allocated under path, hardlinks counted once.'''
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                s = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (s.st_dev, s.st_ino) in seen:
+                continue
+            seen.add((s.st_dev, s.st_ino))
+            total += s.st_blocks * 512
+    return total
+
+
+def _read_meta(entry):
+    try:
+        with open(entry + '/meta.json', 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _in_use(entry):
+    '''An overlay somewhere still has this entry as a lower dir.'''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            return (entry + '/') in f.read()
+    except OSError:
+        return False
+
+
+def evict(cache_dir, budget_mb, keep=None):
+    """
+        Remove least recently used entries until the cache fits budget_mb.
+    Entries being cloned (flocked) or under a live overlay are skipped.
+
+    :return: [list] of the keys removed.
+    """
+    entries = []
+    for meta_file in glob.glob(cache_dir + '/*/meta.json'):
+        entry = os.path.dirname(meta_file)
+        meta = _read_meta(entry)
+        if meta is None:
+            continue
+        entries.append((os.stat(meta_file).st_mtime, entry, meta['size']))
+
+    total = sum(size for _, _, size in entries)
+    removed = []
+    for _, entry, size in sorted(entries):
+        if total <= budget_mb << 20:
+            break
+        if entry == keep or _in_use(entry):
+            continue
+        with open(entry + '.lock', 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            rootfs.release(entry)
+            file_utils.remove_target(entry)
+        total -= size
+        removed.append(os.path.basename(entry))
+    return removed
+
+
+def _populate(args, entry, key_inputs, build, progress):
+    '''Run the shared build in a staging dir, then rename it into place.'''
+    staging = '%s.tmp%d' % (entry, os.getpid())
+    rootfs.release(staging)
+    file_utils.remove_target(staging)
+    file_utils.make_dir(staging)
+
+    shared = argparse.Namespace(**vars(args))
+    shared.build_dir = staging
+    try:
+        shared.new_fs_dir = rootfs.provision(shared, progress)
+        build(shared)
+        meta = {
+            'inputs':   key_inputs,
+            'backend':  shared.rootfs_backend_used,
+            'created':  time.ctime(),
+            'bootfiles': sorted(os.path.basename(f) for pattern in _BOOTFILES
+                                for f in glob.glob(staging + '/' + pattern)),
+        }
+        if rootfs.detach(staging) is not None:
+            meta['layer'] = 'upper'
+            meta['lower'] = rootfs.golden_cache(args.golden_tar)
+        else:
+            meta['layer'] = 'untar'
+        meta['size'] = _du(staging)
+        file_utils.write_to_file(staging + '/meta.json',
+                                 json.dumps(meta, indent=4))
+        os.rename(staging, entry)
+    except Exception:
+        rootfs.release(staging)
+        file_utils.remove_target(staging)
+        raise
+
+
+def _clone(args, entry, meta):
+    dest = args.build_dir + '/untar'
+    rootfs.release(args.build_dir, dest)
+    logger = getattr(args, 'logger', None)
+    if meta['layer'] == 'upper':
+        source = '%s/upper:%s' % (entry, meta['lower'])   # topmost first
+        rootfs.clone(source, dest, 'overlay', args.build_dir)
+        used = 'overlay'
+    else:
+        used = rootfs.clone_any(entry + '/untar', dest,
+            getattr(args, 'rootfs_backend', None) or 'auto',
+            args.build_dir, logger, extra=('copy', ))
+        if used is None:
+            raise RuntimeError('Cannot clone cached image %s' % entry)
+
+    args.vmlinuz_golden = ''
+    for fname in meta['bootfiles']:
+        dest_file = '%s/%s' % (args.build_dir, fname)
+        file_utils.copy_target_into('%s/%s' % (entry, fname), dest_file)
+        if fname.startswith('vmlinuz'):
+            args.vmlinuz_golden = dest_file
+    args.rootfs_backend_used = used
+    return dest + '/'
+
+
+def provision(args, build, progress=None, waiting=None):
+    """
+        rootfs.provision() for a tree that has already been through the
+    shared customization steps.  On a miss, build(shared_args) runs those
+    steps on a tree in the cache; shared_args is a copy of args whose
+    build_dir is the cache staging directory.  Concurrent builders of the
+    same key wait for the first one instead of installing again.
+
+    :param 'args.image_cache': [str] cache directory.
+    :param 'args.image_cache_mb': [int] disk budget in megabytes.
+    :param 'build': callable(shared_args) for the shared steps.
+    :param 'progress': passed to rootfs.provision() on a miss.
+    :param 'waiting': callable() invoked if another build holds the key.
+    :return: [str] new_fs_dir.  Sets args.rootfs_backend_used, args.vmlinuz_golden,
+             args.image_cache_key and args.image_cache_hit.
+    """
+    file_utils.make_dir(args.image_cache)
+    key_inputs = inputs(args)
+    key = cache_key(key_inputs)
+    entry = '%s/%s' % (args.image_cache, key)
+    args.image_cache_key = key
+    args.image_cache_hit = True
+
+    with open(entry + '.lock', 'w') as lockfile:
+        if _read_meta(entry) is None:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                if waiting is not None:
+                    waiting()
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if _read_meta(entry) is None:       # Nobody beat me to it
+                args.image_cache_hit = False
+                _populate(args, entry, key_inputs, build, progress)
+                evict(args.image_cache, args.image_cache_mb, keep=entry)
+        # Downgrade (or take) shared: evict() can't get this entry now.
+        fcntl.flock(lockfile, fcntl.LOCK_SH)
+        meta = _read_meta(entry)
+        assert meta is not None, 'Cached image %s vanished' % key
+        os.utime(entry + '/meta.json')          # Most recently used
+        return _clone(args, entry, meta)
@@ -0,0 +1,254 @@
+#!/usr/bin/python3 -tt
+'''
+    On-disk cache of the mirrors' Packages indices for the packages
+blueprint, so a server restart doesn't pull every Packages.gz over the
+proxy before it can answer anything.
+
+    MANIFESTING_ROOT/indexcache/
+        by-hash/<sha256>    uncompressed Packages and the (In)Release
+                            files, named by content; never rewritten in
+                            place, so they can be memory mapped
+        meta/<key>.json     per URL: ETag, Last-Modified, content SHA256
+
+Each load first asks for the mirror's InRelease (Release if there is
+none) with If-None-Match/If-Modified-Since.  Its SHA256 list names the
+uncompressed Packages of every area and arch, and any of those already in
+by-hash/ are used without touching the network.  The others are fetched
+as Packages.gz, again conditionally.  If a mirror can't be reached the last
+copy is used, with a warning.  The InRelease signature is not checked
+(neither is the download itself, as before); the checksums only key the
+cache.
+
+An IndexCache can be used from many threads at once (one fetch per URL,
+the others wait for it); the packages blueprint fetches every mirror, area
+and arch concurrently over one pooled session.
+'''
+
+import collections
+import gzip
+import hashlib
+import json
+import os
+import requests as HTTP_REQUESTS
+import threading
+
+from pdb import set_trace
+
+from . import file_utils
+
+_BY_HASH = 'by-hash'
+_META = 'meta'
+
+
+def _key(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+
+def parse_release(text):
+    """
+        The SHA256 section of a Release or InRelease file.
+
+    :param 'text': [str] file contents (a clearsigned InRelease is fine).
+    :return: [dict] path under dists/<release>/ -> (sha256, size).
+    """
+    result = {}
+    in_sha256 = False
+    for line in text.splitlines():
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+        if not line.startswith(' '):
+            in_sha256 = line.strip() == 'SHA256:'
+            continue
+        if in_sha256:
+            fields = line.split()
+            if len(fields) == 3:
+                result[fields[2]] = (fields[0], int(fields[1]))
+    return result
+
+
+def session(workers):
+    '''A requests Session keeping up to "workers" connections per mirror.'''
+    session = HTTP_REQUESTS.Session()
+    adapter = HTTP_REQUESTS.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=workers, max_retries=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class IndexCache(object):
+    """
+    :param 'cache_dir': [str] created if missing.
+    :param 'session': requests module or Session to fetch with.
+    """
+
+    def __init__(self, cache_dir, session=HTTP_REQUESTS, logger=None,
+                 timeout=60):
+        for d in (_BY_HASH, _META):
+            file_utils.make_dir('%s/%s' % (cache_dir, d))
+        self.cache_dir = cache_dir
+        self.session = session
+        self.timeout = timeout
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._locks = collections.defaultdict(threading.Lock)
+        self._releases = {}     # (url, release) -> parse_release()
+        self._used = set()      # by-hash names handed out
+        self.stats = { 'cached': 0, 'not_modified': 0, 'downloaded': 0,
+                       'stale': 0 }
+
+    def _locked(self, key):
+        '''A lock per URL, so one thread fetches it and the rest wait.'''
+        with self._lock:
+            return self._locks[key]
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _log(self, msg, level='info'):
+        if self._logger is not None:
+            getattr(self._logger, level)(msg)
+
+    def _path(self, kind, name):
+        return '%s/%s/%s' % (self.cache_dir, kind, name)
+
+    def _store(self, content):
+        '''Keep content in by-hash/, return its name.'''
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = self._path(_BY_HASH, sha256)
+        if not os.path.exists(path):
+            partial = '%s.partial%d.%d' % (path, os.getpid(),
+                                           threading.get_ident())
+            with open(partial, 'wb') as f:
+                f.write(content)
+            os.replace(partial, path)
+        return sha256
+
+    def _use(self, sha256):
+        '''Path of a by-hash file, kept by prune(); None if it's gone.'''
+        path = self._path(_BY_HASH, sha256)
+        if not os.path.exists(path):
+            return None
+        with self._lock:
+            self._used.add(sha256)
+        return path
+
+    def _meta(self, url):
+        try:
+            with open(self._path(_META, _key(url)), 'r') as f:
+                meta = json.loads(f.read())
+            return meta if meta.get('url') == url else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_meta(self, url, headers, sha256):
+        meta = { 'url': url, 'sha256': sha256,
+                 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified') }
+        path = self._path(_META, _key(url))
+        partial = '%s.new%d' % (path, threading.get_ident())
+        file_utils.write_to_file(partial, json.dumps(meta))
+        os.replace(partial, path)
+
+    def _get(self, url, decode=None):
+        """
+            Conditional GET of url.  decode(bytes) turns the response into
+        what is kept (eg gunzip).  Returns the by-hash path of what is kept,
+        None for an HTTP error status.  Falls back on the earlier copy if there is one,
+        otherwise connection failures raise.
+        """
+        meta = self._meta(url)
+        previous = meta.get('sha256')
+        if previous and not os.path.exists(self._path(_BY_HASH, previous)):
+            meta = {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
+            if resp.status_code == 304 and meta:
+                self._count('not_modified')
+                return self._use(previous)
+            resp.raise_for_status()
+            content = resp.content if decode is None else decode(resp.content)
+        except (HTTP_REQUESTS.RequestException, OSError, EOFError) as err:
+            if not meta:
+                if isinstance(err, HTTP_REQUESTS.HTTPError):
+                    return None     # the mirror doesn't have it
+                raise
+            self._log('%s: %s, using the copy from before' % (url, err),
+                      'warning')
+            self._count('stale')
+            return self._use(previous)
+        sha256 = self._store(content)
+        self._save_meta(url, resp.headers, sha256)
+        self._count('downloaded')
+        return self._use(sha256)
+
+    def release(self, url, release):
+        '''parse_release() of the mirror's InRelease or Release, {} if none.'''
+        with self._locked((url, release)):
+            if (url, release) in self._releases:
+                return self._releases[(url, release)]
+            result = {}
+            for name in ('InRelease', 'Release'):
+                try:
+                    path = self._get('%s/dists/%s/%s' % (
+                        url.rstrip('/'), release, name))
+                    if path is None:
+                        continue
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                except (HTTP_REQUESTS.RequestException, OSError) as err:
+                    self._log('%s %s: %s' % (url, name, err), 'warning')
+                    continue
+                result = parse_release(content.decode('utf-8', 'replace'))
+                break
+            self._releases[(url, release)] = result
+            return result
+
+    def packages_path(self, url, release, area, arch):
+        """
+            Uncompressed Packages index of one area and arch of a mirror.
+
+        :param 'arch': [str] eg "binary-all", "binary-arm64".
+        :return: [str] its by-hash file, None if the mirror doesn't have it.
+        """
+        path = '%s/%s/Packages' % (area, arch)
+        listed = self.release(url, release).get(path)
+        gz_url = '%s/dists/%s/%s.gz' % (url.rstrip('/'), release, path)
+        with self._locked(gz_url):
+            if listed is not None:
+                found = self._use(listed[0])
+                if found is not None:
+                    self._count('cached')
+                    return found
+            found = self._get(gz_url, decode=gzip.decompress)
+        if found is not None and listed is not None and \
+           os.path.basename(found) != listed[0]:
+            self._log('%s %s: does not match the Release file (mirror sync '
+                      'in progress?)' % (url, path), 'warning')
+        return found
+
+    def packages(self, url, release, area, arch):
+        '''packages_path() read in, [bytes] or None.'''
+        path = self.packages_path(url, release, area, arch)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def prune(self):
+        '''Remove indices nothing handed out since this IndexCache was made.'''
+        removed = 0
+        for name in os.listdir(self._path(_BY_HASH, '')):
+            if name not in self._used:
+                try:
+                    os.unlink(self._path(_BY_HASH, name))
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
@@ -0,0 +1,304 @@
+#!/usr/bin/python3 -tt
+'''
+    Compression of the node file system cpio ("initrd" to grub).  The
+kernel unpacks gzip, xz, zstd and lz4 initramfs images if it was built with
+the matching CONFIG_RD_xxx, and grub just hands the file over.  Which one
+boots fastest depends on where the time goes: slow links (TMAS PXE, about
+100 MB / hour) want the smallest file, fast links (FAME) want the fastest
+decompression.  Run this module on a sample to see the trade-off:
+
+    python3 -m tmms.utils.initramfs /path/to/untar-or-file.cpio
+
+xz must use CRC32 (the kernel has no CRC64/SHA256 check) and lz4 must use
+the legacy frame format (-l).  zstd and lz4 use the programs of the same
+name, gzip and xz are in-process.
+
+    The kernel also unpacks concatenated archives in order, later entries
+replacing earlier ones, and grub concatenates every file on its "initrd"
+line.  Nodes cloned from the same shared image (see image_cache.py) get
+one base archive of that image, kept in TFTP_IMAGES/_base/<key>.cpio.xx,
+plus a small archive of whatever their per-node steps changed.  Each node
+directory holds a <hostname>.base symlink to the base it boots, which is
+what keeps a base from being collected.
+'''
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import gzip
+import lzma
+import os
+import subprocess
+import tempfile
+import time
+
+from pdb import set_trace
+
+from . import cpio
+from . import pgzip
+
+DEFAULT = 'gzip'
+BASE_DIR = '_base'
+
+# codec: file extension
+CODECS = {
+    'gzip': 'gz',
+    'xz':   'xz',
+    'zstd': 'zst',
+    'lz4':  'lz4',
+}
+
+_COMMANDS = {   # compress to stdout, decompress to stdout
+    'zstd': (['zstd', '-q', '-c', '-19'], ['zstd', '-q', '-d', '-c']),
+    'lz4':  (['lz4', '-q', '-l', '-9', '-c'], ['lz4', '-q', '-d', '-c']),
+}
+
+
+def validate(codec):
+    '''Return the codec name, RuntimeError if it's not one of CODECS.'''
+    codec = (codec or DEFAULT).lower()
+    if codec not in CODECS:
+        raise RuntimeError('Unknown initramfs codec "%s", use one of %s' % (
+            codec, ', '.join(sorted(CODECS))))
+    return codec
+
+
+def filename(hostname, codec):
+    '''What the TFTP directory and the grub menu call the file.'''
+    return '%s.cpio.%s' % (hostname, CODECS[validate(codec)])
+
+
+class _PipeWriter(object):
+    '''Write into a compression program whose stdout is fileobj.'''
+
+    def __init__(self, cmd, fileobj, threads):
+        if threads and cmd[0] == 'zstd':
+            cmd = cmd + [ '-T%d' % threads ]
+        fileobj.flush()
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                      stdout=fileobj, stderr=subprocess.PIPE)
+
+    def write(self, data):
+        return self._proc.stdin.write(data)
+
+    def close(self):
+        if self._proc.stdin.closed:
+            return
+        self._proc.stdin.close()
+        stderr = self._proc.stderr.read()
+        ret = self._proc.wait()
+        self._proc.stderr.close()
+        if ret:
+            raise RuntimeError('"%s" failed: %s' % (
+                ' '.join(self._cmd), stderr.decode(errors='replace')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._proc.kill()
+            self._proc.wait()
+
+
+def writer(codec, fileobj, threads=None):
+    """
+        A write-only file object (also a context manager) that compresses
+    into fileobj with codec.  Closing it finishes the stream; the caller
+    still owns fileobj.
+
+    :param 'threads': [int] for gzip and zstd, None means all cores.
+    """
+    codec = validate(codec)
+    if codec == 'gzip':
+        return pgzip.GzipWriter(fileobj, compresslevel=6, threads=threads)
+    if codec == 'xz':
+        return lzma.LZMAFile(fileobj, 'wb', check=lzma.CHECK_CRC32, preset=6)
+    return _PipeWriter(_COMMANDS[codec][0], fileobj, threads)
+
+
+def _signature(st):
+    return (st.st_mode, st.st_uid, st.st_gid, st.st_size,
+            st.st_mtime_ns, st.st_ctime_ns)
+
+
+def snapshot(top, ignore_files=(), ignore_dirs=()):
+    """
+        Remember the state of a tree, to find what changes later.
+
+    :return: [dict] archive name -> signature of its lstat()
+    """
+    return { name: _signature(st) for name, _, st in
+             cpio.walk(top, ignore_files, ignore_dirs) }
+
+
+def changes(top, before, ignore_files=(), ignore_dirs=()):
+    """
+        What an overlay archive needs on top of the archive of "before":
+    every new or changed entry, and the directories leading to it.
+
+    :param 'before': [dict] from snapshot()
+    :return: [tuple] (list of (name, path, stat) in cpio.walk() order,
+             list of names that are gone).  An archive can't delete, so
+             if the second list isn't empty an overlay won't do.
+    """
+    after = list(cpio.walk(top, ignore_files, ignore_dirs))
+    wanted = set()
+    for name, _, st in after:
+        if before.get(name) != _signature(st):
+            while name not in wanted and name != '.':
+                wanted.add(name)
+                name = os.path.dirname(name)
+    present = frozenset(name for name, _, _ in after)
+    gone = sorted(name for name in before if name not in present)
+    return [ entry for entry in after if entry[0] in wanted ], gone
+
+
+def base_path(images_dir, key, codec):
+    '''Where the base archive of shared image "key" goes.'''
+    return '%s/%s/%s.cpio.%s' % (images_dir, BASE_DIR, key,
+                                 CODECS[validate(codec)])
+
+
+@contextlib.contextmanager
+def base_lock(base, blocking=True):
+    """
+        Exclusive lock of one base archive while it's created and linked,
+    or collected.  Yields False if not blocking and somebody else has it.
+    """
+    with open(base + '.lock', 'a') as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+def link_base(tftp_dir, hostname, base):
+    '''Point the node at its base; None removes the link.'''
+    link = '%s/%s.base' % (tftp_dir, hostname)
+    if os.path.lexists(link):
+        os.unlink(link)
+    if base is not None:
+        os.symlink(os.path.relpath(base, tftp_dir), link)
+
+
+def collect_bases(images_dir):
+    """
+        Remove base archives no node links to any more.
+
+    :return: [int] number removed.
+    """
+    used = set()
+    for link in glob.glob('%s/*/*.base' % images_dir):
+        try:
+            used.add(os.path.basename(os.readlink(link)))
+        except OSError:
+            pass
+    removed = 0
+    for base in glob.glob('%s/%s/*.cpio.*' % (images_dir, BASE_DIR)):
+        if base.endswith('.lock') or os.path.basename(base) in used:
+            continue
+        with base_lock(base, blocking=False) as locked:
+            # Linking happens under the lock, so look again
+            if locked and not any(
+                    os.path.realpath(link) == os.path.realpath(base)
+                    for link in glob.glob('%s/*/*.base' % images_dir)):
+                os.unlink(base)
+                removed += 1
+    return removed
+
+
+def _decompress(codec, path):
+    '''Read the whole thing back, as the kernel would, and throw it away.'''
+    if codec in _COMMANDS:
+        subprocess.run(_COMMANDS[codec][1] + [ path ], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return
+    opener = gzip.open if codec == 'gzip' else lzma.open
+    with opener(path, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+
+def benchmark(sample, codecs=None, threads=None, tmpdir=None):
+    """
+        Compress a sample cpio with each codec and decompress it again.
+
+    :param 'sample': [str] a .cpio file or a directory to archive first.
+    :param 'codecs': [list] names from CODECS, default all of them.
+    :return: [list] of dicts with codec, size, ratio, compress and
+             decompress (seconds); error instead for codecs that failed.
+    """
+    codecs = [ validate(c) for c in (codecs or sorted(CODECS)) ]
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmpdir) as scratch:
+        if os.path.isdir(sample):
+            source = scratch + '/sample.cpio'
+            with open(source, 'wb') as f:
+                cpio.write_tree(sample, f, ignore_files=['vmlinuz', 'initrd.img'],
+                                ignore_dirs=['boot'])
+        else:
+            source = sample
+        raw_size = os.path.getsize(source)
+
+        for codec in codecs:
+            dest = '%s/sample.cpio.%s' % (scratch, CODECS[codec])
+            try:
+                start = time.time()
+                with open(source, 'rb') as f_in, open(dest, 'wb') as raw:
+                    with writer(codec, raw, threads) as f_out:
+                        for chunk in iter(lambda: f_in.read(1 << 20), b''):
+                            f_out.write(chunk)
+                compress = time.time() - start
+                start = time.time()
+                _decompress(codec, dest)
+                decompress = time.time() - start
+                size = os.path.getsize(dest)
+                results.append(dict(codec=codec, size=size,
+                    ratio=size / raw_size if raw_size else 0.0,
+                    compress=compress, decompress=decompress))
+            except Exception as err:
+                results.append(dict(codec=codec, error=str(err)))
+            finally:
+                if os.path.exists(dest):
+                    os.unlink(dest)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare initramfs codecs on a sample node image')
+    parser.add_argument('sample',
+                        help='cpio file or unpacked file system directory')
+    parser.add_argument('--codecs', default=','.join(sorted(CODECS)),
+                        help='Comma-separated subset of %s' % ', '.join(sorted(CODECS)))
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Compression threads, default all cores')
+    parser.add_argument('--mbps', type=float, default=None,
+                        help='Also estimate boot transfer time at this MB/s')
+    args = parser.parse_args()
+
+    header = '%-6s %10s %6s %10s %12s' % (
+        'codec', 'MB', 'ratio', 'compress', 'decompress')
+    if args.mbps:
+        header += ' %12s' % 'xfer+unpack'
+    print(header)
+    for r in benchmark(args.sample, args.codecs.split(','), args.threads):
+        if 'error' in r:
+            print('%-6s %s' % (r['codec'], r['error']))
+            continue
+        line = '%-6s %10.1f %6.3f %9.1fs %11.1fs' % (
+            r['codec'], r['size'] / (1 << 20), r['ratio'],
+            r['compress'], r['decompress'])
+        if args.mbps:
+            line += ' %11.1fs' % (
+                r['size'] / (1 << 20) / args.mbps + r['decompress'])
+        print(line)
+    raise SystemExit(0)
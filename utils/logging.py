@@ -62,6 +62,27 @@ class tmmsLogger(object):   # FIXME: how about subclassing getLogger?
             rootlogger.addHandler(h)
             rootlogger.setLevel(level)
 
+    @staticmethod
+    def after_fork():
+        """
+            In a forked child about to close every fd above stderr: let
+        file handlers reopen their file by name on their next record, and
+        drop other handlers of streams that won't survive.  A handler left
+        on a closed fd would write into whatever file reuses it.
+        """
+        loggers = [ logging.root ] + [ logger for logger in
+            logging.Logger.manager.loggerDict.values()
+            if isinstance(logger, logging.Logger) ]
+        for logger in loggers:
+            for h in list(logger.handlers):
+                if isinstance(h, logging.FileHandler):
+                    h.stream = None     # not closed: it's the parent's too
+                elif isinstance(h, logging.StreamHandler) and \
+                     h.stream in (sys.stdout, sys.stderr):
+                    continue
+                else:
+                    logger.removeHandler(h)
+
     def __init__(self, loggername, use_file='', verbose=False):
         # Create a logger with no handlers.   Because there is no "dot"
         # hierarchy in the namespace, its parent is the (default) root logger
@@ -4,6 +4,8 @@ import flask
 import json
 import werkzeug
 
+from tmms.utils.initramfs import CODECS as INITRAMFS_CODECS
+
 
 class ManifestDestiny(object):
 
@@ -24,7 +26,11 @@ class ManifestDestiny(object):
         molegal = legal.union(frozenset((    # Optional
             'comment', '_comment', 'privkey', 'pubkey',
             'l4tm_privkey', 'l4tm_pubkey',              # Deprecated
-            'postinst', 'rclocal', 'kernel_append')))
+            'postinst', 'rclocal', 'kernel_append', 'initramfs_codec')))
+
+        codec = m.get('initramfs_codec', 'gzip')
+        assert codec in INITRAMFS_CODECS, 'initramfs_codec must be one of ' + \
+            ', '.join(sorted(INITRAMFS_CODECS))
 
         #NO NEED TO BE STRICT ANYMORE
         #illegal = list(keys - molegal - frozenset((_UPFROM, )))
@@ -0,0 +1,259 @@
+#!/usr/bin/python3 -tt
+'''
+    Build telemetry.  Each stage of a node build (customize_node.execute)
+records its wall time, CPU time and bytes read and written.  CPU time and
+bytes include the child processes (tar, apt, dpkg...):
+getrusage(RUSAGE_CHILDREN) and /proc/self/io both count them once they
+have been waited for.  Bytes are what went through read() and write(),
+page cache or not.  The kernel only keeps the largest RSS of any child
+ever reaped, not one per stage, so peak child RSS is recorded once per
+build; it is the build's own only in a process of its own (the scheduler
+forks one per build).
+
+Every finished build is one JSON line appended to a journal, as is every
+SNBU image built on download (kind "esp", stage "esp").  The server turns
+the journal into Prometheus text exposition format:
+
+    tmms_builds_total{result="ready"}
+    tmms_build_seconds_bucket{le="..."} (histogram of whole builds)
+    tmms_build_stage_seconds_bucket{stage="...",le="..."}
+    tmms_build_stage_cpu_seconds_total{stage="..."}
+    tmms_build_stage_read_bytes_total{stage="..."}
+    tmms_build_stage_write_bytes_total{stage="..."}
+    tmms_build_child_max_rss_bytes (largest of any build)
+
+Standard python3 libraries only.
+'''
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+from pdb import set_trace
+
+# Seconds; a cached rebuild is well under a minute, an uncached emulated
+# apt can take most of an hour.
+BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+_SUMMED = ('seconds', 'cpu_seconds', 'read_bytes', 'write_bytes')
+
+
+def _proc_io():
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, val = line.partition(':')
+                counters[key] = int(val)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def _sample():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _proc_io()
+    return {
+        'seconds': time.monotonic(),
+        'cpu_seconds': me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime,
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+    }
+
+
+def _child_max_rss():
+    '''Largest RSS of any child this process reaped, in bytes.'''
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024   # KB
+
+
+class Stages(object):
+    """
+        Per-stage resource accounting of one process.  A stage that runs
+    more than once (or nests in another) adds up.
+
+    :param 'own_process': [bool] the process runs nothing but this build,
+                          so the peak RSS of its children is the build's.
+    """
+
+    def __init__(self, own_process=True):
+        self.own_process = own_process
+        self.stages = collections.OrderedDict()
+        self.started = time.time()
+        self._start = _sample()
+        self._active = []
+
+    @property
+    def current(self):
+        '''Innermost stage running now, None between stages.'''
+        return self._active[-1] if self._active else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        before = _sample()
+        self._active.append(name)
+        try:
+            yield
+        finally:
+            self._active.pop()
+            after = _sample()
+            totals = self.stages.setdefault(name, dict.fromkeys(_SUMMED, 0))
+            for key in _SUMMED:
+                totals[key] += after[key] - before[key]
+
+    def todict(self, **extra):
+        '''The build record: extra fields, totals and the stages.'''
+        now = _sample()
+        record = dict(extra)
+        record['time'] = time.time()
+        record['seconds'] = now['seconds'] - self._start['seconds']
+        record['cpu_seconds'] = now['cpu_seconds'] - self._start['cpu_seconds']
+        if self.own_process:
+            record['child_max_rss_bytes'] = _child_max_rss()
+        record['stages'] = self.stages
+        return record
+
+
+def record(build, per_build=None, journal=None):
+    """
+        Persist a build record (Stages.todict()) as per_build, replacing
+    the previous one, and append it to the journal.  Either may be None.
+    """
+    line = json.dumps(build, sort_keys=True)
+    if per_build:
+        tmp = per_build + '.new'
+        with open(tmp, 'w') as f:
+            f.write(line + '\n')
+        os.replace(tmp, per_build)
+    if journal:
+        os.makedirs(os.path.dirname(journal), exist_ok=True)
+        # One write() on O_APPEND: concurrent builds don't interleave lines
+        fd = os.open(journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (line + '\n').encode())
+        finally:
+            os.close(fd)
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.total += value
+
+    def lines(self, name, labels=''):
+        out = []
+        cumulative = 0
+        sep = ',' if labels else ''
+        for bound, count in zip(BUCKETS + ('+Inf', ), self.counts):
+            cumulative += count
+            out.append('%s_bucket{%s%sle="%s"} %d' % (
+                name, labels, sep, bound, cumulative))
+        braces = '{%s}' % labels if labels else ''
+        out.append('%s_sum%s %.3f' % (name, braces, self.total))
+        out.append('%s_count%s %d' % (name, braces, cumulative))
+        return out
+
+
+class Aggregate(object):
+    """
+        Histograms over every build in the journal.  update() only reads
+    what was appended since the last call.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._offset = 0
+        self.builds = collections.Counter()
+        self.build_seconds = _Histogram()
+        self.stage_seconds = collections.OrderedDict()
+        self.stage_totals = collections.OrderedDict()
+        self.child_max_rss = 0
+
+    def add(self, build):
+        if build.get('kind', 'build') == 'build':   # not an on-demand "esp"
+            self.builds[build.get('result', 'unknown')] += 1
+            self.build_seconds.observe(build.get('seconds', 0))
+        self.child_max_rss = max(self.child_max_rss,
+                                 build.get('child_max_rss_bytes', 0))
+        for name, stage in build.get('stages', {}).items():
+            self.stage_seconds.setdefault(name, _Histogram()).observe(
+                stage.get('seconds', 0))
+            totals = self.stage_totals.setdefault(name, collections.Counter())
+            for key in _SUMMED[1:]:
+                totals[key] += stage.get(key, 0)
+
+    def update(self):
+        with self._lock:
+            try:
+                size = os.path.getsize(self.journal)
+            except OSError:
+                size = 0
+            if size < self._offset:     # truncated or replaced
+                self._reset()
+            if size == self._offset:
+                return
+            with open(self.journal, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            complete = data.rfind(b'\n') + 1    # a build may be mid-write
+            for line in data[:complete].splitlines():
+                try:
+                    self.add(json.loads(line.decode()))
+                except ValueError:
+                    pass
+            self._offset += complete
+
+    def prometheus(self):
+        '''Prometheus text exposition format, version 0.0.4.'''
+        self.update()
+        with self._lock:
+            out = [
+                '# HELP tmms_builds_total Node image builds by result.',
+                '# TYPE tmms_builds_total counter' ]
+            for result, count in sorted(self.builds.items()):
+                out.append('tmms_builds_total{result="%s"} %d' % (result, count))
+            out += [
+                '# HELP tmms_build_seconds Wall time of whole node builds.',
+                '# TYPE tmms_build_seconds histogram' ]
+            out += self.build_seconds.lines('tmms_build_seconds')
+            out += [
+                '# HELP tmms_build_child_max_rss_bytes Peak RSS of a child '
+                'process of any node build.',
+                '# TYPE tmms_build_child_max_rss_bytes gauge',
+                'tmms_build_child_max_rss_bytes %d' % self.child_max_rss ]
+            out += [
+                '# HELP tmms_build_stage_seconds Wall time of build stages.',
+                '# TYPE tmms_build_stage_seconds histogram' ]
+            for name, histogram in self.stage_seconds.items():
+                out += histogram.lines('tmms_build_stage_seconds',
+                                       'stage="%s"' % name)
+            for key, kind, helptext in (
+                    ('cpu_seconds', 'counter', 'CPU time, children included'),
+                    ('read_bytes', 'counter', 'Bytes read, children included'),
+                    ('write_bytes', 'counter', 'Bytes written, children included')):
+                name = 'tmms_build_stage_%s_total' % key
+                out.append('# HELP %s %s of build stages.' % (name, helptext))
+                out.append('# TYPE %s %s' % (name, kind))
+                for stage, totals in self.stage_totals.items():
+                    value = totals[key]
+                    out.append('%s{stage="%s"} %s' % (name, stage,
+                        ('%.3f' % value) if key == 'cpu_seconds' else int(value)))
+            return '\n'.join(out) + '\n'
@@ -0,0 +1,135 @@
+#!/usr/bin/python3 -tt
+'''
+    The packages blueprint's name -> package catalog, without keeping a
+deb822 paragraph per package.  Each Packages index stays in the index
+cache's by-hash/ file and is memory mapped; per package only its interned
+name, version and where its stanza lies in the mapping are kept.  Any other
+field is read out of the mapping when asked for, and a whole paragraph is
+only built for the one package a page or API call shows.  Reading is
+done by utils/control.py.
+
+Mapped index pages are file-backed: the kernel shares them between
+processes and can drop them under memory pressure, unlike parsed copies.
+'''
+
+import mmap
+import sys
+
+from pdb import set_trace
+
+from . import control
+
+
+class _Package(object):
+    '''Where one package's stanza is.'''
+
+    __slots__ = ('index', 'start', 'end', 'version')
+
+    def __init__(self, index, start, end, version):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.version = version
+
+
+class Index(object):
+    """
+        One uncompressed Packages file, mapped and scanned for its stanzas.
+    Scanning is independent of any catalog, so it can run in a worker
+    thread; Catalog.add() then takes the packages over.
+
+    :param 'path': [str] the file, which must not be rewritten in place
+                   while mapped (replacing or unlinking it is fine).
+    :param 'origin': [str] mirror URL the index came from.
+    """
+
+    def __init__(self, path, origin):
+        self.origin = origin
+        with open(path, 'rb') as f:
+            if not f.seek(0, 2):
+                self.map = b''      # mmap() refuses empty files
+            else:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.packages = self._scan()
+
+    def _scan(self):
+        buf = self.map
+        packages = {}
+        for start, end in control.stanzas(buf):
+            name = control.find(buf, start, end, b'Package')
+            if name is not None:
+                name = sys.intern(control.value(buf[name[0]:name[1]]))
+                version = control.find(buf, start, end, b'Version')
+                version = '' if version is None else \
+                    control.value(buf[version[0]:version[1]])
+                packages[name] = _Package(self, start, end, version)
+        return packages
+
+
+class Catalog(object):
+    """
+        Package name -> package of every index added, a later index
+    overriding an earlier one for a name in both (sources.list order).
+    Read-only once loaded, so any number of threads can use it.
+    """
+
+    def __init__(self):
+        self._packages = {}
+
+    def add(self, index):
+        '''Take over an Index's packages.  Returns how many it had.'''
+        self._packages.update(index.packages)
+        count = len(index.packages)
+        index.packages = None   # only the catalog's references are needed
+        return count
+
+    def __len__(self):
+        return len(self._packages)
+
+    def __contains__(self, name):
+        return name in self._packages
+
+    def __iter__(self):
+        return iter(self._packages)
+
+    def keys(self):
+        return self._packages.keys()
+
+    def version(self, name):
+        return self._packages[name].version
+
+    def origin(self, name):
+        '''Mirror URL the package's index came from.'''
+        return self._packages[name].index.origin
+
+    def field(self, name, key, default=None):
+        """
+            One field of a package without building its paragraph.
+
+        :param 'key': [str] field name as spelled in the index (not case
+                      folded like deb822 does).
+        """
+        pkg = self._packages[name]
+        bounds = control.find(pkg.index.map, pkg.start, pkg.end, key.encode())
+        if bounds is None:
+            return default
+        return control.value(pkg.index.map[bounds[0]:bounds[1]])
+
+    def fields(self, name, keys):
+        '''dict of those of keys the package has.'''
+        result = {}
+        for key in keys:
+            value = self.field(name, key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def __getitem__(self, name):
+        '''The package's whole paragraph, a dict built for this caller.'''
+        pkg = self._packages[name]
+        return control.parse(pkg.index.map, pkg.start, pkg.end)
+
+    def get(self, name, default=None):
+        if name not in self._packages:
+            return default
+        return self[name]
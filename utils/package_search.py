@@ -0,0 +1,138 @@
+#!/usr/bin/python3 -tt
+'''
+    Search over the package catalog, for manifest authors looking for a
+package without pulling the whole list.  Everything is built once when the
+catalog is loaded; a query only looks things up.
+
+  - Package ids are positions in the sorted name list, so a name prefix is
+    one contiguous id range (bisect).
+  - Trigrams of every name -> ids, for substrings of names.
+  - Words of names and of the first line of each Description ->
+    ids, with the words sorted so a word prefix is one bisect too.
+  - Section, Architecture and Priority value -> ids, for filters.
+
+Id lists are array('I') in id order.  A query term matches a package if it
+is in the package's name (terms under three characters: the name starts
+with it) or starts a word of its name or short description; every term has
+to match.  Results are in name order, packages whose name matches every
+term first.
+'''
+
+import array
+import bisect
+import re
+
+from pdb import set_trace
+
+FILTERS = ('Section', 'Architecture', 'Priority')
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def _postings(index):
+    '''dict of lists -> dict of array('I'), shrunk to fit.'''
+    return dict((key, array.array('I', ids)) for key, ids in index.items())
+
+
+class SearchIndex(object):
+    """
+    :param 'catalog': [utils/package_catalog.py Catalog] fully loaded.
+    """
+
+    def __init__(self, catalog):
+        self.names = sorted(catalog.keys())
+        grams = {}
+        words = {}
+        filters = dict((field, {}) for field in FILTERS)
+        for id, name in enumerate(self.names):
+            pkg = catalog.fields(name, ('Description', ) + FILTERS)
+            lower = name.lower()
+            for gram in set(lower[i:i + 3] for i in range(len(lower) - 2)):
+                grams.setdefault(gram, []).append(id)
+            text = lower + ' ' + pkg.get('Description', '').split('\n')[0].lower()
+            for word in set(_WORD.findall(text)):
+                words.setdefault(word, []).append(id)
+            for field in FILTERS:
+                if field in pkg:
+                    filters[field].setdefault(pkg[field], []).append(id)
+        self._grams = _postings(grams)
+        self._words = _postings(words)
+        self._vocabulary = sorted(self._words)
+        self._filters = dict((field, _postings(values))
+                             for field, values in filters.items())
+
+    def __len__(self):
+        return len(self.names)
+
+    def values(self, field):
+        '''Sorted values seen for one of FILTERS.'''
+        return sorted(self._filters[field])
+
+    def _prefix(self, prefix):
+        '''Ids of the names starting with prefix, a range.'''
+        low = bisect.bisect_left(self.names, prefix)
+        high = bisect.bisect_left(self.names, prefix + '\U0010ffff', low)
+        return range(low, high)
+
+    def _in_names(self, term):
+        if len(term) < 3:
+            return set(self._prefix(term))
+        result = None
+        for i in range(len(term) - 2):
+            ids = self._grams.get(term[i:i + 3])
+            if ids is None:
+                return set()
+            result = set(ids) if result is None else result.intersection(ids)
+        if len(term) == 3:
+            return result
+        return set(id for id in result if term in self.names[id].lower())
+
+    def _in_words(self, term):
+        result = set()
+        vocabulary = self._vocabulary
+        i = bisect.bisect_left(vocabulary, term)
+        while i < len(vocabulary) and vocabulary[i].startswith(term):
+            result.update(self._words[vocabulary[i]])
+            i += 1
+        return result
+
+    def search(self, query='', prefix=None, filters=None, offset=0,
+               limit=50):
+        """
+            Packages matching all of query, prefix and filters.
+
+        :param 'query': [str] whitespace-separated terms, case ignored.
+        :param 'prefix': [str] package names starting with it (exactly).
+        :param 'filters': [dict] field from FILTERS -> value it must have.
+        :param 'offset': [int] matches to skip, for paging.
+        :param 'limit': [int] most names to return.
+        :return: [tuple] (total number of matches, [ names ]).
+        """
+        candidates = None       # set of ids, None for all of them
+        if prefix:
+            candidates = set(self._prefix(prefix))
+        for field, value in (filters or {}).items():
+            if field not in self._filters:
+                raise ValueError('Cannot filter on "%s", only on %s' % (
+                    field, ', '.join(FILTERS)))
+            ids = self._filters[field].get(value, ())
+            candidates = set(ids) if candidates is None else \
+                candidates.intersection(ids)
+
+        in_names = None
+        for term in query.lower().split():
+            names = self._in_names(term)
+            hits = names | self._in_words(term)
+            candidates = hits if candidates is None else candidates & hits
+            in_names = names if in_names is None else in_names & names
+        if candidates is None:
+            total = len(self.names)
+            return total, self.names[offset:offset + max(limit, 0)]
+
+        if in_names:
+            ordered = sorted(candidates & in_names) + \
+                      sorted(candidates - in_names)
+        else:
+            ordered = sorted(candidates)
+        return len(ordered), [ self.names[id] for id in
+                               ordered[offset:offset + max(limit, 0)] ]
@@ -0,0 +1,137 @@
+#!/usr/bin/python3 -tt
+'''
+    Block-parallel gzip writer in the style of pigz.  Input is cut into
+blocks that worker threads deflate independently, each primed with the
+last 32 KB of the block before it so the ratio stays close to plain gzip.
+Every block but the last ends on a sync flush (byte aligned, not final),
+so concatenating them in order is one ordinary deflate stream: the result
+is a standard single-member .gz that gzip, grub and the kernel all read.
+zlib releases the GIL while it deflates, so threads really do use cores.
+
+Standard python3 libraries only.
+'''
+
+import collections
+import concurrent.futures
+import os
+import struct
+import time
+import zlib
+
+from pdb import set_trace
+
+BLOCKSIZE = 1 << 17         # pigz default
+_DICTSIZE = 1 << 15         # deflate window
+
+
+def default_threads():
+    return os.cpu_count() or 1
+
+
+def _deflate(block, zdict, level, last):
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = comp.compress(block)
+    return data + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class GzipWriter(object):
+    """
+        Write-only file object producing a gzip stream on fileobj.  The
+    caller owns (and closes) fileobj; close() here finishes the stream.
+    With threads=1 no pool is started and blocks are deflated inline.
+    """
+
+    def __init__(self, fileobj, compresslevel=6, threads=None,
+                 blocksize=BLOCKSIZE):
+        self.fileobj = fileobj
+        self.level = compresslevel
+        self.threads = max(1, threads or default_threads())
+        self.blocksize = blocksize
+        self.closed = False
+        self._buf = bytearray()
+        self._dict = b''
+        self._crc = 0
+        self._size = 0
+        self._pending = collections.deque()
+        self._pool = None
+        if self.threads > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                                  int(time.time()), 0, 3))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self.closed = True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write() on closed GzipWriter')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buf += data
+        while len(self._buf) >= self.blocksize:
+            block = bytes(self._buf[:self.blocksize])
+            del self._buf[:self.blocksize]
+            self._submit(block, last=False)
+        return len(data)
+
+    def _submit(self, block, last):
+        zdict, self._dict = self._dict, block[-_DICTSIZE:]
+        if self._pool is None:
+            self.fileobj.write(_deflate(block, zdict, self.level, last))
+            return
+        self._pending.append(
+            self._pool.submit(_deflate, block, zdict, self.level, last))
+        # Bounded read-ahead: write out finished blocks in order
+        while self._pending and (len(self._pending) > 2 * self.threads or
+                                 self._pending[0].done()):
+            self.fileobj.write(self._pending.popleft().result())
+
+    def flush(self):
+        '''Blocks go out as they complete, there is nothing to force.'''
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buf), last=True)
+            self._buf = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self._crc & 0xffffffff,
+                                           self._size & 0xffffffff))
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+            self.closed = True
+
+
+def compress_file(source, dest, compresslevel=6, threads=None):
+    """
+        gzip source to dest, written under a temporary name and renamed.
+
+    :return: [str] dest
+    """
+    tmp = '%s.tmp%d' % (dest, os.getpid())
+    try:
+        with open(source, 'rb') as f_in, open(tmp, 'wb') as raw:
+            with GzipWriter(raw, compresslevel, threads) as f_out:
+                for chunk in iter(lambda: f_in.read(1 << 20), b''):
+                    f_out.write(chunk)
+        os.replace(tmp, dest)
+        return dest
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
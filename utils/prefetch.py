@@ -0,0 +1,106 @@
+#!/usr/bin/python3 -tt
+'''
+    Download the .debs of a manifest's dependency closure (computed by the
+packages blueprint from its indices) before the chroot starts.  Downloads
+run concurrently over one pooled HTTP session so mirror latency overlaps
+instead of adding up per package, and each file is checked against the
+size and SHA256 of the index before it is renamed into place.  apt in the
+chroot then finds them already "downloaded" and only unpacks/configures.
+'''
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+from pdb import set_trace
+
+from . import deb_cache
+from . import index_cache
+
+
+def load(path):
+    '''The list written by the nodes blueprint, [] if there isn't one.'''
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, TypeError, ValueError):
+        return []
+
+
+def _fetch(session, deb, dest):
+    '''Download one .deb into dest; return its size.  Raise on mismatch.'''
+    partial = '%s.partial%d' % (dest, os.getpid())
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with session.get(deb['url'], stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            with open(partial, 'wb') as f:
+                for chunk in resp.iter_content(1 << 16):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        if deb['size'] >= 0 and size != deb['size']:
+            raise RuntimeError('%s: got %d bytes, index says %d' % (
+                deb['url'], size, deb['size']))
+        if digest.hexdigest() != deb['sha256']:
+            raise RuntimeError('%s: SHA256 mismatch' % deb['url'])
+        os.rename(partial, dest)
+        return size
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+
+def prefetch(debs, dest_dir, installed=None, explicit=(), workers=8):
+    """
+        Fetch every deb not already in dest_dir.  Dependencies the tree
+    already has at the same version are skipped; explicit packages are not
+    because install.sh reinstalls them.
+
+    :param 'debs': [list] of dicts from the packages blueprint closure()
+    :param 'dest_dir': [str] deb_cache pool or the chroot's apt archives.
+    :param 'installed': [dict] deb_cache.installed() of the tree.
+    :param 'explicit': [list] packages named by the manifest.
+    :return: [dict] counts of fetched, present, skipped, failed, plus bytes,
+             seconds and the failure messages.
+    """
+    installed = installed or {}
+    explicit = frozenset(explicit)
+    stats = dict(fetched=0, present=0, skipped=0, failed=0, bytes=0,
+                 seconds=0.0, errors=[])
+    todo = []
+    for deb in debs:
+        name = deb['package']
+        if name not in explicit and \
+           installed.get(name, (None, ))[0] == deb['version']:
+            stats['skipped'] += 1
+            continue
+        dest = '%s/%s' % (dest_dir, deb_cache.deb_name(
+            name, deb['version'], deb['architecture']))
+        if os.path.isfile(dest) and os.path.getsize(dest) == deb['size']:
+            stats['present'] += 1
+            continue
+        todo.append((deb, dest))
+    if not todo:
+        return stats
+
+    start = time.time()
+    session = index_cache.session(workers)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [ pool.submit(_fetch, session, deb, dest)
+                        for deb, dest in todo ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    stats['bytes'] += future.result()
+                    stats['fetched'] += 1
+                except Exception as err:    # apt will try again itself
+                    stats['failed'] += 1
+                    stats['errors'].append(str(err))
+    finally:
+        session.close()
+    stats['seconds'] = time.time() - start
+    return stats
@@ -0,0 +1,297 @@
+#!/usr/bin/python3 -tt
+'''
+    Provision the writable root file system ("untar/") of a node build.
+The golden tarball is extracted ONCE into a read-only cache next to it.
+Every build then gets its own writable tree from that cache through a
+copy-on-write backend:
+
+    overlay - overlayfs mount, cache is lowerdir, upper/work in build_dir
+    btrfs   - subvolume snapshot (cache must live on btrfs)
+    reflink - "cp -a --reflink=always" (btrfs, XFS with reflink=1)
+    untar   - the original full extraction per build, always works
+
+Like core_utils, this is also imported by configs/setup_* scripts so keep
+it to standard python3 libraries.
+'''
+
+import fcntl
+import glob
+import hashlib
+import os
+import re
+
+from pdb import set_trace
+
+from . import core_utils
+from . import file_utils
+
+BACKENDS = ('overlay', 'btrfs', 'reflink', 'untar')
+
+_CACHE_PREFIX = 'rootfs.'
+
+
+def _fstype(path):
+    '''Return the file system type holding path by longest mount prefix.'''
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                elems = line.split()
+                if len(elems) < 3:
+                    continue
+                mnt = elems[1].replace('\\040', ' ')
+                if not (path == mnt or path.startswith(mnt.rstrip('/') + '/')):
+                    continue
+                if len(mnt) >= len(best):
+                    best, fstype = mnt, elems[2]
+    except OSError:
+        pass
+    return fstype
+
+
+def _have_overlay():
+    try:
+        with open('/proc/filesystems', 'r') as f:
+            return 'overlay' in f.read()
+    except OSError:
+        return False
+
+
+def _is_subvolume(path):
+    '''btrfs subvolume roots always have inode 256.'''
+    try:
+        return os.lstat(path).st_ino == 256 and _fstype(path) == 'btrfs'
+    except OSError:
+        return False
+
+
+def _candidates(backend, cache):
+    '''Ordered list of backends to try for "backend" (which may be "auto").'''
+    if backend in BACKENDS:
+        return [ backend ]
+    assert backend == 'auto', 'Unknown rootfs backend "%s"' % backend
+    # A snapshot is instant AND independent of the cache afterwards.
+    if _is_subvolume(cache):
+        return [ 'btrfs', 'overlay', 'reflink' ]
+    return [ 'overlay', 'reflink' ]
+
+
+def cache_key(golden_tar):
+    '''Cheap identity of a golden tarball: path, size and mtime.'''
+    s = os.stat(golden_tar)
+    ident = '%s:%d:%d' % (os.path.realpath(golden_tar), s.st_size, s.st_mtime_ns)
+    return hashlib.sha1(ident.encode()).hexdigest()[:16]
+
+
+def golden_cache(golden_tar, progress=None):
+    """
+        Return the path of the read-only extracted copy of golden_tar,
+    extracting it first if needed.  Concurrent builders serialize on a
+    lock file so the tarball is extracted exactly once.  On btrfs the cache
+    is a subvolume so it can be snapshotted.
+
+    :param 'golden_tar': [str] absolute path to golden.ARCH.tar[.gz|.xz|.zst]
+    :param 'progress': passed to core_utils.untar() if extraction is needed.
+    :return: [str] path to the cache directory.  Raise RuntimeError on problems.
+             Copies of earlier golden tarballs are removed once this one is
+             in place (see prune_golden()).
+    """
+    golden_dir = os.path.dirname(golden_tar)
+    cache = '%s/%s%s' % (golden_dir, _CACHE_PREFIX, cache_key(golden_tar))
+    if os.path.isdir(cache):
+        return cache
+
+    with open(cache + '.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)     # released on close
+        if os.path.isdir(cache):                # Somebody beat me to it
+            return cache
+        staging = '%s.tmp%d' % (cache, os.getpid())
+        _remove_tree(staging)       # Leftover from a crashed builder
+        if _fstype(golden_dir) == 'btrfs':
+            ret, _, stderr = core_utils.piper(
+                'btrfs subvolume create %s' % staging)
+            if ret:
+                raise RuntimeError('btrfs subvolume create failed: %s' % stderr)
+            # untar removes the target first, so extract below it and
+            # rename the contents up (cheap, same file system).
+            core_utils.untar(staging + '/tree/', golden_tar, progress)
+            for entry in os.listdir(staging + '/tree'):
+                os.rename(staging + '/tree/' + entry, staging + '/' + entry)
+            os.rmdir(staging + '/tree')
+        else:
+            core_utils.untar(staging + '/', golden_tar, progress)
+        os.rename(staging, cache)
+    prune_golden(golden_dir, keep=cache)
+    return cache
+
+
+def _lower_in_use(path):
+    '''An overlay somewhere still has path as a lower dir.'''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            mounts = f.read()
+    except OSError:
+        return False
+    return (path + ',') in mounts or (path + ':') in mounts
+
+
+def prune_golden(golden_dir, keep):
+    """
+        Remove the extracted copies of earlier golden tarballs.  Each is
+    as big as a full root file system and a rebuilt golden image never
+    uses them again.  Copies under a live overlay, or flocked by a build
+    about to clone them (see provision()), are left for next time.
+
+    :param 'keep': [str] the current copy.
+    :return: [list] of the paths removed.
+    """
+    removed = []
+    for cache in glob.glob('%s/%s*' % (golden_dir, _CACHE_PREFIX)):
+        name = os.path.basename(cache)[len(_CACHE_PREFIX):]
+        if cache == keep or not re.fullmatch('[0-9a-f]{16}', name) or \
+           not os.path.isdir(cache) or _lower_in_use(cache):
+            continue
+        with open(cache + '.lock', 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            _remove_tree(cache)
+            os.unlink(cache + '.lock')
+        removed.append(cache)
+    return removed
+
+
+def clone(source, dest, backend, build_dir):
+    """
+        Give dest a private writable view of source.  Raise RuntimeError
+    if the backend cannot do it here; the caller tries the next one.
+    For overlay, source may be a colon-separated stack of lower dirs.
+    """
+    if backend == 'overlay':
+        if not _have_overlay():
+            raise RuntimeError('overlayfs not supported by this kernel')
+        upper = build_dir + '/upper'
+        work = build_dir + '/work'
+        for d in (upper, work, dest):
+            file_utils.make_dir(d)
+        cmd = 'mount -t overlay overlay -o lowerdir=%s,upperdir=%s,workdir=%s %s' % (
+            source, upper, work, dest)
+    elif backend == 'btrfs':
+        if not _is_subvolume(source):
+            raise RuntimeError('%s is not a btrfs subvolume' % source)
+        cmd = 'btrfs subvolume snapshot %s %s' % (source, dest)
+    elif backend == 'reflink':
+        cmd = 'cp -a --reflink=always %s %s' % (source, dest)
+    elif backend == 'copy':     # Last resort for trees that aren't tarballs
+        cmd = 'cp -a %s %s' % (source, dest)
+    else:
+        raise RuntimeError('"%s" is not a copy-on-write backend' % backend)
+
+    ret, _, stderr = core_utils.piper(cmd)
+    if ret:
+        release(build_dir, dest)     # partial reflink copies, empty mountpoint
+        raise RuntimeError('%s failed: %s' % (cmd, stderr))
+
+
+def clone_any(source, dest, backend, build_dir, logger=None, extra=()):
+    """
+        clone() with every candidate for backend in turn, then any extra
+    backends.  Return the backend that worked or None if none did.
+    """
+    for candidate in _candidates(backend, source) + list(extra):
+        try:
+            clone(source, dest, candidate, build_dir)
+            return candidate
+        except RuntimeError as err:
+            if logger is not None:
+                logger.warning('rootfs backend %s unusable: %s' % (
+                    candidate, str(err)))
+    return None
+
+
+def _remove_tree(path):
+    '''remove_target() that also knows about btrfs subvolumes.'''
+    if _is_subvolume(path):
+        core_utils.piper('btrfs subvolume delete %s' % path)
+    if os.path.lexists(path):
+        file_utils.remove_target(path)
+
+
+def _unmount(dest):
+    if os.path.ismount(dest):
+        ret, _, stderr = core_utils.piper('umount %s' % dest)
+        if ret:     # Stray chroot daemons or a browser reading install.log
+            ret, _, stderr = core_utils.piper('umount -l %s' % dest)
+        if ret:
+            raise RuntimeError('Cannot unmount %s: %s' % (dest, stderr))
+
+
+def release(build_dir, dest=None):
+    """
+        Undo whatever a previous provision() left in build_dir: unmount an
+    overlay, delete a btrfs snapshot, remove the tree and overlay upper/work.
+    Safe to call on directories that never had anything.
+
+    :param 'build_dir': [str] the node build directory.
+    :param 'dest': [str] the root file system under it; default build_dir/untar.
+    """
+    if dest is None:
+        dest = build_dir + '/untar'
+    dest = dest.rstrip('/')
+    _unmount(dest)
+    for d in (dest, build_dir + '/upper', build_dir + '/work'):
+        _remove_tree(d)
+
+
+def detach(build_dir, dest=None):
+    """
+        Like release() but keep an overlay upper dir: afterwards it holds
+    exactly what the build changed and can be stacked on its lower dir.
+
+    :return: [str] path of the upper dir, None if dest was not an overlay.
+    """
+    if dest is None:
+        dest = build_dir + '/untar'
+    dest = dest.rstrip('/')
+    upper = build_dir + '/upper'
+    if not (os.path.ismount(dest) and os.path.isdir(upper)):
+        return None
+    _unmount(dest)
+    for d in (dest, build_dir + '/work'):
+        _remove_tree(d)
+    return upper
+
+
+def provision(args, progress=None):
+    """
+        Create args.build_dir/untar/ as a writable root file system built
+    from args.golden_tar and return its path (with trailing slash, as
+    core_utils.untar always did).
+
+    :param 'args.rootfs_backend': [str] one of BACKENDS or "auto" (default).
+    :param 'args.is_golden': [bool] golden customization always untars;
+                                    its result is tarred up again.
+    :param 'progress': callable(nbytes, seconds) for any extraction done.
+    :return: [str] new_fs_dir.  Sets args.rootfs_backend_used.
+    """
+    backend = getattr(args, 'rootfs_backend', None) or 'auto'
+    dest = args.build_dir + '/untar'
+    release(args.build_dir, dest)
+
+    if not getattr(args, 'is_golden', False) and backend != 'untar':
+        cache = golden_cache(args.golden_tar, progress)
+        # Shared lock: prune_golden() can't remove it before it's mounted
+        with open(cache + '.lock', 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_SH)
+            used = None
+            if os.path.isdir(cache):
+                used = clone_any(cache, dest, backend, args.build_dir,
+                                 getattr(args, 'logger', None))
+        if used is not None:
+            args.rootfs_backend_used = used
+            return dest + '/'
+
+    args.rootfs_backend_used = 'untar'
+    return core_utils.untar(dest + '/', args.golden_tar, progress)
@@ -0,0 +1,389 @@
+#!/usr/bin/python3 -tt
+'''
+    Build scheduler for node images.  Binding a node used to fork a build
+straight away, so binding a whole rack started every untar, chroot and
+compression at once.  Now a bind submits a job and a dispatcher thread in
+the server forks at most max_jobs builds at a time, in FIFO order or by
+priority (higher first, FIFO among equals).  A job may wait for another
+one "after" it, so nodes bound together to one manifest let the first build
+the shared image and then reuse it, instead of all building it at once.
+
+Jobs are persisted one JSON file per job in jobs_dir, so a restarted server
+picks up queued jobs and keeps track of builds that outlived it:
+
+    <job_id>.json   job_id, seq, node_coord, hostname, manifest, priority,
+                    after, submitted, state ("queued" or "running") and pid
+
+Inside a build, slot() additionally bounds how many builds are in one
+phase at a time: flock()ed slot files, so it works across the forked
+builds without the server's help.
+
+Standard python3 libraries only.
+'''
+
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from pdb import set_trace
+
+ORDERS = ('fifo', 'priority')
+
+
+class Job(object):
+
+    _FIELDS = ('job_id', 'seq', 'node_coord', 'hostname', 'manifest',
+               'priority', 'after', 'submitted', 'state', 'pid')
+
+    def __init__(self, **kwargs):
+        for field in self._FIELDS:
+            setattr(self, field, kwargs.get(field, None))
+        self.args = None        # build arguments, not persisted
+        self.adopted = False    # running build of a previous server
+        self.position = None    # in the queue, last reported
+
+    def todict(self):
+        return { field: getattr(self, field) for field in self._FIELDS }
+
+
+class Scheduler(object):
+    """
+        Persistent job queue feeding forked builds.
+
+    :param 'jobs_dir': [str] where job files are kept.
+    :param 'run': callable(job) run in the forked child, which then exits.
+                  Only the dispatcher thread exists in the child and no
+                  scheduler lock is held, but whatever the server's other
+                  threads had open (log files, sqlite connections) is
+                  inherited as is: run() must let go of it before use.
+    :param 'max_jobs': [int] builds running at once, 0 means no limit.
+    :param 'order': [str] "fifo" or "priority".
+    :param 'report': callable(job, message, status) to update the node
+                     status of a job that is waiting or died.
+    """
+
+    def __init__(self, jobs_dir, run, max_jobs=4, order='fifo', report=None,
+                 logger=None, poll=1.0):
+        if order not in ORDERS:
+            raise RuntimeError('Unknown build order "%s", use one of %s' % (
+                order, ', '.join(ORDERS)))
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.jobs_dir = jobs_dir
+        self.max_jobs = max_jobs
+        self.order = order
+        self.poll = poll
+        self._run = run
+        self._report = report
+        self._logger = logger
+        self._queued = []
+        self._running = {}      # pid -> Job
+        self._starting = []     # taken from the queue, not forked yet
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def _log(self, msg, level='info'):
+        if self._logger is not None:
+            getattr(self._logger, level)(msg)
+
+    def _path(self, job):
+        return '%s/%s.json' % (self.jobs_dir, job.job_id)
+
+    def _save(self, job):
+        tmp = self._path(job) + '.new'
+        with open(tmp, 'w') as f:
+            json.dump(job.todict(), f)
+        os.replace(tmp, self._path(job))
+
+    def _forget(self, job):
+        try:
+            os.unlink(self._path(job))
+        except FileNotFoundError:
+            pass
+
+    def _key(self, job):
+        if self.order == 'priority':
+            return (-job.priority, job.seq)
+        return (job.seq, )
+
+    def _report_positions(self):
+        if self._report is None:
+            return
+        total = len(self._queued)
+        for position, job in enumerate(self._queued, 1):
+            if job.position != position:
+                job.position = position
+                self._report(job, 'Queued for build, position %d of %d' % (
+                    position, total), 'building')
+
+    def _enqueue(self, job):
+        job.position = None
+        self._queued.append(job)
+        self._queued.sort(key=self._key)
+
+    def submit(self, args, manifest, priority=0, after=None):
+        """
+            Queue a build.
+
+        :param 'args': [Namespace] build arguments with hostname and
+                       node_coord; job_id and queue_position get set.
+        :param 'manifest': [str] manifest namespace, for recovery.
+        :param 'after': [str] job_id that has to finish first.
+        :return: [Job] the new job.
+        """
+        with self._cond:
+            self._seq += 1
+            job = Job(job_id=uuid.uuid4().hex[:12], seq=self._seq,
+                      node_coord=args.node_coord, hostname=args.hostname,
+                      manifest=manifest, priority=int(priority or 0),
+                      after=after, submitted=time.time(), state='queued')
+            job.args = args
+            args.job_id = job.job_id
+            self._save(job)
+            self._enqueue(job)
+            self._report_positions()
+            self._cond.notify()
+        self.start()
+        return job
+
+    def cancel(self, node_coord):
+        '''Drop the queued job of a node.  Returns True if there was one.'''
+        with self._cond:
+            for job in self._queued:
+                if job.node_coord == node_coord:
+                    self._queued.remove(job)
+                    self._forget(job)
+                    self._report_positions()
+                    return True
+        return False
+
+    def position(self, job_id):
+        '''1-based place in the queue, 0 if running, None if unknown.'''
+        with self._cond:
+            for position, job in enumerate(self._queued, 1):
+                if job.job_id == job_id:
+                    return position
+            for job in list(self._running.values()) + self._starting:
+                if job.job_id == job_id:
+                    return 0
+        return None
+
+    def jobs(self):
+        '''Running then queued jobs, as dicts.'''
+        with self._cond:
+            return [ job.todict() for job in list(self._running.values()) +
+                     self._starting + self._queued ]
+
+    def recover(self, make_args):
+        """
+            Load the jobs a previous server left behind.  Queued jobs go back
+        in the queue, running builds that are still alive count against
+        max_jobs until they finish, dead ones are reported.
+
+        :param 'make_args': callable(job) that returns its build arguments,
+                            or None if the job should be dropped.
+        :return: [int] number of jobs recovered.
+        """
+        recovered = 0
+        with self._cond:
+            jobs = []
+            for fname in glob.glob(self.jobs_dir + '/*.json'):
+                try:
+                    with open(fname) as f:
+                        jobs.append(Job(**json.load(f)))
+                except (OSError, ValueError, TypeError) as err:
+                    self._log('Dropping job file %s: %s' % (fname, err),
+                              'warning')
+                    os.unlink(fname)
+            for job in sorted(jobs, key=lambda j: j.seq):
+                self._seq = max(self._seq, job.seq)
+                if job.state == 'running' and _alive(job.pid):
+                    job.adopted = True
+                    self._running[job.pid] = job
+                    recovered += 1
+                    continue
+                job.args = make_args(job)
+                if job.args is None:
+                    self._forget(job)
+                elif job.state == 'running':
+                    self._forget(job)
+                    if self._report is not None:
+                        self._report(job, 'Build was interrupted, bind the '
+                                     'node again', 'error')
+                else:
+                    job.args.job_id = job.job_id
+                    self._enqueue(job)
+                    recovered += 1
+            self._report_positions()
+        if recovered:
+            self.start()
+        return recovered
+
+    def start(self):
+        '''Start the dispatcher thread if it isn't running.'''
+        with self._cond:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(
+                    target=self._dispatch, name='build-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """
+            Launch nothing more, for a server about to re-execute itself.
+        Running builds carry on and jobs submitted from now on are only
+        saved; recover() in the next server picks both up.
+        """
+        with self._cond:
+            self._stopped = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def _dispatch(self):
+        while not self._stopped:
+            with self._cond:
+                if self._stopped:
+                    break
+                starting = []
+                try:
+                    self._reap()
+                    starting = self._take()
+                except Exception as err:
+                    self._log('Build scheduler: %s' % err, 'error')
+                if not starting:
+                    self._cond.wait(self.poll)
+                    continue
+            # fork() with no lock held: the child has no server thread
+            # left to release one.
+            failed = [ job for job in starting if not self._launch(job) ]
+            if failed:
+                with self._cond:
+                    self._cond.wait(self.poll)
+
+    def _reap(self):
+        for pid, job in list(self._running.items()):
+            if job.adopted:
+                try:    # still our child if this process re-executed
+                    done, retval = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = 0 if _alive(pid) else pid
+                    retval = 0      # exit status is unknown
+                if not done:
+                    continue
+            else:
+                try:
+                    done, retval = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done, retval = pid, 0
+                if not done:
+                    continue
+            del self._running[pid]
+            self._forget(job)
+            if retval and self._report is not None:
+                self._report(job, 'Build process died (wait status %d)' %
+                             retval, 'error')
+            self._log('Job %s for %s finished' % (job.job_id, job.hostname))
+
+    def _next(self):
+        '''First queued job that isn't waiting for another one.'''
+        pending = set(job.job_id for job in self._queued)
+        pending.update(job.job_id for job in self._running.values())
+        pending.update(job.job_id for job in self._starting)
+        for job in self._queued:
+            if job.after not in pending:
+                self._queued.remove(job)
+                return job
+        return None
+
+    def _take(self):
+        '''Move the jobs that may start now from the queue to _starting.'''
+        taken = []
+        while not self.max_jobs or \
+              len(self._running) + len(self._starting) < self.max_jobs:
+            job = self._next()
+            if job is None:
+                break
+            self._starting.append(job)
+            taken.append(job)
+        if taken:
+            self._report_positions()
+        return taken
+
+    def _launch(self, job):
+        '''Fork the build of a job from _take(), called without _cond.
+        Returns False if it went back in the queue.'''
+        try:
+            pid = os.fork()
+        except OSError as err:
+            with self._cond:
+                self._starting.remove(job)
+                self._enqueue(job)          # the next round tries again
+            self._log('Cannot fork job %s for %s: %s' % (
+                job.job_id, job.hostname, err), 'error')
+            return False
+        if pid == 0:
+            try:
+                self._run(job)
+            finally:
+                os._exit(0)
+        with self._cond:
+            self._starting.remove(job)
+            job.state = 'running'
+            job.pid = pid
+            self._running[pid] = job
+            self._save(job)
+        self._log('Job %s for %s started, PID %d' % (
+            job.job_id, job.hostname, pid))
+        return True
+
+
+def _alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def slot(slots_dir, kind, count, waiting=None, poll=0.5):
+    """
+        Hold one of "count" slots of a kind (say "io" or "cpu") shared by
+    every build on the server, waiting for one to free up if necessary.
+    No slots_dir or a count of 0 means no limit.
+
+    :param 'waiting': callable() invoked once if all slots are taken.
+    """
+    if not slots_dir or not count:
+        yield
+        return
+    os.makedirs(slots_dir, exist_ok=True)
+    waited = False
+    while True:
+        for i in range(count):
+            lockfile = open('%s/%s.%d' % (slots_dir, kind, i), 'a')
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lockfile.close()
+                continue
+            try:
+                yield
+            finally:
+                lockfile.close()
+            return
+        if not waited and waiting is not None:
+            waiting()
+        waited = True
+        time.sleep(poll)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3 -tt
+'''
+    Production HTTP serving for manifest_api.py.  The server stays one
+process: the build scheduler, node status cache, event log and package
+catalogs are its in-memory state and the worker threads share them.
+
+  - SERVER_WORKERS threads handle connections; more wait in the listen
+    backlog (SERVER_BACKLOG) instead of each getting a thread.
+  - HTTP/1.1 keep-alive; an idle connection is closed after
+    SERVER_KEEPALIVE_SECONDS so it doesn't hold a worker.
+  - SIGHUP reloads: stop accepting, let the requests in flight finish (at
+    most SERVER_GRACEFUL_SECONDS), then re-exec the same command line in
+    the same PID with the listening socket inherited.  Clients connecting
+    meanwhile wait in the backlog rather than being refused, and the
+    daemon PID file and systemd's MainPID stay right.
+  - SIGTERM drains the same way, then serve() returns.
+
+The flask development server (run()) is still used with --debug and
+--auto-update.
+'''
+
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+import werkzeug.serving
+
+from pdb import set_trace
+
+LISTEN_FD = 'TMMS_LISTEN_FD'    # set across a reload's exec()
+
+# Before manifest_api.py changes directory
+_argv = [ os.path.abspath(sys.argv[0]) ] + sys.argv[1:]
+
+
+def reloaded():
+    '''True in the process a SIGHUP re-executed.'''
+    return LISTEN_FD in os.environ
+
+
+class _Handler(werkzeug.serving.WSGIRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def handle_one_request(self):
+        super().handle_one_request()
+        if self.server.draining:
+            self.close_connection = True
+
+
+class PooledWSGIServer(werkzeug.serving.BaseWSGIServer):
+    """
+        werkzeug's server with a fixed pool of worker threads.
+
+    :param 'workers': [int] connections handled at once.
+    :param 'backlog': [int] listen() backlog.
+    :param 'keepalive': [float] seconds a connection may sit idle, also
+                        the timeout of each socket read and write.
+    :param 'fd': [int] listening socket to use instead of binding one.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, workers=32, backlog=128,
+                 keepalive=10.0, fd=None):
+        assert workers > 0, 'Need at least one worker thread'
+        self.request_queue_size = backlog       # read by server_activate()
+        handler = type('Handler', (_Handler, ), { 'timeout': keepalive })
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        if fd is not None:
+            os.close(fd)    # werkzeug made its own copy
+        self.draining = False
+        self._pending = queue.Queue(maxsize=workers)
+        self._busy = 0
+        self._idle = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, name='http-worker-%d' % i,
+                             daemon=True).start()
+
+    def serve_forever(self, poll_interval=0.5):
+        '''werkzeug's closes the socket, which a reload has to keep.'''
+        try:
+            socketserver.BaseServer.serve_forever(self, poll_interval)
+        except KeyboardInterrupt:
+            self.draining = True
+
+    def process_request(self, request, client_address):
+        '''Called by serve_forever(); blocks while every worker is busy.'''
+        with self._idle:
+            self._busy += 1
+        self._pending.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._pending.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._idle:
+                    self._busy -= 1
+                    self._idle.notify_all()
+
+    def drain(self, timeout):
+        '''Wait for accepted connections to finish, True if they all did.'''
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+
+def serve(app, host, port, workers=32, backlog=128, keepalive=10.0,
+          graceful=30.0, on_drain=None, logger=None):
+    """
+        Serve app until SIGTERM, re-exec on SIGHUP (see above).
+
+    :param 'on_drain': callable() when requests stop being accepted, to end
+                       long polls and event streams and to stop anything
+                       the re-executed server will take over.
+    """
+    fd = os.environ.pop(LISTEN_FD, None)
+    server = PooledWSGIServer(host, port, app, workers=workers,
+                              backlog=backlog, keepalive=keepalive,
+                              fd=None if fd is None else int(fd))
+    signalled = []
+
+    def stop(signum, frame):
+        if signalled:
+            return      # Daemon.stop() repeats SIGTERM until it's gone
+        signalled.append(signum)
+        server.draining = True
+        # shutdown() waits for serve_forever(), which this thread is in
+        threading.Thread(target=server.shutdown, name='http-shutdown').start()
+
+    signal.signal(signal.SIGHUP, stop)
+    signal.signal(signal.SIGTERM, stop)
+    if logger is not None:
+        logger.info('Serving on %s:%s with %d workers' % (
+            host, port, workers))
+    server.serve_forever()
+
+    if on_drain is not None:
+        on_drain()
+    if not server.drain(graceful) and logger is not None:
+        logger.warning('Requests still active after %ss' % graceful)
+
+    if signalled == [ signal.SIGHUP ]:
+        if logger is not None:
+            logger.info('Reloading: exec %s' % ' '.join(_argv))
+        listen_fd = server.socket.fileno()
+        os.set_inheritable(listen_fd, True)
+        os.environ[LISTEN_FD] = str(listen_fd)
+        os.execv(sys.executable, [ sys.executable ] + _argv)
+    server.server_close()
@@ -0,0 +1,285 @@
+#!/usr/bin/python3 -tt
+'''
+    In-memory copy of every node's status.json under TFTP_IMAGES, so web
+pages and API listings don't open and parse a file per node per request.
+A thread keeps it current from inotify events on the images directory and
+each node directory beneath it (update_status() renames status.json.new
+over status.json, unbinding deletes it).  Every "poll" seconds, or all the
+time if inotify is unavailable, it also compares status.json mtimes as a
+fallback for anything inotify missed (queue overflow, NFS).
+
+Standard python3 libraries only; inotify goes through ctypes.
+'''
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+from pdb import set_trace
+
+STATUS = 'status.json'
+_SEEDED = ()    # signature of an "initial" status, no stat() matches it
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+
+_TOP_MASK = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_ONLYDIR
+_NODE_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_DELETE | \
+             _IN_DELETE_SELF | _IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+
+class _Inotify(object):
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._add = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path, mask):
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch %s' % path)
+        return wd
+
+    def read(self):
+        '''Pending events as (wd, mask, name).'''
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _read_status(path):
+    """
+    :return: [tuple] (stat signature, status dict) or (None, None) if
+             there is no status file.
+    """
+    try:
+        st = os.stat(path)
+        with open(path, 'r') as f:
+            status = json.loads(f.read())
+    except FileNotFoundError:
+        return None, None
+    except Exception as err:
+        return None, {
+            'message':  'Failed to parse status file: %s ' % str(err),
+            'manifest': 'unknown',
+            'status':   'error'
+        }
+    return (st.st_ino, st.st_mtime_ns, st.st_size), status
+
+
+class StatusCache(object):
+    """
+        hostname -> status dict for every <images_dir>/<hostname>/status.json.
+
+    :param 'images_dir': [str] TFTP_IMAGES.
+    :param 'poll': [float] seconds between mtime rescans.
+    :param 'use_inotify': [bool] False leaves it all to the rescans.
+    :param 'on_change': callable(hostname, status) after the first scan,
+                        whenever a status differs from the cached one
+                        (None once unbound).
+    :param 'initial': [dict] hostname -> status to start from instead of
+                      reading every status.json (see utils/history.py);
+                      the first rescan, "poll" seconds later, checks it.
+    """
+
+    def __init__(self, images_dir, poll=30.0, use_inotify=True, logger=None,
+                 on_change=None, initial=None):
+        self.images_dir = images_dir
+        self.poll = poll
+        self.on_change = None
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._status = {}       # hostname -> (signature, status)
+        self._wds = {}          # watch descriptor -> hostname, None for top
+        self._watched = set()
+        self._inotify = None
+        self._thread = None
+        self._stop = False
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as err:
+                self._log('No inotify, polling status every %ss: %s' % (
+                    poll, err), 'warning')
+        self._watch_top()
+        if initial is None:
+            self.rescan()
+        else:
+            for hostname, status in initial.items():
+                self._watch(hostname)
+                self._status[hostname] = (_SEEDED, dict(status))
+        self.on_change = on_change
+
+    def _log(self, msg, level='info'):
+        if self._logger is not None:
+            getattr(self._logger, level)(msg)
+
+    def _watch_top(self):
+        if self._inotify is None:
+            return
+        try:
+            self._wds[self._inotify.add(self.images_dir, _TOP_MASK)] = None
+        except OSError as err:
+            self._log('Cannot watch %s: %s' % (self.images_dir, err), 'warning')
+
+    def _watch(self, hostname):
+        with self._lock:
+            if self._inotify is None or hostname in self._watched:
+                return
+            try:
+                wd = self._inotify.add(
+                    '%s/%s' % (self.images_dir, hostname), _NODE_MASK)
+            except OSError:
+                return  # gone again, or not a directory
+            self._wds[wd] = hostname
+            self._watched.add(hostname)
+
+    def get(self, hostname):
+        '''A copy of the cached status, None if the node is unbound.'''
+        with self._lock:
+            status = self._status.get(hostname, (None, None))[1]
+        return None if status is None else dict(status)
+
+    def all(self):
+        '''hostname -> status of every bound node.'''
+        with self._lock:
+            return { host: dict(status) for host, (_, status) in
+                     self._status.items() if status is not None }
+
+    def refresh(self, hostname):
+        '''Read one status.json now, returns what get() will.'''
+        self._watch(hostname)
+        signature, status = _read_status(
+            '%s/%s/%s' % (self.images_dir, hostname, STATUS))
+        with self._lock:
+            old_signature, old = self._status.get(hostname, (None, None))
+            if signature and old_signature and signature[1] < old_signature[1]:
+                return dict(old)    # a racing refresh read a newer file
+            if status is None:
+                self._status.pop(hostname, None)
+            else:
+                self._status[hostname] = (signature, status)
+            # Under the lock, so callbacks see changes in order
+            if status != old and self.on_change is not None:
+                self.on_change(hostname, None if status is None else dict(status))
+        return None if status is None else dict(status)
+
+    def rescan(self):
+        '''Pick up anything whose status.json changed by its stat().'''
+        try:
+            hostnames = [ entry.name for entry in os.scandir(self.images_dir)
+                          if entry.is_dir(follow_symlinks=False) ]
+        except OSError:
+            hostnames = []
+        with self._lock:
+            for gone in set(self._status) - set(hostnames):
+                del self._status[gone]
+                if self.on_change is not None:
+                    self.on_change(gone, None)
+        for hostname in hostnames:
+            self._watch(hostname)
+            path = '%s/%s/%s' % (self.images_dir, hostname, STATUS)
+            try:
+                st = os.stat(path)
+                signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except OSError:
+                signature = None
+            with self._lock:
+                cached = self._status.get(hostname, (None, None))[0]
+            if signature != cached:
+                self.refresh(hostname)
+
+    def _events(self):
+        rescan = False
+        for wd, mask, name in self._inotify.read():
+            if mask & _IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            hostname = self._wds.get(wd, False)
+            if mask & _IN_IGNORED:     # directory gone, watch removed
+                with self._lock:
+                    self._wds.pop(wd, None)
+                    self._watched.discard(hostname)
+                if hostname:
+                    self.refresh(hostname)
+            elif hostname is None:      # the images directory itself
+                if mask & _IN_ISDIR:
+                    self.refresh(name)
+            elif hostname and name in (STATUS, ''):
+                self.refresh(hostname)
+        if rescan:
+            self.rescan()
+
+    def start(self):
+        '''Start the watcher thread if it isn't running.'''
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='status-cache', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def after_fork(self):
+        '''In a forked child: close the inherited inotify fd, no watching.'''
+        self._stop = True
+        self._thread = None     # only the forking thread exists here
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop:
+            wait = max(0.0, last + self.poll - time.monotonic())
+            try:
+                if self._inotify is not None:
+                    ready = select.select([self._inotify.fd], [], [],
+                                          min(wait, 1.0))[0]
+                    if ready:
+                        self._events()
+                else:
+                    time.sleep(min(wait, 1.0))
+                if time.monotonic() - last >= self.poll:
+                    self.rescan()
+                    last = time.monotonic()
+            except Exception as err:
+                self._log('Status cache: %s' % err, 'error')
+                time.sleep(1.0)